@@ -0,0 +1,76 @@
+import os
+import hashlib
+import pickle
+
+class ResultCache(object):
+    def __init__(self, directory, maxsize=None):
+        """A persistent cache for extracted results. Entries are addressed by a hash of the rendered input of a task, so tasks which were already computed in an earlier run can be skipped.
+        If the total size exceeds 'maxsize', the least recently used entries are removed.
+
+        Arguments:
+            directory {str} -- folder containing the cache entries
+            maxsize {int} -- maximum size of all entries in bytes. If None, the size is not limited. (default: {None})
+        """
+        self.directory=directory
+        self.maxsize=maxsize
+        os.makedirs(directory, exist_ok=True)
+        self.size=sum(os.path.getsize(path) for path in self.entries())
+
+    def entries(self):
+        return [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.pkl')]
+
+    @staticmethod
+    def key(contents):
+        """Hash a list of strings, e.g. rendered template files and the names of the requested quantities.
+
+        Returns:
+            str -- hex digest
+        """
+        h=hashlib.sha256()
+        for content in contents:
+            content=content.encode('utf-8')
+            h.update(str(len(content)).encode('utf-8')+b':')
+            h.update(content)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key+'.pkl')
+
+    def get(self, key):
+        """Get the cached results for a key.
+
+        Returns:
+            list -- xr.DataArray objects or None, if the key is not in the cache
+        """
+        path=self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                arrays=pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(path)#mark as recently used
+        return arrays
+
+    def put(self, key, arrays):
+        """Store a list of xr.DataArray objects under a key and evict old entries if necessary."""
+        path=self.path(key)
+        if os.path.exists(path):
+            self.size-=os.path.getsize(path)
+        tempfile=f'{path}.{os.getpid()}.tmp'
+        with open(tempfile, 'wb') as f:
+            pickle.dump(arrays, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tempfile, path)
+        self.size+=os.path.getsize(path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into 'maxsize'."""
+        if self.maxsize is None or self.size<=self.maxsize:
+            return
+        entries=sorted(self.entries(), key=os.path.getmtime)
+        self.size=sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if self.size<=self.maxsize:
+                break
+            self.size-=os.path.getsize(path)
+            os.remove(path)
@@ -1,11 +1,17 @@
 import xarray as xr
+import pandas as pd
 import re as reg
 import numpy as np
 from xarray.core.dataarray import DataArray
 from ComRun.Helperfunctions import append_ids
+from ComRun.Writers import NetcdfWriter, NetcdfRowWriter, FILLED, filled_mask, rows_writable, convert_for_rows
 import ComRun.UvspecExtractors as uvex
 import os
+import io
 import functools
+import time
+import collections
+from concurrent.futures import ProcessPoolExecutor
 
 class CoordinateError(Exception): #Derived from Exception class
     def __init__(self, value): 
@@ -31,32 +37,255 @@ def extraction_func(func):
         return da
     return wrapper_checker
 
+class Axis(object):
+    def __init__(self, name, values=(), attrs=None):
+        """One dimension of the output hypercube. Coordinate values are appended in insertion order and mapped to their integer position by a lookup table, so that new values can be added without reordering existing data. Output sorts the axes of the extracted quantities with reorder before the data is used.
+
+        Arguments:
+            name {str} -- name of the dimension
+            values {arr} -- initial coordinate values
+            attrs {dict} -- attributes of the coordinate variable
+        """
+        self.name=name
+        self.values=[]
+        self.index={}
+        self.attrs=dict(attrs) if attrs else {}
+        self.aux={}#coordinates tied to this dimension in the form {name:[values]}
+        self.extend(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def extend(self, values):
+        for v in values:
+            if v not in self.index:
+                self.index[v]=len(self.values)
+            self.values.append(v)
+
+    def position(self, value):
+        """Get the integer position of a coordinate value, appending it if unknown."""
+        try:
+            return self.index[value]
+        except KeyError:
+            self.extend([value])
+            for aux in self.aux.values():
+                aux.append(np.nan)
+            return len(self.values)-1
+
+    def positions(self, values):
+        """Get the positions of several coordinate values. Consecutive positions are returned as slice.
+        
+        Returns:
+            slice or np.array -- positions of the values in the axis
+        """
+        pos=[self.position(v) for v in values]
+        if len(pos)>0 and pos==list(range(pos[0], pos[0]+len(pos))):
+            return slice(pos[0], pos[0]+len(pos))
+        return np.array(pos, dtype=int)
+
+    def coordinate(self):
+        return np.array(self.values)
+
+    def order(self):
+        """Permutation which sorts the coordinate values, or None if they are already sorted or can not be compared."""
+        try:
+            order=np.argsort(self.coordinate(), kind='stable')
+        except TypeError:
+            return None
+        if np.all(order==np.arange(len(order))):
+            return None
+        return order
+
+    def reorder(self, order):
+        """Rearrange the coordinate values and auxiliary coordinates by a permutation."""
+        self.values=[self.values[i] for i in order]
+        self.index={}
+        for i, v in enumerate(self.values):
+            self.index.setdefault(v, i)
+        for name, aux in self.aux.items():
+            self.aux[name]=[aux[i] for i in order]
+
+class DenseVariable(object):
+    def __init__(self, name, axes, dtype, attrs=None):
+        """A preallocated numpy array holding one output variable over the state dimensions and the dimensions of the extracted quantity.
+
+        Arguments:
+            name {str} -- name of the variable
+            axes {list} -- Axis objects for all dimensions, state dimensions first
+            dtype {np.dtype} -- storage type. Must be able to represent nan.
+            attrs {dict} -- attributes of the variable
+        """
+        self.name=name
+        self.axes=axes
+        self.attrs=dict(attrs) if attrs else {}
+        self.values=np.full([len(ax) for ax in axes], np.nan, dtype=dtype)
+
+    @property
+    def dims(self):
+        return tuple(ax.name for ax in self.axes)
+
+    @staticmethod
+    def storage_dtype(dtype):
+        """Numeric types are stored as float or complex, everything else as object, so that missing values can be nan."""
+        if dtype.kind in 'biuf':
+            return np.dtype(float)
+        if dtype.kind=='c':
+            return np.dtype(complex)
+        return np.dtype(object)
+
+    def promote(self, dtype):
+        dtype=np.promote_types(self.values.dtype, self.storage_dtype(dtype))
+        if dtype!=self.values.dtype:
+            self.values=self.values.astype(dtype)
+
+    def reserve(self):
+        """Grow the array along every axis which outgrew its capacity. The capacity is at least doubled to keep the amortized cost of appending coordinates constant."""
+        shape=self.values.shape
+        needed=[len(ax) for ax in self.axes]
+        if np.all([n<=s for n, s in zip(needed, shape)]):
+            return
+        newshape=[s if n<=s else max(n, 2*s) for n, s in zip(needed, shape)]
+        values=np.full(newshape, np.nan, dtype=self.values.dtype)
+        values[tuple(slice(0, s) for s in shape)]=self.values
+        self.values=values
+
+    def view(self):
+        self.reserve()
+        return self.values[tuple(slice(0, len(ax)) for ax in self.axes)]
+
 class Output(object):
     def __init__(self, variables, tied=[]):
         """Create an object around an xarray dataset, which is able to contain the simulation output.
+        Internally, every output variable is stored as a preallocated numpy array over the state dimensions. States are mapped to array positions by lookup tables built from 'variables' and 'tied'.
         
         Arguments:
             object {Output} -- self
             variables {dict} -- The state space to explore in the form {variable:values, ...}
             tied {arr} -- Groups of coordinates which are tied together in the form [[var1, var2], [var3, ...]...]. Groups must be disjunct.
         """
-        output=xr.Dataset()
+        self.variables=variables
+        self.tied=tied
         tied_flat=[i for group in tied for i in group]
         untied=[key for key in variables.keys() if key not in tied_flat]
+        self.state_dims=untied+[group[0] for group in tied if group]
+        self.attrs={}
+        self.axes={}
+        self.store={}
         for var in untied:
-            output.coords[var]=(var, variables[var])
+            self.axes[var]=Axis(var, variables[var])
         for group in tied:
-            for var in group:
-                output.coords[var]=(group[0], variables[var])
-        self.data=output
+            if group:
+                self.axes[group[0]]=Axis(group[0], variables[group[0]])
+                for var in group[1:]:
+                    self.axes[group[0]].aux[var]=list(variables[var])
+        self.filled=set()#positions of all states which contain data
+        self.dirty=set()#positions of states which changed since the last snapshot
+        self.writer=NetcdfWriter()
+        self._data=None
         self.check_unique()
 
     def check_unique(self):
-        for c in self.data.dims:
-            uniq, counts=np.unique(self.data.coords[c], return_counts=True)
+        for c, axis in self.axes.items():
+            uniq, counts=np.unique(axis.coordinate(), return_counts=True)
             if np.any(counts>1):
                 raise CoordinateError(f'Not all values are unique in coordinate {c}. Duplicates are {uniq[counts>1]}.')
 
+    @property
+    def data(self):
+        """The output as xr.Dataset. It is assembled from the internal arrays whenever the content changed."""
+        if self._data is None:
+            self.sort_axes()
+            coords={}
+            for name, axis in self.axes.items():
+                coords[name]=xr.Variable(name, axis.coordinate(), attrs=axis.attrs)
+                for auxname, auxvalues in axis.aux.items():
+                    coords[auxname]=(name, np.array(auxvalues))
+            data_vars={name:xr.Variable(var.dims, var.view(), attrs=var.attrs) for name, var in self.store.items()}
+            self._data=xr.Dataset(data_vars, coords=coords, attrs=self.attrs)
+        return self._data
+
+    @data.setter
+    def data(self, dataset):
+        """Replace the content of the output by an existing dataset."""
+        self.attrs=dict(dataset.attrs)
+        self.axes={}
+        self.store={}
+        self.filled=set()
+        self.dirty=set()
+        if FILLED in dataset:
+            filled=dataset[FILLED].transpose(*self.state_dims).values>0
+            dataset=dataset.drop_vars(FILLED)
+            dataset=dataset.where(xr.DataArray(filled, dims=self.state_dims))
+        else:
+            filled=np.zeros([dataset.sizes[d] for d in self.state_dims], dtype=bool)
+            for da in dataset.data_vars.values():
+                da=da.expand_dims([d for d in self.state_dims if d not in da.dims])
+                filled|=da.notnull().any([d for d in da.dims if d not in self.state_dims]).transpose(*self.state_dims).values
+        self.filled.update(tuple(int(i) for i in index) for index in zip(*np.nonzero(filled)))
+        dims=self.state_dims+[d for d in dataset.dims if d not in self.state_dims]
+        for d in dims:
+            if d in dataset.coords:
+                self.axes[d]=Axis(d, dataset[d].values, dataset[d].attrs)
+            else:
+                self.axes[d]=Axis(d, np.arange(dataset.sizes[d]))
+        for name, coord in dataset.coords.items():
+            if name not in dataset.dims and len(coord.dims)==1:
+                self.axes[coord.dims[0]].aux[name]=list(coord.values)
+        for name, da in dataset.data_vars.items():
+            da=da.expand_dims([d for d in self.state_dims if d not in da.dims])
+            da=da.transpose(*self.state_dims, ...)
+            var=DenseVariable(name, [self.axes[d] for d in da.dims], DenseVariable.storage_dtype(da.dtype), da.attrs)
+            var.values[...]=da.values
+            self.store[name]=var
+        for d in self.state_dims:#states which are not yet part of the dataset are appended
+            axis=self.axes[d]
+            group=[g for g in self.tied if g and g[0]==d]
+            for i, value in enumerate(self.variables[d]):
+                if value not in axis.index:
+                    axis.position(value)
+                    for auxname in (group[0][1:] if group else []):
+                        if auxname in axis.aux:
+                            axis.aux[auxname][-1]=self.variables[auxname][i]
+        self._data=None
+
+    def sort_axes(self):
+        """Sort the coordinates of all dimensions which are not state dimensions, like the union of coordinates formed by xr.merge. Coordinates of the extracted quantities are appended in the order in which they arrive, so the arrays are permuted accordingly.
+
+        Returns:
+            list -- names of the reordered dimensions
+        """
+        reordered=[]
+        for d, axis in self.axes.items():
+            if d in self.state_dims:
+                continue
+            order=axis.order()
+            if order is None:
+                continue
+            for var in self.store.values():
+                for i, ax in enumerate(var.axes):
+                    if ax is axis:
+                        values=var.view()
+                        values[...]=np.take(values, order, axis=i)
+            axis.reorder(order)
+            reordered.append(d)
+        if reordered:
+            self._data=None
+        return reordered
+
+    def state_index(self, state):
+        """Get the position of a state in the state dimensions.
+        
+        Arguments:
+            state {dict} -- state in the form {dim:value, ...}, containing at least all state dimensions
+        
+        Returns:
+            tuple -- integer position along every state dimension
+        """
+        try:
+            return tuple(self.axes[d].position(state[d]) for d in self.state_dims)
+        except KeyError as e:
+            raise CoordinateError(f'State {state} does not specify the state dimension {e}!')
+
     def add_data(self, new, state):
         """Add a new DataArray to the output. Existing values with matching coordinates are overwritten, non-existing coordinates are appended and nan's are introduced when necessary.
         
@@ -64,20 +293,34 @@ class Output(object):
             new {xr.DataArray} -- New data to be added.
             state {dict} -- The position in the output data where 'new' will be added.
         """
-        lstate={key:[val] for i, (key, val) in enumerate(state.items())}
-        new=new.expand_dims(lstate)
-        if not new.name in self.data:
-            self.data[new.name]=new
+        index=self.state_index(state)
+        for d in new.dims:
+            if d not in self.axes:
+                self.axes[d]=Axis(d, attrs=new[d].attrs)
+        var=self.store.get(new.name)
+        if var is None:
+            var=DenseVariable(new.name, [self.axes[d] for d in self.state_dims+list(new.dims)], DenseVariable.storage_dtype(new.dtype), new.attrs)
+            self.store[new.name]=var
         else:
-            try:
-                self.data[new.name].loc[new.coords]=new
-            except KeyError:
-                temp=new.combine_first(self.data[new.name])# use combine_first because it allows for coordinate alignment and extends if necessary
-                self.data=xr.merge([temp, self.data], compat='override')#now, merge the new data array in the full dataset
-
+            if new.dims!=var.dims[len(self.state_dims):]:
+                new=new.transpose(*var.dims[len(self.state_dims):])
+            var.promote(new.dtype)
+        positions=[self.axes[d].positions(new.get_index(d)) for d in new.dims]
+        var.reserve()
+        if new.ndim==0:#store the scalar itself, not a 0-d array in an object array
+            var.values[index]=new.values[()]
+        elif np.all([isinstance(p, slice) for p in positions]):
+            var.values[index+tuple(positions)]=new.values
+        else:
+            positions=[np.arange(p.start, p.stop) if isinstance(p, slice) else p for p in positions]
+            var.values[index+np.ix_(*positions)]=new.values
+        self.filled.add(index)
+        self.dirty.add(index)
+        self._data=None
 
     def save_snapshot(self, savefile):
-        self.data.to_netcdf(savefile)
+        self.sort_axes()
+        self.writer.write(self, savefile)
 
     def load_existing(self, filename):
         new=xr.load_dataset(filename)
@@ -93,7 +336,289 @@ class Output(object):
         logfile=os.path.splitext(savefile)[0]+".log"
         inpLogger.write_log(logfile, old_logs=templates)
 
+    def summary(self):
+        return str(self.data)
 
+    def state_values(self, name, state):
+        """Get the values of one variable for one state.
+        
+        Returns:
+            np.array -- values along the other dimensions or None, if the state or the variable is missing
+        """
+        index=self.state_index(state)
+        if index not in self.filled or name not in self.store:
+            return None
+        return self.store[name].view()[index]
+
+    def complete_mask(self, names):
+        """Find the states which contain at least one non-nan value in all given variables.
+        
+        Arguments:
+            names {list} -- variable names
+        
+        Returns:
+            np.array -- boolean mask over the state dimensions
+        """
+        mask=np.ones([len(self.axes[d]) for d in self.state_dims], dtype=bool)
+        nstate=len(self.state_dims)
+        for name in names:
+            if name not in self.store:
+                return np.zeros_like(mask)
+            values=self.store[name].view()
+            mask&=pd.notnull(values).any(axis=tuple(range(nstate, values.ndim))) if values.ndim>nstate else pd.notnull(values)
+        return mask
+
+class LazyOutput(Output):
+    def __init__(self, variables, tied=[]):
+        """An output for sweeps which do not fit into memory. Only the coordinates and the rows added since the last snapshot are kept in memory, the netcdf file written by the snapshots holds the data.
+        Reading the data opens the file lazily with dask.
+        
+        Arguments:
+            variables {dict} -- The state space to explore in the form {variable:values, ...}
+            tied {arr} -- Groups of coordinates which are tied together
+        """
+        super().__init__(variables, tied)
+        self.layout={}#name:(dims, storage dtype, attrs) of every variable
+        self.pending={}#name:list of (state position, positions along the other dimensions, values)
+        self.source=None#file the output was loaded from
+        self.savefile=None
+        self.writer=NetcdfRowWriter()
+
+    @property
+    def data(self):
+        """The output as dask-backed xr.Dataset. Pending rows are written to the file first."""
+        if self.savefile is None:
+            return super().data
+        if self.pending:
+            self.save_snapshot(self.savefile)
+        return xr.open_dataset(self.savefile, chunks={})
+
+    def add_data(self, new, state):
+        index=self.state_index(state)
+        for d in new.dims:
+            if d not in self.axes:
+                self.axes[d]=Axis(d, attrs=new[d].attrs)
+        if new.name in self.layout:
+            dims, dtype, attrs=self.layout[new.name]
+            if new.dims!=dims[len(self.state_dims):]:
+                new=new.transpose(*dims[len(self.state_dims):])
+        else:
+            self.layout[new.name]=(tuple(self.state_dims)+new.dims, DenseVariable.storage_dtype(new.dtype), dict(new.attrs))
+        values=new.values
+        positions=[]
+        for axis, d in enumerate(new.dims):
+            pos=self.axes[d].positions(new.get_index(d))
+            if not isinstance(pos, slice):#netcdf expects increasing positions
+                order=np.argsort(pos)
+                values=np.take(values, order, axis=axis)
+                pos=pos[order]
+            positions.append(pos)
+        self.pending.setdefault(new.name, []).append((index, tuple(positions), values))
+        self.filled.add(index)
+        self.dirty.add(index)
+
+    def save_snapshot(self, savefile):
+        self.writer.write(self, savefile)
+        self.savefile=savefile
+        self.sort_file()
+
+    def sort_file(self):
+        """Sort the coordinates of the extracted quantities in the file, if new values were appended out of order. The file is rewritten with dask, so it does not need to fit into memory."""
+        orders={d:axis.order() for d, axis in self.axes.items() if d not in self.state_dims}
+        orders={d:order for d, order in orders.items() if order is not None}
+        if not orders:
+            return
+        tempfile=self.savefile+'.sort.tmp'
+        with xr.open_dataset(self.savefile, chunks={}) as data:
+            data.isel({d:order for d, order in orders.items()}).to_netcdf(tempfile, unlimited_dims=[d for d in data.dims if d not in self.state_dims])
+        os.replace(tempfile, self.savefile)
+        for d, order in orders.items():
+            self.axes[d].reorder(order)
+
+    def load_existing(self, filename):
+        """Continue an existing file. Only its coordinates and the mask of filled states are read. Files which can not be extended row by row, like the ones from snapshot=full, are converted first."""
+        if not rows_writable(filename, self.state_dims):
+            convert_for_rows(filename, self.state_dims)
+        with xr.open_dataset(filename) as new:
+            for d in self.state_dims:
+                if d not in new.coords or not set(self.axes[d].index).issubset(new.indexes[d]):
+                    raise Exception(f'The states in {filename} do not cover all states. Use lazy=False to extend the file!')
+            self.attrs=dict(new.attrs)
+            for d in self.state_dims+[d for d in new.dims if d not in self.state_dims]:
+                self.axes[d]=Axis(d, new[d].values if d in new.coords else np.arange(new.sizes[d]), new[d].attrs)
+            for name, coord in new.coords.items():
+                if name not in new.dims and len(coord.dims)==1:
+                    self.axes[coord.dims[0]].aux[name]=list(coord.values)
+            self.layout={name:(da.dims, DenseVariable.storage_dtype(da.dtype), dict(da.attrs)) for name, da in new.data_vars.items() if name!=FILLED}
+            filled=filled_mask(new, self.state_dims)
+        self.filled=set(tuple(int(i) for i in index) for index in zip(*np.nonzero(filled)))
+        self.pending={}
+        self.dirty=set()
+        self.source=filename
+        self.savefile=filename
+
+    def state_values(self, name, state):
+        index=self.state_index(state)
+        if index not in self.filled or name not in self.layout or self.savefile is None:
+            return None
+        with self.data as data:
+            return data[name].isel(dict(zip(self.state_dims, index))).values
+
+    def complete_mask(self, names):
+        mask=np.zeros([len(self.axes[d]) for d in self.state_dims], dtype=bool)
+        if self.savefile is None:
+            return mask
+        mask[...]=True
+        with self.data as data:
+            for name in names:
+                if name not in data:
+                    return np.zeros_like(mask)
+                da=data[name]
+                mask&=da.notnull().any([d for d in da.dims if d not in self.state_dims]).transpose(*self.state_dims).values
+        return mask
+
+    def summary(self):
+        """Describe the output without reading the data."""
+        nstates=int(np.prod([len(self.axes[d]) for d in self.state_dims]))
+        lines=[f'Lazy output in {self.savefile}: {len(self.filled)} of {nstates} states filled']
+        lines.append('Dimensions: '+', '.join(f'{d}: {len(axis)}' for d, axis in self.axes.items()))
+        for name, (dims, dtype, _) in self.layout.items():
+            lines.append(f'    {name} ({", ".join(dims)}) {dtype}')
+        return '\n'.join(lines)
+
+
+
+RAGGED_STATE='comrun_state'
+
+def ragged_offsets(dataset, name):
+    """Start of the row of every state in the sample dimension of a ragged variable, followed by the total length."""
+    return np.concatenate([[0], np.cumsum(dataset[name+'_row_size'].values)])
+
+def ragged_row(dataset, name, instance, offsets=None):
+    """Reconstruct the array of one variable for one state from a contiguous ragged dataset written by RaggedOutput.
+
+    Arguments:
+        dataset {xr.Dataset} -- ragged dataset
+        name {str} -- variable name
+        instance {int} -- position along the state instance dimension
+
+    Keyword Arguments:
+        offsets {np.array} -- result of ragged_offsets, to be reused when many rows are read (default: {None})
+
+    Returns:
+        xr.DataArray -- the array with its own coordinates
+    """
+    if offsets is None:
+        offsets=ragged_offsets(dataset, name)
+    obs=slice(int(offsets[instance]), int(offsets[instance+1]))
+    dims=dataset[name].attrs['comrun_dims'].split()
+    coords=[dataset[f'{name}_{d}'].values[obs] for d in dims]
+    values=dataset[name].values[obs]
+    attrs={k:v for k, v in dataset[name].attrs.items() if k not in ('comrun_dims', 'coordinates')}
+    if not dims:
+        return xr.DataArray(values[0] if len(values) else np.nan, name=name, attrs=attrs)
+    index=pd.MultiIndex.from_arrays(coords, names=dims)
+    da=pd.Series(values, index=index).to_xarray() if len(dims)>1 else xr.DataArray(values, coords=[(dims[0], coords[0])])
+    da.name=name
+    da.attrs=attrs
+    for d in dims:
+        da[d].attrs=dict(dataset[f'{name}_{d}'].attrs)
+    return da
+
+@xr.register_dataset_accessor('comrun')
+class RaggedAccessor(object):
+    def __init__(self, dataset):
+        """Access a dataset in the ragged layout of ComRun by state, e.g. ds.comrun.sel(lwc='0.1', reff='10')"""
+        self.dataset=dataset
+
+    def states(self):
+        """The states of all instances as pd.DataFrame"""
+        return self.dataset[[c for c in self.dataset.coords if self.dataset[c].dims==(RAGGED_STATE,)]].to_dataframe()
+
+    def sel(self, **state):
+        """Get all variables of one state as dense xr.Dataset, with the coordinates of this state only."""
+        match=np.ones(self.dataset.sizes[RAGGED_STATE], dtype=bool)
+        for key, value in state.items():
+            match&=self.dataset[key].values==value
+        instances=np.nonzero(match)[0]
+        if len(instances)!=1:
+            raise KeyError(f'{len(instances)} states found for {state}!')
+        names=[name for name in self.dataset.data_vars if 'comrun_dims' in self.dataset[name].attrs]
+        result=xr.merge([ragged_row(self.dataset, name, instances[0]) for name in names if self.dataset[name+'_row_size'].values[instances[0]]>0], combine_attrs='drop')
+        return result.assign_attrs(state)
+
+class RaggedOutput(Output):
+    def __init__(self, variables, tied=[]):
+        """An output which stores every state with its own coordinates instead of a hypercube over the union of all coordinates.
+        The dataset uses the contiguous ragged array representation of the CF conventions: Every variable is flattened along an own sample dimension '<name>_obs', with one coordinate variable '<name>_<dim>' per dimension. '<name>_row_size' holds the number of elements of every state along the instance dimension 'comrun_state'. The accessor ds.comrun.sel selects the dense arrays of one state.
+        
+        Arguments:
+            variables {dict} -- The state space to explore in the form {variable:values, ...}
+            tied {arr} -- Groups of coordinates which are tied together
+        """
+        super().__init__(variables, tied)
+        self.rows={}#name:{state position:xr.DataArray}
+
+    @property
+    def data(self):
+        if self._data is None:
+            instances=sorted(self.filled)
+            coords={}
+            for i, d in enumerate(self.state_dims):
+                axis=self.axes[d]
+                coords[d]=xr.Variable(RAGGED_STATE, np.array([axis.values[index[i]] for index in instances]) if instances else axis.coordinate()[:0], attrs=axis.attrs)
+                for auxname, auxvalues in axis.aux.items():
+                    coords[auxname]=(RAGGED_STATE, np.array([auxvalues[index[i]] for index in instances]) if instances else np.array(auxvalues)[:0])
+            data_vars={}
+            for name, rows in self.rows.items():
+                arrays=[rows.get(index) for index in instances]
+                first=next(da for da in arrays if da is not None)
+                dims=first.dims
+                obs=name+'_obs'
+                data_vars[name+'_row_size']=xr.Variable(RAGGED_STATE, np.array([da.size if da is not None else 0 for da in arrays], dtype='i8'), attrs={'sample_dimension':obs})
+                arrays=[da.transpose(*dims) for da in arrays if da is not None]
+                grids=[np.meshgrid(*[da[d].values for d in dims], indexing='ij') for da in arrays]
+                for k, d in enumerate(dims):
+                    data_vars[f'{name}_{d}']=xr.Variable(obs, np.concatenate([grid[k].ravel() for grid in grids]), attrs=first[d].attrs)
+                attrs=dict(first.attrs, comrun_dims=' '.join(dims), coordinates=' '.join(f'{name}_{d}' for d in dims))
+                data_vars[name]=xr.Variable(obs, np.concatenate([np.ravel(da.values) for da in arrays]), attrs=attrs)
+            self._data=xr.Dataset(data_vars, coords=coords, attrs=dict(self.attrs, comrun_layout='ragged'))
+        return self._data
+
+    @data.setter
+    def data(self, dataset):
+        """Replace the content by an existing ragged dataset."""
+        self.attrs={k:v for k, v in dataset.attrs.items() if k!='comrun_layout'}
+        self.rows={}
+        self.filled=set()
+        names=[name for name in dataset.data_vars if 'comrun_dims' in dataset[name].attrs]
+        offsets={name:ragged_offsets(dataset, name) for name in names}
+        states=[dataset[d].values for d in self.state_dims]
+        for instance in range(dataset.sizes[RAGGED_STATE]):
+            state={d:values[instance] for d, values in zip(self.state_dims, states)}
+            for name in names:
+                if offsets[name][instance+1]>offsets[name][instance]:
+                    self.add_data(ragged_row(dataset, name, instance, offsets[name]), state)
+        self.dirty=set()
+        self._data=None
+
+    def state_values(self, name, state):
+        row=self.rows.get(name, {}).get(self.state_index(state))
+        return None if row is None else row.values
+
+    def complete_mask(self, names):
+        mask=np.zeros([len(self.axes[d]) for d in self.state_dims], dtype=bool)
+        for index in self.filled:
+            mask[index]=np.all([index in self.rows.get(name, {}) and bool(self.rows[name][index].notnull().any()) for name in names])
+        return mask
+
+    def add_data(self, new, state):
+        """Store a DataArray for one state. An existing array of the same variable and state is replaced."""
+        index=self.state_index(state)
+        self.rows.setdefault(new.name, {})[index]=new
+        self.filled.add(index)
+        self.dirty.add(index)
+        self._data=None
 
 class Collector(object):
     def __init__(self, stdout, stderr, infile, miscfiles, collection_keys, variables, tied=[]):
@@ -103,11 +628,38 @@ class Collector(object):
         self.miscfilesbase=miscfiles
         self.collection_keys=collection_keys
         self.output=Output(variables, tied)
+        self.workers=1
+        self.pool=None
+        self.variable_name={}#collection key:name of the returned DataArray, if different
+        self.memory={}#filename:content of the files of the current task, which were already read or captured in memory
+        self.parsed={}#key:results of parsers, shared between the extraction functions of the current task
+        self.stats=collections.Counter()#seconds per extraction function, 'add_data' seconds and 'bytes_parsed' since the last take_stats
 
     def open_file(self,filename):
-        with open(filename, 'r') as file:
-            data=file.read()
-        return data
+        """Get the content of a file. Every file is read only once per task."""
+        if filename not in self.memory:
+            with open(filename, 'r') as file:
+                self.memory[filename]=file.read()
+            self.stats['bytes_parsed']+=len(self.memory[filename])
+        return self.memory[filename]
+
+    def open_stream(self, filename):
+        """Open a file for reading line by line, or a file like object if the content is already in memory."""
+        if filename in self.memory:
+            return io.StringIO(self.memory[filename])
+        self.stats['bytes_parsed']+=os.path.getsize(filename)
+        return open(filename, 'r')
+
+    def parse_once(self, key, parser):
+        """Call parser only for the first extraction function of a task which needs its result.
+
+        Arguments:
+            key {str} -- name of the result
+            parser {func} -- function without arguments, which parses the files of the current task
+        """
+        if key not in self.parsed:
+            self.parsed[key]=parser()
+        return self.parsed[key]
 
     def save(self, savefile, inpLogger, templates=None):
         self.output.save(savefile, inpLogger, templates)
@@ -115,20 +667,121 @@ class Collector(object):
     def save_snapshot(self, savefile):
         self.output.save_snapshot(savefile)
 
-    def collect(self, cartesian_state, chunkid, taskid):
+    def variable_names(self):
+        """Names of the DataArrays returned for the collection keys."""
+        return [self.variable_name.get(key, key) for key in self.collection_keys]
+
+    def __getstate__(self):
+        #worker processes only extract, they do not need the output
+        state=self.__dict__.copy()
+        state['output']=None
+        state['pool']=None
+        state['stats']=collections.Counter()
+        return state
+
+    def __copy__(self):
+        #the extraction functions are bound methods, which must read the files of the copy
+        new=self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new.extraction_functions={key:getattr(new, func.__name__) for key, func in getattr(self, 'extraction_functions', {}).items()}
+        new.memory={}
+        new.parsed={}
+        new.stats=collections.Counter()
+        return new
+
+    def take_stats(self):
+        """Get the statistics of the extraction since the last call and reset them."""
+        stats, self.stats=self.stats, collections.Counter()
+        return stats
+
+    def extract(self, chunkid, taskid, streams=None):
+        """Call all extraction functions for one task.
+        
+        Arguments:
+            chunkid {int} -- chunk of the task
+            taskid {int} -- task id
+            streams {dict} -- If given, 'input', 'stdout' and 'stderr' of the task as strings. They are used instead of the files. (default: {None})
+        
+        Returns:
+            list -- one xr.DataArray for every key in collection_keys
+        """
         self.stdoutfile=append_ids(self.stdoutbase, chunkid, taskid)
         self.stderrfile=append_ids(self.stderrbase, chunkid, taskid)
         self.miscfiles=[append_ids(f, chunkid, taskid) for f in self.miscfilesbase]
         self.infile=append_ids(self.infilebase,chunkid, taskid)
-        for key in self.collection_keys:
-            self.output.add_data(self.extraction_functions[key](), cartesian_state)
+        self.memory={}
+        self.parsed={}
+        if streams is not None:
+            self.memory={self.infile:streams['input'], self.stdoutfile:streams['stdout'], self.stderrfile:streams['stderr']}
+            self.stats['bytes_parsed']+=len(streams['stdout'])+len(streams['stderr'])
+        try:
+            arrays=[]
+            for key in self.collection_keys:
+                start=time.time()
+                arrays.append(self.extraction_functions[key]())
+                self.stats[f'extract_{key}']+=time.time()-start
+            return arrays
+        finally:
+            self.memory={}
+            self.parsed={}
+
+    def collect(self, cartesian_state, chunkid, taskid, streams=None):
+        arrays=self.extract(chunkid, taskid, streams)
+        start=time.time()
+        for da in arrays:
+            self.output.add_data(da, cartesian_state)
+        self.stats['add_data']+=time.time()-start
+        return arrays
+
+    def collect_many(self, tasks, streams=None):
+        """Collect the output of several tasks. If 'workers' is larger than one, the extraction functions run in a pool of worker processes and only the insertion into the output happens in this process.
+        
+        Arguments:
+            tasks {list} -- (cartesian_state, chunkid, taskid) tuples
+            streams {list} -- If given, the captured streams of every task (see extract) (default: {None})
+        
+        Returns:
+            list -- the extracted arrays of every task
+        """
+        tasks=list(tasks)
+        if streams is None:
+            streams=[None]*len(tasks)
+        if self.workers<=1 or len(tasks)<=1:
+            return [self.collect(state, chunkid, taskid, s) for (state, chunkid, taskid), s in zip(tasks, streams)]
+        if self.pool is None:
+            self.pool=ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self,))
+        batch=max(1, len(tasks)//(4*self.workers))
+        results=[]
+        for arrays, stats in self.pool.map(_extract_worker, [(chunkid, taskid, s) for (_, chunkid, taskid), s in zip(tasks, streams)], chunksize=batch):
+            results.append(arrays)
+            self.stats.update(stats)
+        start=time.time()
+        for (state, _, _), arrays in zip(tasks, results):
+            for da in arrays:
+                self.output.add_data(da, state)
+        self.stats['add_data']+=time.time()-start
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool=None
+
+_worker_collector=None
+
+def _init_worker(collector):
+    global _worker_collector
+    _worker_collector=collector
+
+def _extract_worker(ids):
+    return _worker_collector.extract(*ids), _worker_collector.take_stats()
 
 class EmptyCollector(Collector):
     def __init__(self):
         super().__init__(None, None, None,None, None, {}, [])
     
-    def collect(self, state, chunkid, taskid):
-        pass
+    def collect(self, state, chunkid, taskid, streams=None):
+        return []
 
     def save(self, savefile, inpLogger, templates=None):
         pass
@@ -139,9 +792,10 @@ class EmptyCollector(Collector):
 class UvspecCollector(Collector):
     def __init__(self, stdout, stderr, infile,miscfiles, collection_keys, variables, tied=[]):
         super().__init__(stdout, stderr, infile, miscfiles, collection_keys, variables, tied)
+        self.stderr_quantities={"time_all":"runtime", "wctau_dis":"wctau", "optprop_dis":"optprop"}
+        self.variable_name={"dis_std":"standard_dis"}
         self.extraction_functions={"time_all":self.get_time_all, "radiance": self.get_radiance, "photons_second": self.get_photons_second, "radiance_std": self.get_radiance_std, "radiance_dis": self.get_radiance_dis, "dis_std":self.get_dis_std, "mie_all":self.get_mie_std, "wctau_dis":self.get_wctau_dis, "optprop_dis":self.get_optprop_dis}
 
-    @extraction_func
     def get_basename(self):
         """Get the parameter value of "mc_basename" in a uvspec input file
     
@@ -151,6 +805,9 @@ class UvspecCollector(Collector):
         Returns:
             str -- the value of mc_basename
         """
+        return self.parse_once('basename', self.read_basename)
+
+    def read_basename(self):
         content=self.open_file(self.infile)
         basename=reg.findall(r"mc_basename [^\n]*", content)
         if len(basename)>0:
@@ -158,45 +815,50 @@ class UvspecCollector(Collector):
             return basename.split(" ")[1]#last word
         raise Exception(f"mc_basename not found in any of the files {self.infile}!")
 
+    def read_stderr(self, quantities):
+        results={q:[] for q in quantities}
+        with self.open_stream(self.stderrfile) as f:
+            for quantity, value in uvex.scan_stderr(f, quantities):
+                results[quantity].append(value)
+        return results
+
+    def scan_stderr(self, quantity):
+        """Get a quantity from stderr. All quantities needed by the collection keys are read in one pass over stderr.
+
+        Arguments:
+            quantity {str} -- 'runtime', 'wctau' or 'optprop'
+
+        Returns:
+            list -- all values found for the quantity
+        """
+        needed={self.stderr_quantities[key] for key in self.collection_keys if key in self.stderr_quantities}
+        results=self.parse_once('stderr', lambda: self.read_stderr(needed|{quantity}))
+        if quantity not in results:
+            results.update(self.read_stderr([quantity]))
+        return results[quantity]
+
+    def read_disort(self):
+        return self.parse_once('disort', lambda: uvex.read_disort_stdout(self.open_file(self.stdoutfile)))
+
 
     @extraction_func
     def get_time_all(self):
-        stderr=self.open_file(self.stderrfile)
-        #find values in output
         result=xr.DataArray(np.zeros(3), coords=[('rt_type', ['wall', 'user', 'kernel'])])
         result.name='time_all'
-        m=reg.findall(r"###Runtime [^#]* ###", stderr)
-        if len(m)!=0:
-            m=m[0]
-            m=np.array(m.split(" "))[1:4]
-            m=m.astype(float)
-        else:
-            m=[np.nan, np.nan, np.nan]
-        result.values=m
+        m=self.scan_stderr('runtime')
+        result.values=m[0] if m else [np.nan, np.nan, np.nan]
+        return result
+
+    def mystic_radiance(self, extension, name):
+        self.stats['bytes_parsed']+=os.path.getsize(self.get_basename()+extension)
+        coords, radiance=uvex.read_mystic_spc(self.get_basename()+extension)
+        result=xr.DataArray(radiance, coords=list(zip(['rad_wvl', 'rad_ix', 'rad_iy', 'rad_iz', 'rad_pol'], coords)))
+        result.name=name
         return result
 
     @extraction_func
     def get_radiance(self):
-        basename=self.get_basename()
-        data=np.genfromtxt(basename+".rad.spc")
-        data=np.atleast_2d(data)
-        polarized=False
-        if len(data)>1:
-            if np.sum(data[0,:4]==data[1,:4])==4:#if the first two rows have equal coordinates, they represent different I,Q,U,V
-                polarized=True
-        rad_wvl=np.unique(data[:,0])
-        rad_ix=np.unique(data[:,1])
-        rad_iy=np.unique(data[:,2])
-        rad_iz=np.unique(data[:,3])
-        if polarized:
-            rad_pol=['I', 'Q', 'U', 'V']
-        else:
-            rad_pol=['I']
-        rad_space_shape=(len(rad_wvl), len(rad_ix), len(rad_iy), len(rad_iz), len(rad_pol))
-        radiance=np.reshape(data[:,4], rad_space_shape)
-        result=xr.DataArray(radiance, coords=[('rad_wvl', rad_wvl),('rad_ix', rad_ix),('rad_iy', rad_iy),('rad_iz', rad_iz),('rad_pol', rad_pol)])
-        result.name='radiance'
-        return result
+        return self.mystic_radiance(".rad.spc", 'radiance')
         
     @extraction_func
     def get_photons_second(self):
@@ -204,111 +866,39 @@ class UvspecCollector(Collector):
 
     @extraction_func
     def get_radiance_std(self):
-        basename=self.get_basename()
-        data=np.genfromtxt(basename+".rad.std.spc")
-        data=np.atleast_2d(data)
-        polarized=False
-        if len(data)>1:
-            if np.sum(data[0,:4]==data[1,:4])==4:#if the first two rows have equal coordinates, they represent different I,Q,U,V
-                polarized=True
-        rad_wvl=np.unique(data[:,0])
-        rad_ix=np.unique(data[:,1])
-        rad_iy=np.unique(data[:,2])
-        rad_iz=np.unique(data[:,3])
-        if polarized:
-            rad_pol=['I', 'Q', 'U', 'V']
-        else:
-            rad_pol=['I']
-        rad_space_shape=(len(rad_wvl), len(rad_ix), len(rad_iy), len(rad_iz), len(rad_pol))
-        radiance=np.reshape(data[:,4], rad_space_shape)
-        result=xr.DataArray(radiance, coords=[('rad_wvl', rad_wvl),('rad_ix', rad_ix),('rad_iy', rad_iy),('rad_iz', rad_iz),('rad_pol', rad_pol)])
-        result.name='radiance_std'
-        return result
+        return self.mystic_radiance(".rad.std.spc", 'radiance_std')
 
     @extraction_func
     def get_radiance_dis(self):
         """Read radiance for the case of 'disort', which prints it to stdout rather than a .rad.spc file.
         """
-        #The output from disort is quite hard to read. The format is:
-        #headline (length 7)
-        #philine (length nphi)
-        #multiple umu lines (length nphi+2)
-        #headline
-        #...
-        #The strategy is to locate the philines and derive the structure of the rest from these points
         stdout=self.open_file(self.stdoutfile)
-        lines=stdout.split('\n')[:-1]
-        if len(lines)==0:
+        if not stdout.strip():
             raise Exception(f'No lines found in {self.stdoutfile}!')
-        data=[np.atleast_1d(np.fromstring(lines[i], sep=' ', dtype=float)) for i in range(len(lines))]
-        if len(data[0])!=7:#First line
-            raise Exception(f"Error: Number of field in first line in {self.stdoutfile} not 7!")
-        rad_phi=data[1]
-        n_phi=len(rad_phi)
-        if n_phi==7:
-            print("Error: output not unique if 7 phi angles are specified!")
-        assert(n_phi!=7)
-        data_lengths=np.array([len(data[i]) for i in range(len(data))])
-        philines=np.where(data_lengths==n_phi)[0]
-        rad_wvl=[data[i-1][0] for i in philines]
-        n_wvl=len(rad_wvl)
-        n_umu=len(data)-2 if len(philines)==1 else philines[1]-philines[0]-2
-        rad_umu=[data[philines[0]+i+1][0] for i in range(n_umu)]
-        radiance_dis=np.zeros((n_wvl, n_umu, n_phi))
-        for i in range(n_wvl):
-            for j in range(n_umu):
-                radiance_dis[i][j]=data[philines[i]+1+j][2:]
-
-        result=xr.DataArray(radiance_dis, coords=[('rad_wvl', rad_wvl),('rad_umu', rad_umu),('rad_phi', rad_phi)])
+        standard, radiance=self.read_disort()
+        if radiance is None:
+            raise Exception(f'No radiance found in {self.stdoutfile}!')
+        rad_umu, rad_phi, radiance_dis=radiance
+        result=xr.DataArray(radiance_dis, coords=[('rad_wvl', standard[:,0]),('rad_umu', rad_umu),('rad_phi', rad_phi)])
         result.name='radiance_dis'
         return result
 
     @extraction_func
     def get_dis_std(self):
         """Read the seven standard output values from uvspec disort output"""
-        stdout=self.open_file(self.stdoutfile)
-        lines=stdout.split('\n')[:-1]
-        data=[np.fromstring(lines[i], sep=' ', dtype=float) for i in range(len(lines))]
-        assert(len(data[0])==7)#First line
-        if len(data)<4 or len(data[0])==len(data[1])==len(data[2]):#no radiance
-            n_wvl=len(data)
-            headlines=range(n_wvl)#Indices of the standard output line of disort
-        else:
-            rad_phi=data[1]
-            n_phi=len(rad_phi)
-            if n_phi==7:
-                print("Error: output not unique if 7 phi angles are specified!")
-            assert(n_phi!=7)
-            data_lengths=np.array([len(data[i]) for i in range(len(data))])
-            philines=np.where(data_lengths==n_phi)[0]
-            headlines=philines-1
-            n_wvl=len(headlines)
-        rad_wvl=[data[i][0] for i in headlines]
-
-        dis_edir=np.zeros((n_wvl))
-        dis_edn=np.zeros((n_wvl))
-        dis_eup=np.zeros((n_wvl))
-        dis_uavgdir=np.zeros((n_wvl))
-        dis_uavgdn=np.zeros((n_wvl))
-        dis_uavgup=np.zeros((n_wvl))
-
-        for i in range(n_wvl):
-            dis_edir[i]=data[headlines[i]][1]
-            dis_edn[i]=data[headlines[i]][2]
-            dis_eup[i]=data[headlines[i]][3]
-            dis_uavgdir[i]=data[headlines[i]][4]
-            dis_uavgdn[i]=data[headlines[i]][5]
-            dis_uavgup[i]=data[headlines[i]][6]
-        
-        disort_output=np.row_stack((dis_edir, dis_edn, dis_eup, dis_uavgdir, dis_uavgdn, dis_uavgup))
+        standard, _=self.read_disort()
+        rad_wvl=standard[:,0]
+        disort_output=standard[:,1:].T
         result=xr.DataArray(disort_output, coords=[('quantity_dis', ['dis_edir', 'dis_edn', 'dis_eup', 'dis_uavgdir', 'dis_uavgdn', 'dis_uavgup']),('rad_wvl', rad_wvl)])
         result.name='standard_dis'
         return result
 
     @extraction_func
     def get_wctau_dis(self):
-        with open(self.stderrfile) as f:
-            result=uvex.get_wctau_dis_fromstream(f)
+        result=self.scan_stderr('wctau')
+        if not result:
+            raise uvex.ResultNotFoundException('No information about cloud optical thickness found!')
+        result=np.array(result)
         array=xr.DataArray(result[:,1:], coords=[('rte_wvl', result[:,0]),('tau_type', ['scat', 'abs'])])
         array.name='wctau_dis'
         array.attrs['long_name']='water cloud opt. thickness'
@@ -318,8 +908,7 @@ class UvspecCollector(Collector):
     
     @extraction_func
     def get_optprop_dis(self):
-        with open(self.stderrfile) as f:
-            result=uvex.get_optprop_table_fromstream(f)
+        result=dict(self.scan_stderr('optprop'))
         frames=[xr.DataArray(result[wvl][:,2:], coords=[('rte_z', result[wvl][:,1]),('opt_type', ['raytau', 'aerscat', 'aerabs', 'aerasy', 'wscat', 'wabs', 'wasy', 'iscat', 'iabs', 'iasy', 'iff', 'ig1', 'ig2', 'f','molabs'])]) for wvl in list(result.keys())]
         array=xr.concat(frames, dim='rte_wvl')
         array.coords['rte_wvl']=('rte_wvl', list(result.keys()))
@@ -1,6 +1,9 @@
 import os
 import collections
 import itertools as it
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 def append_ids(filename, chunkid=None, taskid=None):
@@ -13,6 +16,11 @@ def append_ids(filename, chunkid=None, taskid=None):
             filename_ext=base+"_"+str(taskid)+ext
         return filename_ext
 
+def shard_filename(filename, shard):
+    """Name of the output of one shard, e.g. Output_shard2.nc for Output.nc"""
+    base, ext=os.path.splitext(filename)
+    return f'{base}_shard{shard}{ext}'
+
 def consume(iterator, n=None):
     "Advance the iterator n-steps ahead. If n is None, consume entirely."
     # Use functions that consume iterators at C speed.
@@ -21,4 +29,66 @@ def consume(iterator, n=None):
         collections.deque(iterator, maxlen=0)
     else:
         # advance to the empty slice starting at position n
-        next(it.islice(iterator, n, n), None)
\ No newline at end of file
+        next(it.islice(iterator, n, n), None)
+
+def timed_run(command, infile, stdoutfile, stderrfile):
+    """Run a shell command with the content of 'infile' as stdin and write its stdout and stderr to files.
+    The runtime is appended to stderr in the form '###Runtime wall user kernel ###', like '/usr/bin/time -f "###Runtime %e %U %S ###"' does.
+
+    Arguments:
+        command {str} -- shell command
+        infile {str} -- file piped to stdin
+        stdoutfile {str} -- file for stdout
+        stderrfile {str} -- file for stderr
+
+    Returns:
+        int -- returncode of the command
+    """
+    with open(infile, 'r') as fin, open(stdoutfile, 'w') as fout, open(stderrfile, 'w') as ferr:
+        start=time.time()
+        process=subprocess.Popen(command, shell=True, stdin=fin, stdout=fout, stderr=ferr)
+        returncode, runtime=wait_timed(process, start)
+        ferr.write(runtime)
+    return returncode
+
+def wait_timed(process, start):
+    """Wait for a process and measure its resource usage.
+
+    Arguments:
+        process {subprocess.Popen} -- the process
+        start {float} -- start time of the process
+
+    Returns:
+        (int, str) -- returncode and the line '###Runtime wall user kernel ###'
+    """
+    _, status, usage=os.wait4(process.pid, 0)
+    process.returncode=os.waitstatus_to_exitcode(status)
+    return process.returncode, f'###Runtime {time.time()-start:.2f} {usage.ru_utime:.2f} {usage.ru_stime:.2f} ###\n'
+
+def timed_pipe(command, stdin):
+    """Run a shell command with a string as stdin and capture stdout and stderr in memory.
+    The runtime is appended to stderr in the form '###Runtime wall user kernel ###'.
+
+    Arguments:
+        command {str} -- shell command
+        stdin {str} -- input for the command
+
+    Returns:
+        (int, str, str) -- returncode, stdout and stderr
+    """
+    start=time.time()
+    process=subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
+    with ThreadPoolExecutor(max_workers=2) as readers:
+        stdout=readers.submit(process.stdout.read)
+        stderr=readers.submit(process.stderr.read)
+        try:
+            process.stdin.write(stdin)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        stdout=stdout.result()
+        stderr=stderr.result()
+    process.stdout.close()
+    process.stderr.close()
+    returncode, runtime=wait_timed(process, start)
+    return returncode, stdout, stderr+runtime
@@ -0,0 +1,82 @@
+import os
+import json
+
+def state_key(state):
+    return tuple(sorted(state.items()))
+
+class Journal(object):
+    def __init__(self, filename, resume=False):
+        """An append-only record of submitted and collected tasks, which allows to resume an interrupted run.
+        Every line is a json object. 'submitted' entries are written before a chunk is run, 'finished' entries when a task ended successfully according to the runner and 'collected' entries after the results of a task were saved in a snapshot. 'attrs' entries store settings which a resumed run must reuse, like the seed of a sampled design.
+
+        Arguments:
+            filename {str} -- journal file
+            resume {bool} -- If True, existing entries are read and kept. Otherwise, the journal is started from scratch. (default: {False})
+        """
+        self.filename=filename
+        self.submitted={}#state key:(chunkid, taskid)
+        self.finished={}#state key:(chunkid, taskid) of tasks which ended successfully
+        self.collected=set()#state keys
+        self.attrs={}
+        self.last_chunkid=-1
+        if resume:
+            self.read()
+        elif os.path.exists(filename):
+            os.remove(filename)
+
+    @staticmethod
+    def filename_for(outputfile):
+        return os.path.splitext(outputfile)[0]+'.journal'
+
+    def read(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    entry=json.loads(line)
+                except json.JSONDecodeError:#the last line might be incomplete after a crash
+                    continue
+                if entry['event']=='attrs':
+                    self.attrs.update(entry['attrs'])
+                    continue
+                key=state_key(entry['state'])
+                if entry['event']=='submitted':
+                    self.submitted[key]=(entry['chunk'], entry['task'])
+                    self.last_chunkid=max(self.last_chunkid, entry['chunk'])
+                elif entry['event']=='finished':
+                    self.finished[key]=(entry['chunk'], entry['task'])
+                elif entry['event']=='collected':
+                    self.collected.add(key)
+
+    def write(self, entries):
+        with open(self.filename, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record_attrs(self, attrs):
+        self.attrs.update(attrs)
+        self.write([{'event':'attrs', 'attrs':attrs}])
+
+    def record(self, event, entries):
+        """Record a list of (chunkid, taskid, state) tuples.
+
+        Arguments:
+            event {str} -- 'submitted', 'finished' or 'collected'
+            entries {list} -- (chunkid, taskid, state) tuples
+        """
+        lines=[]
+        for chunkid, taskid, state in entries:
+            key=state_key(state)
+            if event=='submitted':
+                self.submitted[key]=(chunkid, taskid)
+                self.last_chunkid=max(self.last_chunkid, chunkid)
+            elif event=='finished':
+                self.finished[key]=(chunkid, taskid)
+            else:
+                self.collected.add(key)
+            lines.append({'event':event, 'chunk':chunkid, 'task':taskid, 'state':state})
+        if lines:
+            self.write(lines)
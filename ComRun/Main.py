@@ -1,48 +1,216 @@
 import xarray as xr
-import sys
 import numpy as np
 import itertools as it
 import jinja2 as jinja
 import os as os
 import subprocess
-from ComRun.Helperfunctions import append_ids, consume
-from ComRun.Collectors import UvspecCollector, EmptyCollector
+from ComRun.Helperfunctions import append_ids, timed_run, shard_filename
+from ComRun.Collectors import UvspecCollector, EmptyCollector, LazyOutput, RaggedOutput
+from ComRun.Writers import writer_for, merge_files, open_lazy
+from ComRun.Cache import ResultCache
+from ComRun.Journal import Journal, state_key
+from ComRun.Packing import CostModel, TaskPacker
+from ComRun.Metrics import Metrics
+from ComRun.uvspec import uvspec, UvspecError
 from collections.abc import Iterable
-import re
 import time
+import collections
+import copy
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 VERSION="1.0.1"
 
 class RunController(object):
-    pass
+    def run_chunk(self, chunk):
+        self.run(chunk.runfile)
+
+    def finished(self):
+        """Check without blocking whether the last run finished."""
+        return True
+
+    def failed_tasks(self, chunk):
+        """Get the ids of all tasks in the last chunk which are known to have failed."""
+        return set()
 
 class LocalRunner(RunController):
     def run(self, runfile):
         self.process=subprocess.Popen(f'chmod u=rwx {runfile}; {runfile}', shell=True)
     def wait(self):
         self.result=self.process.wait()
+    def finished(self):
+        return self.process.poll() is not None
+
+class PoolRunner(RunController):
+    def __init__(self, processes=1):
+        """Run every task of a chunk with run_task in a thread pool, with up to 'processes' tasks running at the same time. Subclasses define how a task is run and return its exit code.
+        
+        Keyword Arguments:
+            processes {int} -- number of concurrent tasks (default: {1})
+        """
+        self.processes=max(processes, 1)
+        self.futures=[]
+
+    def run_task(self, chunk, taskid):
+        raise NotImplementedError
+
+    def run_chunk(self, chunk):
+        pool=ThreadPoolExecutor(max_workers=self.processes)
+        self.futures=[pool.submit(self.run_task, chunk, taskid) for taskid in range(len(chunk))]
+        pool.shutdown(wait=False)
+
+    def wait(self):
+        returncodes=[f.result() for f in self.futures]
+        failed=[taskid for taskid, code in enumerate(returncodes) if code!=0]
+        if failed:
+            print(f'Warning: Tasks {failed} returned with nonzero exit status.')
+        self.result=returncodes
+
+    def finished(self):
+        return np.all([f.done() for f in self.futures])
+
+    def failed_tasks(self, chunk):
+        return {taskid for taskid, code in enumerate(self.result) if code!=0}
+
+class LocalPoolRunner(PoolRunner):
+    def __init__(self, command, inputfile, stdout, stderr, processes=1):
+        """Run the tasks of a chunk directly, without a runfile. Every task gets its own process, with up to 'processes' tasks running at the same time.
+        
+        Arguments:
+            command {str} -- command which reads the inputfile from stdin
+            inputfile {str} -- name template of the inputfiles
+            stdout {str} -- name template of the stdout files
+            stderr {str} -- name template of the stderr files
+        
+        Keyword Arguments:
+            processes {int} -- number of concurrent tasks (default: {1})
+        """
+        super().__init__(processes)
+        self.command=command
+        self.inputfile=inputfile
+        self.stdout=stdout
+        self.stderr=stderr
+
+    def run_task(self, chunk, taskid):
+        return timed_run(self.command, *[append_ids(f, chunk.chunkid, taskid) for f in (self.inputfile, self.stdout, self.stderr)])
+
+class PipeRunner(PoolRunner):
+    def __init__(self, template, command, processes=1):
+        """Run the tasks of a chunk without any files: The input is rendered directly into the stdin of the command and stdout and stderr are kept in memory. They are stored in chunk.streams, from where the collector reads them.
+        
+        Arguments:
+            template {Template} -- template of the input
+            command {str} -- command which reads the input from stdin
+        
+        Keyword Arguments:
+            processes {int} -- number of concurrent tasks (default: {1})
+        """
+        super().__init__(processes)
+        self.template=template
+        self.command=command
+
+    def run_task(self, chunk, taskid):
+        state, _=chunk.states[taskid]
+        task=uvspec(self.template.render(state, chunkid=chunk.chunkid, taskid=taskid), command=self.command, info='quiet')
+        try:
+            task.execute()
+        except UvspecError:
+            pass
+        chunk.streams[taskid]={'input':task.input, 'stdout':task.stdout, 'stderr':task.stderr}
+        return task.returncode
+
+TERMINAL_STATES={'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE', 'REVOKED'}
 
 class SlurmRunner(RunController):
+    def __init__(self, mininterval=5, maxinterval=300, backoff=1.5, array_tasks=False):
+        """Submit a runfile with sbatch and wait for the job to finish.
+        The job is tracked by its id. The time between two squeue calls grows from 'mininterval' to 'maxinterval' seconds. Once the job left the queue, the state of every array element is read with sacct. The job is finished when sacct reports a final state for all elements, so a failing squeue call or a delay of the accounting only leads to further polling.
+        
+        Keyword Arguments:
+            mininterval {float} -- first polling interval in seconds (default: {5})
+            maxinterval {float} -- maximum polling interval in seconds (default: {300})
+            backoff {float} -- factor by which the polling interval grows (default: {1.5})
+            array_tasks {bool} -- array element N runs task N, as in examples/Slurmfile.template. Otherwise, failed elements can only be mapped to tasks if the chunk was packed. (default: {False})
+        """
+        self.mininterval=mininterval
+        self.maxinterval=maxinterval
+        self.backoff=backoff
+        self.array_tasks=array_tasks
+        self.jobid=None
+        self.states={}
+        self.done=False
+        self.submitted=None
+        self.started=None
+
     def run(self, runfile):
         self.runfile=runfile
-        subprocess.call(f'sbatch {runfile}', shell=True)
+        result=subprocess.run(['sbatch', '--parsable', runfile], stdout=subprocess.PIPE, check=True, encoding='utf-8')
+        self.jobid=result.stdout.strip().split(';')[0]#--parsable prints jobid[;cluster]
+        self.states={}
+        self.done=False
+        self.submitted=time.time()
+        self.started=None
+
+    @property
+    def queue_time(self):
+        """Seconds between the submission and the first poll which found the job no longer pending, or None if it is still pending."""
+        if self.started is None or self.submitted is None:
+            return None
+        return self.started-self.submitted
     
     def wait(self):
-        waittime=30
-        while(True):
+        waittime=self.mininterval
+        while not (self.done or self.finished()):
             time.sleep(waittime)
-            if self.finished():
-                break
-            # if waittime<600:
-            #     waittime=int(waittime*1.5)
+            waittime=min(waittime*self.backoff, self.maxinterval)
+        failed={element:state for element, (state, exitcode) in self.states.items() if state!='COMPLETED'}
+        if failed:
+            print(f'Warning: Elements of job {self.jobid} did not complete: {failed}')
 
     def finished(self):
-        filename=os.path.basename(self.runfile)
-        uid=os.getuid()
-        result=subprocess.run(f'squeue -u {uid} -n {filename} --format "%.5t"',stdout=subprocess.PIPE, shell=True)
-        pattern = re.compile("\n[\s]*(R|PD)\n")
-        if pattern.search(result.stdout.decode('utf-8')):
+        result=subprocess.run(['squeue', '-h', '-j', self.jobid, '-o', '%i %T'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8')
+        queued=result.returncode==0 and result.stdout.strip()
+        if self.started is None and queued and [line for line in result.stdout.splitlines() if line.split()[-1:]!=['PENDING']]:
+            self.started=time.time()
+        if queued:
             return False
-        return True
+        #squeue fails for jobs which are no longer known, but also if the controller is not reachable
+        states=self.element_states()
+        self.done=bool(states) and np.all([state in TERMINAL_STATES for state, exitcode in states.values()])
+        if self.done:
+            self.states=states
+            if self.started is None:
+                self.started=time.time()
+        return self.done
+
+    def element_states(self):
+        """Get the final state of every element of the job.
+        
+        Returns:
+            dict -- {array index:(state, exitcode)}. The array index is None for jobs without array.
+        """
+        result=subprocess.run(['sacct', '-n', '-P', '-X', '-j', self.jobid, '-o', 'JobID,State,ExitCode'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8')
+        states={}
+        for line in result.stdout.splitlines():
+            fields=line.strip().split('|')
+            if len(fields)<3:
+                continue
+            jobid, state, exitcode=fields[:3]
+            element=jobid.split('_')[1] if '_' in jobid else None
+            state=state.split()[0] if state else state#e.g. 'CANCELLED by 1234'
+            if element is not None and element.isdigit():
+                element=int(element)
+            states[element]=(state, exitcode)
+        return states
+
+    def failed_tasks(self, chunk):
+        """Tasks of array elements which did not complete. If the tasks of the chunk were packed, all tasks of a failed element are returned. With array_tasks, array element N is task N. Otherwise, the tasks of an element are unknown and no task is returned."""
+        failed={element for element, (state, exitcode) in self.states.items() if state!='COMPLETED' and isinstance(element, int)}
+        elements=getattr(chunk, 'elements', None)
+        if elements is not None:
+            return {taskid for element in failed if element<len(elements) for taskid in elements[element]}
+        if self.array_tasks:
+            return failed
+        return set()
 
 class EmptyRunner(RunController):
     def run(self, *args, **kwargs):
@@ -53,8 +221,24 @@ class EmptyRunner(RunController):
 
 class Scheduler(object):
     def __init__(self, variables, tied=[]):
+        """All combinations of the variables, where the variables in every group of 'tied' are varied together.
+        The states are numbered in the order of generate_state. Besides iteration, a scheduler supports len(), indexing and slicing by this number, as well as the reverse lookup with index.
+        
+        Arguments:
+            variables {dict} -- name:list of values
+            tied {list} -- groups of variable names (default: {[]})
+        """
         self.variables=variables
         self.tied=tied
+        tied_flat=[i for group in self.tied for i in group]#[y,z]
+        untied=[key for key in self.variables.keys() if key not in tied_flat]#[x]
+        self.allkeys=untied+tied_flat#[x,y,z]
+        self.majorkeys=untied+[group[0] for group in self.tied if group]#[x,y]
+        self.groups=[[key] for key in untied]+[group for group in self.tied if group]#variables along every axis of the product
+        self.axes=[[(v,) for v in self.variables[key]] for key in untied]+[list(zip(*[self.variables[v] for v in group])) for group in self.tied if group]#value tuples along every axis of the product
+        self.positions=[{values[0]:i for i, values in reversed(list(enumerate(axis)))} for axis in self.axes]#first value of a tuple:position on the axis
+        self.shape=[len(axis) for axis in self.axes]
+        self.strides=[int(np.prod(self.shape[i+1:])) for i in range(len(self.shape))]
     
     @classmethod
     def nflatten(cls,nestlist):
@@ -65,41 +249,278 @@ class Scheduler(object):
             else:
                 yield i
 
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    def make_state(self, com):
+        state=dict(zip(self.allkeys, Scheduler.nflatten(com)))#Resolve the tuples from the combined iterables
+        majorstate={k:state[k] for k in self.majorkeys}
+        return state, majorstate
+
+    def state(self, index):
+        """Get the state with a given number by mixed radix decoding.
+        
+        Arguments:
+            index {int} -- position in the order of generate_state, negative values count from the end
+        
+        Returns:
+            (dict, dict) -- state and majorstate
+        """
+        n=len(self)
+        if index<0:
+            index+=n
+        if not 0<=index<n:
+            raise IndexError(f'State {index} out of range for {n} states!')
+        return self.make_state([axis[(index//stride)%size] for axis, stride, size in zip(self.axes, self.strides, self.shape)])
+
+    def index(self, state):
+        """Get the number of a state. The state must contain the majorkeys, e.g. it can also be a majorstate."""
+        return sum(positions[state[key]]*stride for positions, key, stride in zip(self.positions, self.majorkeys, self.strides))
+
+    def range_variables(self, start, stop=None):
+        """Restrict the variables to the smallest box of the state space which contains the states from 'start' to 'stop' (exclusive). Leading variables which are constant in the range get one value, the first varying one gets the values between the first and the last state and all following variables keep all values.
+        
+        Returns:
+            dict -- name:list of values
+        """
+        stop=len(self) if stop is None else min(stop, len(self))
+        variables=dict(self.variables)
+        if stop<=start:
+            return variables
+        for group, stride, size in zip(self.groups, self.strides, self.shape):
+            first, last=(start//stride)%size, ((stop-1)//stride)%size
+            for key in group:
+                variables[key]=list(self.variables[key])[first:last+1]
+            if first!=last:
+                break
+        return variables
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return (self.state(i) for i in range(*key.indices(len(self))))
+        return self.state(key)
+
     def generate_state(self):
         """Generate an iterable over all possible states.
         
         Yields:
             dict -- A state in the form {key:value, key2:value2, ...}
         """
-        #tied: [[y,z]]
-        tied_flat=[i for group in self.tied for i in group]#[y,z]
-        untied=[key for key in self.variables.keys() if key not in tied_flat]#[x]
-        allkeys=untied+tied_flat#[x,y,z]
-        majorkeys=untied+[group[0] for group in self.tied if group]#[x,y]
-        iterables=[self.variables[v] for v in untied]+[zip( *[self.variables[v] for v in group]) for group in self.tied]#generate a combined iterable for all tied variables 
-        for com in it.product(*iterables):
-            com=Scheduler.nflatten(com)#Resolve the tuples from the combined iterables
-            state=dict(zip(allkeys, com))
-            majorstate={k:state[k] for k in majorkeys}
-            yield state, majorstate
+        for com in it.product(*self.axes):
+            yield self.make_state(com)
+
+SAMPLE_DIM='sample'
+
+def sample_design(ranges, method, samples, seed=None):
+    """Draw a space-filling design in a box.
+    Latin hypercube samples are drawn with numpy, Sobol and Halton sequences need scipy.stats.qmc.
+    
+    Arguments:
+        ranges {dict} -- name:(lower, upper)
+        method {str} -- 'lhs', 'sobol' or 'halton'
+        samples {int} -- number of samples
+        seed {int} -- seed of the random generator or the scrambling (default: {None})
+    
+    Returns:
+        dict -- name:array of sampled values
+    """
+    dims=len(ranges)
+    if method=='lhs':
+        rng=np.random.default_rng(seed)
+        unit=(np.argsort(rng.random((samples, dims)), axis=0)+rng.random((samples, dims)))/samples#one sample in every stratum
+    elif method in ('sobol', 'halton'):
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            raise ImportError(f'Sampling with {method} needs scipy, use lhs instead.')
+        engine=qmc.Sobol(dims, seed=seed) if method=='sobol' else qmc.Halton(dims, seed=seed)
+        unit=engine.random(samples)
+    else:
+        raise KeyError(f'{method} not a valid keyword for "sampling"!')
+    return {name:lower+unit[:,i]*(upper-lower) for i, (name, (lower, upper)) in enumerate(ranges.items())}
+
+def sample_variables(variables, tied, method, samples, seed=None):
+    """Replace all variables given as range 'lower:upper' by a space-filling design. The sampled variables are tied together with the new variable SAMPLE_DIM, which numbers the samples, so the output gets one dimension 'sample' with the sampled values as coordinates.
+    
+    Arguments:
+        variables {dict} -- name:list of values
+        tied {list} -- groups of variable names
+        method {str} -- 'lhs', 'sobol' or 'halton'
+        samples {int} -- number of samples
+        seed {int} -- (default: {None})
+    
+    Returns:
+        (dict, list) -- new variables and tied groups
+    """
+    ranges={}
+    for name, values in variables.items():
+        if len(values)==1 and ':' in values[0]:
+            lower, upper=values[0].split(':')
+            ranges[name]=(float(lower), float(upper))
+    if not ranges:
+        raise ValueError('No variable is given as range "lower:upper" for sampling!')
+    if SAMPLE_DIM in variables:
+        raise ValueError(f'The variable name {SAMPLE_DIM} is reserved for sampling!')
+    if [name for group in tied for name in group if name in ranges]:
+        raise ValueError('Sampled variables can not be part of not_cartesian!')
+    design=sample_design(ranges, method, samples, seed)
+    variables={name:values for name, values in variables.items() if name not in ranges}
+    variables[SAMPLE_DIM]=[str(i) for i in range(samples)]
+    for name, values in design.items():
+        variables[name]=[f'{v:.10g}' for v in values]
+    return variables, tied+[[SAMPLE_DIM]+list(ranges)]
+
+SEED_ATTR='comrun_seed'
+
+def stored_seed(outputfile):
+    """Get the seed of the sampled design of an earlier run from the attributes of 'outputfile' or from its journal.
+
+    Returns:
+        str -- the seed or None, if it is not known
+    """
+    if os.path.exists(outputfile):
+        with open_lazy(outputfile) as ds:
+            if SEED_ATTR in ds.attrs:
+                return str(ds.attrs[SEED_ATTR])
+    journalfile=Journal.filename_for(outputfile)
+    if os.path.exists(journalfile):
+        return Journal(journalfile, resume=True).attrs.get(SEED_ATTR)
+    return None
+
+class AdaptiveScheduler(Scheduler):
+    def __init__(self, variables, tied=[], refine=(), coarse=3, tolerance=0., budget=None):
+        """A scheduler which does not run the full product, but refines a coarse subgrid where the results change most.
+        The variables in 'refine' start with 'coarse' evenly spaced values, all other variables with all values. After every round, the collected quantity of neighbouring states along a refined variable is compared. If it differs by more than 'tolerance', the state in the middle is run in the next round. The values of a refined variable are assumed to be ordered.
+        
+        Arguments:
+            variables {dict} -- name:list of values
+            tied {list} -- groups of variable names (default: {[]})
+            refine {list} -- variables to refine, which must be untied or the first variable of a tied group (default: {()})
+            coarse {int} -- number of values of a refined variable in the first round (default: {3})
+            tolerance {float} -- maximum absolute difference between neighbours (default: {0.})
+            budget {int} -- maximum number of states to run. If None, the number is not limited. (default: {None})
+        """
+        super().__init__(variables, tied)
+        for key in refine:
+            if key not in self.majorkeys:
+                raise KeyError(f'{key} can not be refined, it must be a variable which is not tied to a previous one!')
+        self.refine=[self.majorkeys.index(key) for key in refine]
+        self.coarse=max(coarse, 2)
+        self.tolerance=tolerance
+        self.budget=budget
+        self.scheduled=set()#positions of all states which were run or found in the output
+        self.values={}#position:collected values
+
+    def position_state(self, position):
+        return self.make_state([axis[i] for axis, i in zip(self.axes, position)])
+
+    def coarse_grid(self):
+        positions=[range(n) for n in self.shape]
+        for k in self.refine:
+            positions[k]=np.unique(np.round(np.linspace(0, self.shape[k]-1, min(self.coarse, self.shape[k]))).astype(int))
+        return [tuple(int(i) for i in position) for position in it.product(*positions)]
+
+    def variation(self, a, b):
+        a, b=np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+        if a.shape!=b.shape:
+            return np.inf
+        diff=np.abs(a-b)
+        return np.nanmax(diff) if np.any(np.isfinite(diff)) else np.nan
+
+    def refinement(self, values):
+        """Find the states between neighbours which differ by more than the tolerance.
+        
+        Arguments:
+            values {callable} -- returns the collected values of a majorstate or None
+        
+        Returns:
+            list -- positions of states which were not yet scheduled, starting with the largest difference
+        """
+        for position in self.scheduled:
+            if self.values.get(position) is None:
+                self.values[position]=values(self.position_state(position)[1])
+        candidates={}
+        for k in self.refine:
+            lines=collections.defaultdict(list)
+            for position in self.scheduled:
+                if self.values[position] is not None:
+                    lines[position[:k]+position[k+1:]].append(position[k])
+            for rest, line in lines.items():
+                line.sort()
+                for i, j in zip(line[:-1], line[1:]):
+                    if j-i<2:
+                        continue
+                    variation=self.variation(self.values[rest[:k]+(i,)+rest[k:]], self.values[rest[:k]+(j,)+rest[k:]])
+                    middle=rest[:k]+((i+j)//2,)+rest[k:]
+                    if variation>self.tolerance and middle not in self.scheduled:
+                        candidates[middle]=max(variation, candidates.get(middle, variation))
+        return sorted(candidates, key=candidates.get, reverse=True)
+
+    def rounds(self, values):
+        """Generate the states to run, round by round. The next round is determined when it is requested, so all states of the previous round must be collected by then. States which already have values, e.g. from an existing output, are not run again.
+        
+        Arguments:
+            values {callable} -- returns the collected values of a majorstate or None, if the state is missing
+        
+        Yields:
+            list -- (state, majorstate) tuples of one round
+        """
+        candidates=self.coarse_grid()
+        count=0
+        while candidates:
+            todo=[]
+            for position in candidates:
+                if position in self.scheduled:
+                    continue
+                if self.budget is not None and count+len(todo)>=self.budget:
+                    break
+                state, majorstate=self.position_state(position)
+                self.scheduled.add(position)
+                self.values[position]=values(majorstate)
+                if self.values[position] is None:
+                    todo.append((state, majorstate))
+            if todo:
+                count+=len(todo)
+                yield todo
+            if self.budget is not None and count>=self.budget:
+                return
+            candidates=self.refinement(values)
 
 class Template(object):
     def __init__(self, templatefile, savepath):
-        self.template=jinja.Template(templatefile.read())
+        self.source=templatefile.read()
+        self.template=jinja.Template(self.source)
         self.savepath=savepath
+
+    def __getstate__(self):
+        #compiled jinja templates can not be pickled, they are compiled again in the worker process
+        return {'source':self.source, 'savepath':self.savepath}
+
+    def __setstate__(self, state):
+        self.source=state['source']
+        self.savepath=state['savepath']
+        self.template=jinja.Template(self.source)
     
     @classmethod
     def fromFilepath(cls, templatepath, savepath):
         with open(templatepath) as f:
             return cls(f, savepath)
     
+    def render(self, state, chunkid=None, taskid=None):
+        state_interp=state
+        if taskid is not None or chunkid is not None:
+            state_interp=state.copy()
+            for key, val in state.items():
+                if 'ID' in val:#only values containing TASKID or CHUNKID need to be replaced
+                    if taskid is not None:
+                        val=val.replace("TASKID", str(taskid))
+                    if chunkid is not None:
+                        val=val.replace("CHUNKID", str(chunkid))
+                    state_interp[key]=val
+        return self.template.render(var=state_interp)
+
     def create(self, state, chunkid=None, taskid=None):
-        state_interp=state.copy()
-        if taskid is not None:
-            state_interp={key:val.replace("TASKID", str(taskid)) for i, (key, val) in enumerate(state_interp.items())}
-        if chunkid is not None:
-            state_interp={key:val.replace("CHUNKID", str(chunkid)) for i, (key, val) in enumerate(state_interp.items())}
-        filled=self.template.render(var=state_interp)
+        filled=self.render(state, chunkid=chunkid, taskid=taskid)
         savepath_ext=append_ids(self.savepath, chunkid, taskid)
         self.save_file(filled, savepath_ext)
         return savepath_ext
@@ -133,15 +554,45 @@ class TemplateHandler(object):
             if tp:
                 self.templates[names[i]]=Template.fromFilepath(tp, savepaths[i])
         self.counter=len(self.templates)
+        self.memory_only=set()#names of templates which are rendered, but not saved by create
 
     def create(self, state, names=None, chunkid=None, taskid=None):
         if names is None:
-            names=self.templates.keys()
+            names=[n for n in self.templates.keys() if n not in self.memory_only]
         runfiles=[]
         for n in names:
             runfiles.append(self.templates[n].create(state, chunkid=chunkid, taskid=taskid))
         return runfiles
 
+    def create_chunk(self, states, chunkid=None):
+        """Fill the templates for all tasks of a chunk first and save all files afterwards in one pass, instead of alternating between rendering and writing.
+        
+        Arguments:
+            states {list} -- state of every task, the position is the task id
+        
+        Keyword Arguments:
+            chunkid {int} -- number of the chunk (default: {None})
+        
+        Returns:
+            list -- names of all saved files
+        """
+        names=[n for n in self.templates.keys() if n not in self.memory_only]
+        files=[(append_ids(self.templates[n].savepath, chunkid, taskid), self.templates[n].render(state, chunkid=chunkid, taskid=taskid)) for taskid, state in enumerate(states) for n in names]
+        for filename, filled in files:
+            with open(filename, 'w') as f:
+                f.write(filled)
+        return [filename for filename, _ in files]
+
+    def render(self, state, names=None, chunkid=None, taskid=None):
+        """Fill the templates without saving them.
+        
+        Returns:
+            list -- the filled templates as strings
+        """
+        if names is None:
+            names=self.templates.keys()
+        return [self.templates[n].render(state, chunkid=chunkid, taskid=taskid) for n in names]
+
     def add_template(self, temppath, savepath, name=None):
         if not name:
             name=self.counter
@@ -153,6 +604,417 @@ class EmptyHandler(TemplateHandler):
         super().__init__([],[])
     def add_template(self, temppath, savepath, name=None):
         raise Exception('Not possible to add template to EmptyHandler object!')
+class Chunk(object):
+    def __init__(self, chunkid, states):
+        """A group of tasks, which are run together with one runfile.
+        
+        Arguments:
+            chunkid {int} -- number of the chunk
+            states {list} -- (state, majorstate) tuples. The position of a state in the list is its task id.
+        """
+        self.chunkid=chunkid
+        self.states=states
+        self.runfile=None
+        self.failed=set()
+        self.streams={}#taskid:captured streams, if the tasks were run in memory
+        self.elements=None#task ids of every array element, if the tasks were packed
+
+    def __len__(self):
+        return len(self.states)
+
+def generate_chunks(states, chunksize, chunkstart=0):
+    """Group an iterable of states into chunks.
+    
+    Arguments:
+        states {iterable} -- (state, majorstate) tuples, as generated by Scheduler.generate_state
+        chunksize {int} -- maximum number of tasks in each chunk
+        chunkstart {int} -- id of the first chunk
+    
+    Yields:
+        Chunk -- the next chunk
+    """
+    states=iter(states)
+    chunkid=chunkstart
+    while True:
+        chunkstates=list(it.islice(states, chunksize))
+        if not chunkstates:
+            break
+        yield Chunk(chunkid, chunkstates)
+        chunkid+=1
+
+def shard_chunks(nstates, chunksize, shards, shard):
+    """Split all chunks into 'shards' consecutive ranges of nearly equal size.
+    
+    Returns:
+        (int, int) -- first chunk of the shard and the first chunk after it
+    """
+    nchunks=-(-nstates//chunksize)
+    return shard*nchunks//shards, (shard+1)*nchunks//shards
+
+class ChunkDriver(object):
+    def __init__(self, template_handler, runtemplate_handler, runstate, runner, collector, outputfile, clean=None, info=1, cache=None, journal=None, packer=None, metrics=None):
+        """Process chunks one after another: Create the inputfiles and the runfile, run the chunk, collect the results, save a snapshot and clean up.
+        
+        Arguments:
+            template_handler {TemplateHandler} -- templates filled for every task
+            runtemplate_handler {TemplateHandler} -- template for the runfile of a chunk
+            runstate {dict} -- variables for the runtemplate
+            runner {RunController} -- executes the runfile
+            collector {Collector} -- collects the results
+            outputfile {str} -- file for the snapshots
+        
+        Keyword Arguments:
+            clean {str} -- shell command executed after every chunk. CHUNKID is replaced by the chunk number. (default: {None})
+            info {int} -- verbosity (default: {1})
+            cache {ResultCache} -- If given, states with cached results are not run and new results are added to the cache. (default: {None})
+            journal {Journal} -- If given, submitted and collected tasks are recorded and skip_done can filter out states of a previous run. (default: {None})
+            packer {TaskPacker} -- If given, the tasks of every chunk are packed into array elements by their predicted runtime and a manifest is written for the runfile. (default: {None})
+            metrics {Metrics} -- If given, the phases of every chunk are timed. (default: {None})
+        """
+        self.template_handler=template_handler
+        self.runtemplate_handler=runtemplate_handler
+        self.runstate=runstate
+        self.runner=runner
+        self.collector=collector
+        self.outputfile=outputfile
+        self.clean=clean
+        self.info=info
+        self.cache=cache
+        self.cachekeys={}#state:cache key for all states which are not yet collected
+        self.cached=collections.deque()#(majorstate, arrays, journal entry) found in the cache or recovered from a previous run, but not yet added to the output
+        self.journal=journal
+        self.recovered=[]#journal entries of recovered states, which are not yet part of a snapshot
+        self.packer=packer
+        self.metrics=metrics
+
+    def cachekey(self, state):
+        return self.cache.key(self.template_handler.render(state)+list(self.collector.collection_keys))
+
+    def skip_cached(self, states):
+        """Filter out all states with results in the cache. The key is computed from the templates filled without TASKID and CHUNKID, so that it does not depend on the position of a task.
+        
+        Arguments:
+            states {iterable} -- (state, majorstate) tuples
+        
+        Yields:
+            tuple -- (state, majorstate) of states which need to be run
+        """
+        if self.cache is None:
+            yield from states
+            return
+        for state, majorstate in states:
+            key=self.cachekey(state)
+            arrays=self.cache.get(key)
+            if arrays is None:
+                self.cachekeys[tuple(state.items())]=key
+                yield state, majorstate
+            else:
+                self.cached.append((majorstate, arrays, None))
+
+    def skip_complete(self, states):
+        """Filter out all states of the output which contain values for every collection key. Only states which are missing or nan are run again.
+        
+        Arguments:
+            states {iterable} -- (state, majorstate) tuples
+        
+        Yields:
+            tuple -- (state, majorstate) of states which need to be run
+        """
+        output=self.collector.output
+        mask=output.complete_mask(self.collector.variable_names())
+        for state, majorstate in states:
+            index=output.state_index(majorstate)
+            if np.all([i<n for i, n in zip(index, mask.shape)]) and mask[index]:
+                continue
+            yield state, majorstate
+
+    def skip_done(self, states):
+        """Filter out all states which are collected according to the journal or which are already part of the output.
+        States which finished successfully in a previous run, but were never collected, are read from their existing output files. Only if this fails, they are run again. States which were submitted, but not known to have finished, are always run again.
+        
+        Arguments:
+            states {iterable} -- (state, majorstate) tuples
+        
+        Yields:
+            tuple -- (state, majorstate) of states which need to be run
+        """
+        if self.journal is None:
+            yield from states
+            return
+        recovery=copy.copy(self.collector)#reading happens while other chunks might be collected
+        output=self.collector.output
+        for state, majorstate in states:
+            key=state_key(state)
+            if key in self.journal.collected or output.state_index(majorstate) in output.filled:
+                continue
+            if key in self.journal.finished and self.journal.finished[key]==self.journal.submitted.get(key):
+                chunkid, taskid=self.journal.finished[key]
+                try:
+                    arrays=recovery.extract(chunkid, taskid)
+                except Exception:
+                    arrays=None
+                if arrays is not None:
+                    self.cached.append((majorstate, arrays, (chunkid, taskid, state)))
+                    continue
+            yield state, majorstate
+
+    def add_cached(self):
+        while self.cached:
+            majorstate, arrays, entry=self.cached.popleft()
+            for da in arrays:
+                self.collector.output.add_data(da, majorstate)
+            if entry is not None:
+                self.recovered.append(entry)
+
+    def record(self, event, chunk=None, tasks=()):
+        """Write journal entries for tasks of a chunk and for all recovered states."""
+        if self.journal is None:
+            return
+        entries=[(chunk.chunkid, taskid, chunk.states[taskid][0]) for taskid in tasks]
+        if event=='collected':
+            entries+=self.recovered
+            self.recovered=[]
+        self.journal.record(event, entries)
+
+    def finalize(self):
+        """Add the remaining cached results and save a last snapshot."""
+        if self.cached:
+            self.add_cached()
+            self.collector.save_snapshot(self.outputfile)
+            self.record('collected')
+
+    def phase(self, chunk, name):
+        """Context manager which times a phase of a chunk, if metrics are recorded."""
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.phase(chunk.chunkid, name)
+
+    def record_wait(self, chunk, runner, seconds):
+        """Split the time until a chunk finished into the time in the queue of the runner and the remaining waiting time."""
+        if self.metrics is None:
+            return
+        queued=min(getattr(runner, 'queue_time', None) or 0., seconds)
+        if queued>0:
+            self.metrics.add_phase(chunk.chunkid, 'queue', queued)
+        self.metrics.add_phase(chunk.chunkid, 'wait', seconds-queued)
+
+    def render(self, chunk):
+        with self.phase(chunk, 'render'):
+            self.template_handler.create_chunk([state for state, _ in chunk.states], chunkid=chunk.chunkid)
+            if self.info>1:
+                for state, _ in chunk.states:
+                    print(f'Current state is {state}')
+            runstate=dict(self.runstate)
+            runstate['jobs']=str(len(chunk)-1)
+            if self.packer is not None:
+                runstate.update(self.packer.pack(chunk))
+            runfiles=self.runtemplate_handler.create(runstate, chunkid=chunk.chunkid)
+            chunk.runfile=runfiles[0] if runfiles else None
+        return chunk
+
+    def execute(self, chunk):
+        if self.info>0:
+            print(f'Running chunk {chunk.chunkid} with {len(chunk)} jobs')
+        self.record('submitted', chunk, range(len(chunk)))
+        with self.phase(chunk, 'submit'):
+            self.runner.run_chunk(chunk)
+        start=time.time()
+        self.runner.wait()
+        self.record_wait(chunk, self.runner, time.time()-start)
+        chunk.failed=self.runner.failed_tasks(chunk)
+        self.record('finished', chunk, [taskid for taskid in range(len(chunk)) if taskid not in chunk.failed])
+
+    def finish(self, chunk):
+        if self.info>0:
+            print(f'Reading output of chunk {chunk.chunkid}...')
+        if chunk.failed:
+            print(f'Warning: Skipping failed tasks {sorted(chunk.failed)} of chunk {chunk.chunkid}.')
+        tasks=[taskid for taskid in range(len(chunk)) if taskid not in chunk.failed]
+        streams=[chunk.streams[taskid] for taskid in tasks] if chunk.streams else None
+        with self.phase(chunk, 'collect'):
+            results=self.collector.collect_many([(chunk.states[taskid][1], chunk.chunkid, taskid) for taskid in tasks], streams=streams)
+        if self.metrics is not None:
+            stats=self.collector.take_stats()
+            self.metrics.add(chunk.chunkid, bytes_parsed=stats.pop('bytes_parsed', 0))
+            for name, seconds in stats.items():
+                self.metrics.add_phase(chunk.chunkid, name, seconds)
+        chunk.streams={}
+        if self.cache is not None:
+            for taskid, arrays in zip(tasks, results):
+                self.cache.put(self.cachekeys.pop(tuple(chunk.states[taskid][0].items())), arrays)
+            for taskid in chunk.failed:
+                self.cachekeys.pop(tuple(chunk.states[taskid][0].items()), None)
+        self.add_cached()
+        if self.info>1:
+            for _, majorstate in chunk.states:
+                print(f'Collected state {majorstate}')
+        writer=getattr(self.collector.output, 'writer', None)
+        written=getattr(writer, 'bytes_written', 0)
+        with self.phase(chunk, 'snapshot'):
+            self.collector.save_snapshot(self.outputfile)
+        self.record('collected', chunk, tasks)
+        if self.clean:
+            with self.phase(chunk, 'clean'):
+                exe(self.clean.replace('CHUNKID', str(chunk.chunkid)))
+        if self.metrics is not None:
+            self.metrics.add(chunk.chunkid, bytes_written=getattr(writer, 'bytes_written', 0)-written)
+            self.metrics.finish(chunk.chunkid, len(tasks))
+
+    def refine_chunks(self, rounds, chunksize, chunkstart=0):
+        """Group the rounds of an AdaptiveScheduler into chunks. The next round is only requested after the last chunk of a round was collected, which holds for the sequential run of this class, but not for the pipelined or windowed drivers.
+        
+        Arguments:
+            rounds {iterable} -- lists of (state, majorstate) tuples, as generated by AdaptiveScheduler.rounds
+            chunksize {int} -- maximum number of tasks in each chunk
+            chunkstart {int} -- id of the first chunk
+        
+        Yields:
+            Chunk -- the next chunk
+        """
+        chunkid=chunkstart
+        for states in rounds:
+            for chunk in generate_chunks(self.skip_cached(states), chunksize, chunkid):
+                chunkid=chunk.chunkid+1
+                yield chunk
+            self.add_cached()#cached results are needed for the next refinement
+
+    def run(self, chunks):
+        for chunk in chunks:
+            self.render(chunk)
+            self.execute(chunk)
+            self.finish(chunk)
+
+class PipelinedDriver(ChunkDriver):
+    def __init__(self, *args, depth=1, **kwargs):
+        """Process chunks in overlapping stages: While chunk N runs, the following chunks are rendered and chunk N-1 is collected, both in background threads.
+        Because inputfiles of later chunks already exist while a chunk is cleaned, the clean command should only remove the files of its own chunk, using CHUNKID.
+        
+        Keyword Arguments:
+            depth {int} -- number of chunks rendered in advance (default: {1})
+        """
+        super().__init__(*args, **kwargs)
+        self.depth=max(depth, 1)
+        if self.clean and 'CHUNKID' not in self.clean:
+            print('Warning: The clean command is executed while later chunks are already rendered. Use CHUNKID to only remove the files of the finished chunk.')
+
+    def run(self, chunks):
+        chunks=iter(chunks)
+        rendered=collections.deque()
+        collecting=None
+        with ThreadPoolExecutor(max_workers=1) as renderpool, ThreadPoolExecutor(max_workers=1) as collectpool:
+            def fill():
+                while len(rendered)<self.depth:
+                    chunk=next(chunks, None)
+                    if chunk is None:
+                        break
+                    rendered.append(renderpool.submit(self.render, chunk))
+            fill()
+            while rendered:
+                chunk=rendered.popleft().result()
+                fill()
+                self.execute(chunk)
+                if collecting is not None:
+                    collecting.result()
+                collecting=collectpool.submit(self.finish, chunk)
+            if collecting is not None:
+                collecting.result()
+
+class WindowDriver(ChunkDriver):
+    def __init__(self, *args, window=1, **kwargs):
+        """Keep up to 'window' chunks running at the same time. Every chunk gets its own copy of the runner. Chunks are collected as soon as they finish, in the order of completion.
+        Because other chunks are still running while a chunk is cleaned, the clean command should only remove the files of its own chunk, using CHUNKID.
+        
+        Keyword Arguments:
+            window {int} -- maximum number of chunks running at the same time (default: {1})
+        """
+        super().__init__(*args, **kwargs)
+        self.window=max(window, 1)
+        self.mininterval=getattr(self.runner, 'mininterval', 1)
+        self.maxinterval=getattr(self.runner, 'maxinterval', 60)
+        if self.clean and 'CHUNKID' not in self.clean:
+            print('Warning: The clean command is executed while other chunks are running. Use CHUNKID to only remove the files of the finished chunk.')
+
+    def submit(self, chunk):
+        self.render(chunk)
+        runner=copy.copy(self.runner)
+        if self.info>0:
+            print(f'Submitting chunk {chunk.chunkid} with {len(chunk)} jobs')
+        self.record('submitted', chunk, range(len(chunk)))
+        with self.phase(chunk, 'submit'):
+            runner.run_chunk(chunk)
+        runner.submit_time=time.time()
+        return runner
+
+    def run(self, chunks):
+        chunks=iter(chunks)
+        running={}#chunk:runner
+        waittime=self.mininterval
+        remaining=True
+        while remaining or running:
+            while remaining and len(running)<self.window:
+                chunk=next(chunks, None)
+                if chunk is None:
+                    remaining=False
+                    break
+                running[chunk]=self.submit(chunk)
+            done=[chunk for chunk, runner in running.items() if runner.finished()]
+            for chunk in done:
+                runner=running.pop(chunk)
+                runner.wait()
+                self.record_wait(chunk, runner, time.time()-runner.submit_time)
+                chunk.failed=runner.failed_tasks(chunk)
+                self.record('finished', chunk, [taskid for taskid in range(len(chunk)) if taskid not in chunk.failed])
+                self.finish(chunk)
+            if done:
+                waittime=self.mininterval
+            elif running:
+                time.sleep(waittime)
+                waittime=min(waittime*1.5, self.maxinterval)
+
+_worker_driver=None
+
+def _init_render_worker(driver):
+    global _worker_driver
+    _worker_driver=driver
+
+def _render_worker(chunk):
+    _worker_driver.render(chunk)
+    return len(chunk)
+
+class BulkRenderDriver(ChunkDriver):
+    def __init__(self, *args, workers=1, **kwargs):
+        """Only create the inputfiles and runfiles of all chunks, in a pool of worker processes. Every worker compiles the templates once and renders complete chunks, whose files are written together after all tasks of the chunk were rendered. The throughput is reported at the end.
+        
+        Keyword Arguments:
+            workers {int} -- number of worker processes (default: {1})
+        """
+        super().__init__(*args, **kwargs)
+        self.workers=max(workers, 1)
+
+    def __getstate__(self):
+        #the workers only need the templates
+        return {'template_handler':self.template_handler, 'runtemplate_handler':self.runtemplate_handler, 'runstate':self.runstate, 'info':0, 'packer':self.packer, 'metrics':None}
+
+    def run(self, chunks):
+        chunks=iter(chunks)
+        start=time.time()
+        ntasks=0
+        pending=set()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_render_worker, initargs=(self,)) as pool:
+            while True:
+                while len(pending)<2*self.workers:#limit the number of chunks held in memory
+                    chunk=next(chunks, None)
+                    if chunk is None:
+                        break
+                    pending.add(pool.submit(_render_worker, chunk))
+                if not pending:
+                    break
+                done, pending=wait(pending, return_when=FIRST_COMPLETED)
+                ntasks+=sum(f.result() for f in done)
+        duration=time.time()-start
+        if self.info>0:
+            print(f'Rendered {ntasks} tasks in {duration:.1f} s ({ntasks/max(duration, 1e-9):.1f} tasks/s)')
+
 def exe(command):
     proc=subprocess.Popen(command, shell=True)
     proc.wait()
@@ -161,17 +1023,37 @@ def main():
     import argparse
     par=argparse.ArgumentParser()
     par.add_argument('infile')
+    par.add_argument('--shard', type=int, default=None, help='run only this part of the sweep, if it is split by the option "shards"')
+    par.add_argument('--merge', action='store_true', help='merge the outputs of all shards into outputfile')
     args=par.parse_args()
     def_opts={}
-    def_opts["Options"]={"idnumber":str(int(np.random.rand()*1e10)), "uvspec":"uvspec", "sep":",", "not_cartesian":"", "mode":"local","misctemplates":'',"miscfiles":"","info":"info", "chunkstart":"0","chunksize":"1", "append":"False"}
+    def_opts["Options"]={"idnumber":str(int(np.random.rand()*1e10)), "uvspec":"uvspec", "sep":",", "not_cartesian":"", "mode":"local","misctemplates":'',"miscfiles":"","info":"info", "chunkstart":"0","chunksize":"1", "append":"False", "snapshot":"full", "pipeline":"0", "collect_workers":"1", "processes":"0", "runtemplate":"", "runfile":"", "window":"1", "cache":"", "cachesize":"10000", "resume":"False", "render_workers":"1", "engine":"file", "shards":"1", "lazy":"False", "layout":"dense", "fill_gaps":"False", "refine":"", "refine_value":"", "refine_coarse":"3", "refine_tol":"0", "refine_budget":"0", "sampling":"", "samples":"0", "seed":"", "pack_elements":"0", "manifest":"", "costfile":"", "metrics":"True", "promfile":"", "array_tasks":"False"}
     inp=InputLogger.Input(args.infile,version=VERSION, def_opts=def_opts)
     inp.convert_array(str, "misctemplates", "Options", removeSpaces=True)
     inp.convert_array(str, "miscfiles", "Options", removeSpaces=True)
     inp.convert_array(str, "out_values","Output", removeSpaces=True)
     inp.convert_array(str, "not_cartesian", "Options", removeSpaces=True)
+    inp.convert_array(str, "refine", "Options", removeSpaces=True)
     inp.convert_type(int, 'chunksize', 'Options')
     inp.convert_type(int, 'chunkstart', 'Options')
     inp.convert_type(bool, 'append', 'Options')
+    inp.convert_type(bool, 'resume', 'Options')
+    inp.convert_type(bool, 'lazy', 'Options')
+    inp.convert_type(bool, 'fill_gaps', 'Options')
+    inp.convert_type(bool, 'metrics', 'Options')
+    inp.convert_type(bool, 'array_tasks', 'Options')
+    inp.convert_type(int, 'pipeline', 'Options')
+    inp.convert_type(int, 'collect_workers', 'Options')
+    inp.convert_type(int, 'processes', 'Options')
+    inp.convert_type(int, 'window', 'Options')
+    inp.convert_type(float, 'cachesize', 'Options')
+    inp.convert_type(int, 'render_workers', 'Options')
+    inp.convert_type(int, 'shards', 'Options')
+    inp.convert_type(int, 'refine_coarse', 'Options')
+    inp.convert_type(float, 'refine_tol', 'Options')
+    inp.convert_type(int, 'refine_budget', 'Options')
+    inp.convert_type(int, 'samples', 'Options')
+    inp.convert_type(int, 'pack_elements', 'Options')
     infodict={'quiet':0, 'info':1, 'verbose':2}
     info=infodict[inp.get('info', 'Options')]
     if info >0:
@@ -185,84 +1067,149 @@ def main():
         tied=[]
     runstate=inp.options['Run']
     outputfile=inp.get('outputfile', 'Options')
+    seed=None
+    if inp.get('sampling', 'Options'):
+        #all processes which write into the same output must draw the same design
+        seed=inp.get('seed', 'Options')
+        continued=inp.get('append', 'Options') or inp.get('resume', 'Options') or inp.get('fill_gaps', 'Options')
+        if not seed and continued:
+            seed=stored_seed(shard_filename(outputfile, args.shard) if args.shard is not None else outputfile)
+            if seed is None:
+                raise ValueError('The seed of the sampled design is not stored in the output or journal, set the option seed!')
+        if not seed and (inp.get('shards', 'Options')>1 or args.shard is not None or args.merge):
+            raise ValueError('Sampling with shards needs the option seed, so all shards draw the same design!')
+        seed=seed or str(int(np.random.rand()*1e9))
+        variables, tied=sample_variables(variables, tied, inp.get('sampling', 'Options'), inp.get('samples', 'Options'), int(seed))
     chunksize=inp.get('chunksize', 'Options')
     chunkstart=inp.get('chunkstart', 'Options')
 
     mode=inp.get('mode', 'Options')
     misctemplates=inp.get('misctemplates', 'Options')
     intemplate=inp.get('intemplate', 'Options')
+    refine=[key for key in inp.get('refine', 'Options') if key]
+    if refine:
+        scheduler=AdaptiveScheduler(variables, tied, refine, inp.get('refine_coarse', 'Options'), inp.get('refine_tol', 'Options'), inp.get('refine_budget', 'Options') or None)
+    else:
+        scheduler=Scheduler(variables, tied)
+    shards=inp.get('shards', 'Options')
+    if args.merge:
+        merge_files([shard_filename(outputfile, shard) for shard in range(shards)], outputfile, scheduler.majorkeys, {key:variables[key] for key in scheduler.majorkeys}, chunksize)
+        inp.add_outfile(outputfile)
+        inp.write_log(os.path.splitext(outputfile)[0]+".log", old_logs=[intemplate]+misctemplates)
+        return
+    firstchunk, stopchunk=0, None
+    if args.shard is not None:
+        if not 0<=args.shard<shards:
+            raise ValueError(f'Shard {args.shard} does not exist for shards={shards}!')
+        outputfile=shard_filename(outputfile, args.shard)
+        firstchunk, stopchunk=shard_chunks(len(scheduler), chunksize, shards, args.shard)
+    stop=stopchunk*chunksize if stopchunk is not None else None
+    output_variables=variables
+    if args.shard is not None:#the output of a shard only covers its own states, --merge forms the union
+        output_variables=scheduler.range_variables(firstchunk*chunksize, stop)
     template_handler=TemplateHandler(misctemplates, inp.get('miscfiles', 'Options'))
     template_handler.add_template(intemplate, inp.get('inputfile', 'Options'), 'input')
     runtemplate_handler=TemplateHandler(inp.get('runtemplate', 'Options'), inp.get('runfile', 'Options'), 'Run')
+    processes=inp.get('processes', 'Options')
+    if inp.get('engine', 'Options') not in ('file', 'pipe'):
+        raise KeyError(f'{inp.get("engine", "Options")} not a valid keyword for "engine"!')
     if mode=='local':
-        runner=LocalRunner()
-        collector=UvspecCollector(inp.get("stdout", 'Options'), inp.get("stderr", 'Options'), inp.get("inputfile", 'Options'),inp.get("miscfiles", 'Options'), inp.get("out_values", 'Output'), variables, tied)
-        if chunksize!=1:
-            print("Warning: When running local, you probably want to set the chunksize to 1.")
+        if inp.get('engine', 'Options')=='pipe':
+            template_handler.memory_only.add('input')
+            runner=PipeRunner(template_handler.templates['input'], inp.get("uvspec", 'Options'), processes)
+        elif processes>0:
+            runner=LocalPoolRunner(inp.get("uvspec", 'Options'), inp.get("inputfile", 'Options'), inp.get("stdout", 'Options'), inp.get("stderr", 'Options'), processes)
+        else:
+            runner=LocalRunner()
+            if chunksize!=1:
+                print("Warning: When running local, you probably want to set the chunksize to 1.")
+        collector=UvspecCollector(inp.get("stdout", 'Options'), inp.get("stderr", 'Options'), inp.get("inputfile", 'Options'),inp.get("miscfiles", 'Options'), inp.get("out_values", 'Output'), output_variables, tied)
     elif mode=='create':
         runner=EmptyRunner()
         collector=EmptyCollector()
     elif mode=='slurm':
-        runner=SlurmRunner()
-        collector=UvspecCollector(inp.get("stdout", 'Options'), inp.get("stderr", 'Options'), inp.get("inputfile", 'Options'),inp.get("miscfiles", 'Options'), inp.get("out_values", 'Output'), variables, tied)
+        runner=SlurmRunner(array_tasks=inp.get('array_tasks', 'Options'))
+        collector=UvspecCollector(inp.get("stdout", 'Options'), inp.get("stderr", 'Options'), inp.get("inputfile", 'Options'),inp.get("miscfiles", 'Options'), inp.get("out_values", 'Output'), output_variables, tied)
     elif mode=='read':
         template_handler=EmptyHandler()
         runner=EmptyRunner()
-        collector=UvspecCollector(inp.get("stdout", 'Options'), inp.get("stderr", 'Options'), inp.get("inputfile", 'Options'),inp.get("miscfiles", 'Options'), inp.get("out_values", 'Output'), variables, tied)
+        collector=UvspecCollector(inp.get("stdout", 'Options'), inp.get("stderr", 'Options'), inp.get("inputfile", 'Options'),inp.get("miscfiles", 'Options'), inp.get("out_values", 'Output'), output_variables, tied)
     else:
         raise KeyError(f'{mode} not a valid keyword for "mode"!')
+    if refine and (mode not in ('local', 'slurm') or args.shard is not None or inp.get('window', 'Options')>1 or inp.get('pipeline', 'Options')>0):
+        raise ValueError('Adaptive refinement is only possible in mode local or slurm, without shards, window or pipeline!')
+    collector.workers=inp.get('collect_workers', 'Options')
+    if inp.get('layout', 'Options') not in ('dense', 'ragged'):
+        raise KeyError(f'{inp.get("layout", "Options")} not a valid keyword for "layout"!')
+    if inp.get('layout', 'Options')=='ragged':
+        if inp.get('lazy', 'Options') or inp.get('snapshot', 'Options')!='full' or os.path.splitext(outputfile)[1]=='.zarr':
+            raise ValueError('The ragged layout is only possible for netcdf output with snapshot=full and lazy=False!')
+        collector.output=RaggedOutput(output_variables, tied)
+    elif inp.get('lazy', 'Options'):
+        if os.path.splitext(outputfile)[1]=='.zarr':
+            raise ValueError('The option lazy is only possible for netcdf output!')
+        collector.output=LazyOutput(output_variables, tied)
+    else:
+        collector.output.writer=writer_for(outputfile, inp.get('snapshot', 'Options'), chunksize)
     
-    if inp.get('append', 'Options'):
+    resume=inp.get('resume', 'Options')
+    fill_gaps=inp.get('fill_gaps', 'Options') and mode!='create'
+    if inp.get('append', 'Options') or ((resume or fill_gaps) and os.path.exists(outputfile)):
         collector.output.load_existing(outputfile)
+    if seed is not None:
+        collector.output.attrs[SEED_ATTR]=seed
 
-    scheduler=Scheduler(variables, tied)
-    chunks_remaining=True
-    states_creation=scheduler.generate_state()
-    states_reading=scheduler.generate_state()
-    chunkid=chunkstart
-    consume(states_creation, chunksize*chunkstart)
-    consume(states_reading, chunksize*chunkstart)
-    while chunks_remaining:
-        taskid=0
-        while taskid<chunksize:
-            try:
-                state, _=next(states_creation)
-            except StopIteration:
-                chunks_remaining=False
-                break
-            template_handler.create(state,chunkid=chunkid, taskid=taskid)
-            taskid+=1
-            if info>1:
-                print(f'Current state is {state}')
-        if taskid==0 and not chunks_remaining:
-            break
-        runstate['jobs']=str(taskid-1)
-        runfile=runtemplate_handler.create(runstate, chunkid=chunkid)[0]
-        if info>0:
-            print(f'Running chunk {chunkid} with {taskid} jobs')
-        runner.run(runfile)
-        runner.wait()
-        taskid=0
-        if info>0:
-            print('Reading output...')
-        while taskid<chunksize:
-            try:
-                _, majorstate=next(states_reading)
-            except StopIteration:
-                chunks_remaining=False
-                break
-            collector.collect(majorstate, chunkid, taskid)
-            taskid+=1
-            if info>1:
-                print(f'Current state is {majorstate}')
-        collector.save_snapshot(outputfile)
-        if mode=='local' or mode=='slurm':
-            exe(inp.get("clean",'Options'))
-        chunkid+=1
+    journal=None
+    if mode=='local' or mode=='slurm':
+        journal=Journal(Journal.filename_for(outputfile), resume=resume)
+        if seed is not None:
+            journal.record_attrs({SEED_ATTR:seed})
+    if resume:
+        states=scheduler[firstchunk*chunksize:stop]
+        chunkstart=max(chunkstart, firstchunk, journal.last_chunkid+1) if journal else max(chunkstart, firstchunk)
+    else:
+        chunkstart=max(chunkstart, firstchunk)
+        states=scheduler[chunksize*chunkstart:stop]
+    clean=inp.get("clean",'Options') if mode=='local' or mode=='slurm' else None
+    cache=None
+    if inp.get('cache', 'Options') and (mode=='local' or mode=='slurm'):
+        cache=ResultCache(inp.get('cache', 'Options'), int(inp.get('cachesize', 'Options')*1e6))
+    driver_args=(template_handler, runtemplate_handler, runstate, runner, collector, outputfile)
+    packer=None
+    if inp.get('pack_elements', 'Options')>0:
+        costfile=inp.get('costfile', 'Options')
+        if costfile:
+            with xr.open_dataset(costfile) as pilot:
+                model=CostModel.fit(pilot, scheduler.majorkeys)
+        else:
+            model=CostModel.fit(collector.output.data, scheduler.majorkeys)
+        packer=TaskPacker(model, inp.get('pack_elements', 'Options'), inp.get('manifest', 'Options') or os.path.splitext(inp.get('runfile', 'Options'))[0]+'.manifest')
+    metrics=None
+    if inp.get('metrics', 'Options') and mode!='create':
+        metrics=Metrics(Metrics.filename_for(outputfile), inp.get('promfile', 'Options') or None)
+    driver_kwargs={'clean':clean, 'info':info, 'cache':cache, 'journal':journal, 'packer':packer, 'metrics':metrics}
+    if mode=='create' and inp.get('render_workers', 'Options')>1:
+        driver=BulkRenderDriver(*driver_args, workers=inp.get('render_workers', 'Options'), **driver_kwargs)
+    elif inp.get('window', 'Options')>1:
+        driver=WindowDriver(*driver_args, window=inp.get('window', 'Options'), **driver_kwargs)
+    elif inp.get('pipeline', 'Options')>0:
+        driver=PipelinedDriver(*driver_args, depth=inp.get('pipeline', 'Options'), **driver_kwargs)
+    else:
+        driver=ChunkDriver(*driver_args, **driver_kwargs)
+    if refine:
+        refine_value=inp.get('refine_value', 'Options') or collector.variable_names()[0]
+        chunks=driver.refine_chunks(scheduler.rounds(lambda majorstate: collector.output.state_values(refine_value, majorstate)), chunksize, chunkstart)
+    else:
+        if fill_gaps:
+            states=driver.skip_complete(states)
+        if resume:
+            states=driver.skip_done(states)
+        chunks=generate_chunks(driver.skip_cached(states), chunksize, chunkstart)
+    driver.run(chunks)
+    driver.finalize()
+    collector.close()
     collector.save(outputfile, inp, [intemplate]+misctemplates)
-    print(collector.output.data)
-        # if chunkid==2:
-        #     sys.exit()
+    print(collector.output.summary())
 
 
 
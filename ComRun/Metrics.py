@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import threading
+import collections
+import contextlib
+
+def max_rss():
+    """Memory high-water marks of this process and of all finished child processes in bytes, or None where not available."""
+    try:
+        import resource
+    except ImportError:#not available on windows
+        return None, None
+    return tuple(resource.getrusage(who).ru_maxrss*1024 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+class Metrics(object):
+    def __init__(self, filename, promfile=None):
+        """Measure where the time of a run is spent. Every phase of a chunk (rendering, submission, queueing, waiting, extraction of every output value, adding to the output, snapshots, cleaning) is timed and counters like the number of parsed and written bytes are summed up.
+        When a chunk is finished, one json line with its phases, throughput and the memory high-water marks is appended to 'filename'. The totals of the run can additionally be exported as textfile for the node exporter of Prometheus.
+
+        Arguments:
+            filename {str} -- json lines file
+            promfile {str} -- If given, the totals are written to this file after every chunk. (default: {None})
+        """
+        self.filename=filename
+        self.promfile=promfile
+        self.start=time.time()
+        self.chunks={}#chunkid:(start time, phases, counters) of unfinished chunks
+        self.phases=collections.Counter()#totals of all finished chunks
+        self.counters=collections.Counter()
+        self.nchunks=0
+        self.lock=threading.Lock()#phases of different chunks run in parallel in the pipelined driver
+
+    @staticmethod
+    def filename_for(outputfile):
+        return os.path.splitext(outputfile)[0]+'.metrics.jsonl'
+
+    def chunk(self, chunkid):
+        if chunkid not in self.chunks:
+            self.chunks[chunkid]=(time.time(), collections.Counter(), collections.Counter())
+        return self.chunks[chunkid]
+
+    @contextlib.contextmanager
+    def phase(self, chunkid, name):
+        start=time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(chunkid, name, time.time()-start)
+
+    def add_phase(self, chunkid, name, seconds):
+        with self.lock:
+            self.chunk(chunkid)[1][name]+=seconds
+
+    def add(self, chunkid, **counters):
+        with self.lock:
+            self.chunk(chunkid)[2].update(counters)
+
+    def finish(self, chunkid, tasks):
+        """Write the line of a finished chunk and update the totals.
+
+        Arguments:
+            chunkid {int} -- the chunk
+            tasks {int} -- number of collected tasks
+        """
+        with self.lock:
+            start, phases, counters=self.chunk(chunkid)
+            del self.chunks[chunkid]
+            seconds=time.time()-start
+            counters['tasks']+=tasks
+            self.phases.update(phases)
+            self.counters.update(counters)
+            self.nchunks+=1
+            rss, rss_children=max_rss()
+            entry={'chunk':chunkid, 'time':time.time(), 'seconds':seconds, 'tasks_per_second':tasks/max(seconds, 1e-9), 'phases':dict(phases), **counters, 'max_rss':rss, 'max_rss_children':rss_children}
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(entry)+'\n')
+            if self.promfile:
+                self.write_prometheus(rss, rss_children)
+
+    def write_prometheus(self, rss, rss_children):
+        """Write the totals in the text format of Prometheus. The file is replaced atomically, as expected by the textfile collector."""
+        lines=['# HELP comrun_phase_seconds_total Time spent in every phase of all finished chunks.', '# TYPE comrun_phase_seconds_total counter']
+        lines+=[f'comrun_phase_seconds_total{{phase="{name}"}} {seconds}' for name, seconds in sorted(self.phases.items())]
+        lines+=['# TYPE comrun_chunks_total counter', f'comrun_chunks_total {self.nchunks}']
+        for name, value in sorted(self.counters.items()):
+            lines+=[f'# TYPE comrun_{name}_total counter', f'comrun_{name}_total {value}']
+        lines+=['# TYPE comrun_tasks_per_second gauge', f'comrun_tasks_per_second {self.counters["tasks"]/max(time.time()-self.start, 1e-9)}']
+        for name, value in (('max_rss_bytes', rss), ('max_rss_children_bytes', rss_children)):
+            if value is not None:
+                lines+=[f'# TYPE comrun_{name} gauge', f'comrun_{name} {value}']
+        tempfile=f'{self.promfile}.{os.getpid()}.tmp'
+        with open(tempfile, 'w') as f:
+            f.write('\n'.join(lines)+'\n')
+        os.replace(tempfile, self.promfile)
@@ -0,0 +1,108 @@
+import heapq
+import numpy as np
+from ComRun.Helperfunctions import append_ids
+
+class CostModel(object):
+    def __init__(self, state_dims, exact=None, mean=0., effects=None):
+        """Predict the runtime of a state from the runtimes of earlier runs.
+        States which were already run get their measured wall time. For all other states, the logarithm of the runtime is modeled as sum of one effect per value of every state dimension, so e.g. a wide wavelength range is expensive for all combinations with the other variables.
+        Without any measurements, every state costs 1.
+
+        Arguments:
+            state_dims {list} -- names of the state dimensions
+            exact {dict} -- tuple of state values:measured runtime (default: {None})
+            mean {float} -- mean logarithmic runtime (default: {0.})
+            effects {dict} -- state dimension:{value:logarithmic effect} (default: {None})
+        """
+        self.state_dims=state_dims
+        self.exact=exact or {}
+        self.mean=mean
+        self.effects=effects or {}
+
+    @classmethod
+    def fit(cls, dataset, state_dims, iterations=10):
+        """Fit the model to the wall times in 'time_all' of a dense output.
+
+        Arguments:
+            dataset {xr.Dataset} -- output of an earlier run, e.g. a short pilot run
+            state_dims {list} -- names of the state dimensions
+
+        Keyword Arguments:
+            iterations {int} -- number of backfitting iterations (default: {10})
+
+        Returns:
+            CostModel -- the fitted model
+        """
+        if 'time_all' not in dataset:
+            return cls(state_dims)
+        da=dataset['time_all']
+        if 'rt_type' in da.dims:
+            da=da.sel(rt_type='wall')
+        if [d for d in da.dims if d not in state_dims]:#e.g. the ragged layout
+            return cls(state_dims)
+        dims=[d for d in state_dims if d in da.dims]
+        frame=da.to_dataframe(name='time').reset_index()
+        frame=frame[frame['time']>0]
+        if frame.empty:
+            return cls(state_dims)
+        exact={tuple(row[d] for d in dims):row['time'] for _, row in frame.iterrows()} if dims==list(state_dims) else {}
+        y=np.log(frame['time'].values)
+        mean=y.mean()
+        effects={d:{} for d in dims}
+        for _ in range(iterations):
+            for d in dims:
+                residual=y-mean-sum(frame[o].map(effects[o]).fillna(0.).values for o in dims if o!=d)
+                effects[d]=dict(frame.assign(residual=residual).groupby(d)['residual'].mean())
+        return cls(state_dims, exact, mean, effects)
+
+    def predict(self, state):
+        """Predicted runtime of a state, which must contain all state dimensions."""
+        key=tuple(state[d] for d in self.state_dims)
+        if key in self.exact:
+            return self.exact[key]
+        return float(np.exp(self.mean+sum(effects.get(state[d], 0.) for d, effects in self.effects.items())))
+
+def pack_lpt(costs, elements):
+    """Distribute tasks over array elements with the longest processing time first heuristic: Tasks are sorted by decreasing cost and every task is given to the element with the lowest total cost so far.
+
+    Arguments:
+        costs {list} -- predicted cost of every task
+        elements {int} -- number of array elements
+
+    Returns:
+        list -- task ids of every element
+    """
+    packing=[[] for _ in range(min(elements, len(costs)))]
+    loads=[(0., element) for element in range(len(packing))]
+    for taskid in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        load, element=heapq.heappop(loads)
+        packing[element].append(taskid)
+        heapq.heappush(loads, (load+costs[taskid], element))
+    return packing
+
+class TaskPacker(object):
+    def __init__(self, model, elements, manifest):
+        """Pack the tasks of every chunk into a fixed number of array elements and write the assignment into a manifest file.
+        Line i of the manifest contains the task ids of array element i, separated by spaces.
+
+        Arguments:
+            model {CostModel} -- predicts the cost of a task
+            elements {int} -- number of array elements per chunk
+            manifest {str} -- name template of the manifest files, the chunk id is appended
+        """
+        self.model=model
+        self.elements=elements
+        self.manifest=manifest
+
+    def pack(self, chunk):
+        """Set chunk.elements and write the manifest of a chunk.
+
+        Returns:
+            dict -- variables for the runtemplate: 'manifest' and 'elements', the number of the last element
+        """
+        chunk.elements=pack_lpt([self.model.predict(majorstate) for _, majorstate in chunk.states], self.elements)
+        filename=append_ids(self.manifest, chunk.chunkid)
+        with open(filename, 'w') as f:
+            for tasks in chunk.elements:
+                f.write(' '.join(str(taskid) for taskid in tasks)+'\n')
+        return {'manifest':filename, 'elements':str(len(chunk.elements)-1)}
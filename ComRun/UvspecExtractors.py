@@ -1,4 +1,5 @@
 import re
+import io
 import numpy as np
 
 class ResultNotFoundException(Exception): #Derived from Exception class
@@ -8,6 +9,87 @@ class ResultNotFoundException(Exception): #Derived from Exception class
         return(repr(self.value)) 
 
 
+WAVELENGTH=re.compile(r'([0-9]*\.[0-9]*) nm')
+RUNTIME=re.compile(r'###Runtime ([^#]*) ###')
+SOLVER_FINISHED='internal_to_transmittance_grid'#first message after the radiative transfer calculation of all wavelengths
+
+def read_tail(stream, size=4096):
+    """Read the last characters of a seekable stream."""
+    if hasattr(stream, 'buffer'):#text file, seek in the underlying binary file
+        raw=stream.buffer
+        raw.seek(0, io.SEEK_END)
+        raw.seek(max(0, raw.tell()-size))
+        return raw.read().decode('utf-8', errors='replace')
+    stream.seek(0, io.SEEK_END)
+    stream.seek(max(0, stream.tell()-size))
+    return stream.read()
+
+def scan_stderr(stream, quantities=('runtime', 'wctau', 'optprop')):
+    """Walk once through the (verbose) stderr output of uvspec and yield the requested quantities as soon as they are found.
+    Lines are only read until the radiative transfer calculation finished. The runtime, which is appended at the end of stderr, is then read from the tail of the stream. Since the stream is read line by line, files larger than the memory can be scanned.
+
+    Arguments:
+        stream {stream} -- filestream of the stderr output
+        quantities {iterable} -- any of 'runtime', 'wctau', 'optprop' (default: all)
+
+    Yields:
+        (str, object) -- ('runtime', [wall, user, kernel]), ('wctau', [wavelength, tau_scat, tau_abs]) for every wavelength or ('optprop', (wavelength, table)) for every wavelength
+    """
+    pending=set(quantities)
+    sections=pending&{'wctau', 'optprop'}
+    wavelength=None
+    found=0#0: outside of an optical properties section, 1,2: header, 3: table, 4: after the table, until the sum
+    table=[]
+    for line in stream:
+        if '###Runtime' in line and 'runtime' in pending:
+            match=RUNTIME.search(line)
+            if match:
+                yield 'runtime', [float(v) for v in match.group(1).split()[:3]]
+                pending.discard('runtime')
+                if not pending:
+                    return
+            continue
+        if not sections:
+            break
+        if '*** wavelength: iv =' in line:
+            #*** wavelength: iv = 0, 599.831543 nm
+            wavelength=float(WAVELENGTH.search(line).group(1))
+        elif SOLVER_FINISHED in line:
+            break
+        elif found==0:
+            if '*** optical_properties' in line:
+                found=1
+        elif found<3:
+            if '---------------------------------------------' in line:
+                found+=1
+        elif found==3:
+            #the table ends with the phase function line of disort or directly with the separator before the sum
+            end='The phase function' in line or '------' in line or 'sum |' in line
+            if 'optprop' in sections:
+                try:
+                    table.append([float(val) for val in line.replace('|', ' ').split()])
+                    continue
+                except ValueError:
+                    if not end:
+                        raise Exception('Error: Did not find end of optprop table like expected.')
+                    yield 'optprop', (wavelength, np.array(table))
+                    table=[]
+            if end:
+                found=4
+        if found==4 and 'sum |' in line:
+            if 'wctau' in sections:
+                arr=line.replace('|', ' ').split()
+                yield 'wctau', [wavelength, float(arr[6]), float(arr[7])]
+            found=0
+    pending-=sections
+    if 'runtime' in pending:
+        seekable=hasattr(stream, 'seekable') and stream.seekable()
+        for line in (read_tail(stream).splitlines() if seekable else stream):
+            match=RUNTIME.search(line) if '###Runtime' in line else None
+            if match:
+                yield 'runtime', [float(v) for v in match.group(1).split()[:3]]
+                break
+
 def get_wctau_dis_fromstream(stream_verbose_stderr):
     """Get total water cloud optical thickness from disort verbose stderr output.
 
@@ -20,20 +102,7 @@ def get_wctau_dis_fromstream(stream_verbose_stderr):
     Returns:
         np 2darr -- columns wavelength, tau_scat, tau_abs
     """
-    found=0
-    result=[]
-    for line in stream_verbose_stderr:
-        #*** wavelength: iv = 0, 599.831543 nm
-        if '*** wavelength: iv =' in line:
-            match=re.search('([0-9]*\.[0-9]*) nm', line)
-            wavelength=match.group(1)
-        if not found and '*** optical_properties' in line:
-            found=1
-        if found and 'sum |' in line:
-            arr=line.replace('|', ' ')
-            arr=arr.split()
-            found=0
-            result.append([float(wavelength), float(arr[6]), float(arr[7])])
+    result=[value for _, value in scan_stderr(stream_verbose_stderr, ['wctau'])]
     if not result:
         raise ResultNotFoundException('No information about cloud optical thickness found!')
     return np.array(result)
@@ -44,37 +113,76 @@ def get_optprop_table_fromstream(stream_verbose_stderr):
     Arguments:
         stream_verbose_stderr {stream} -- filestream of the stderr output.
 
+    Returns:
+        dict -- wavelength:table with one row per level
+    """
+    return dict(value for _, value in scan_stderr(stream_verbose_stderr, ['optprop']))
+
+def read_disort_stdout(text):
+    """Read the stdout of uvspec with the disort solver in one pass.
+    For every wavelength, disort prints a line with 7 values (wavelength and the standard output). If radiances are calculated, this line is followed by a line with the phi angles and one line for every umu angle with umu, the azimuthally averaged radiance and the radiance for every phi.
+    Only the first lines are inspected to find the structure, all numbers are read at once and reshaped into blocks of one wavelength.
+
+    Arguments:
+        text {str} -- stdout of uvspec
+
     Raises:
-        ResultNotFoundException: If no information was found.
+        ResultNotFoundException: If the output is empty.
 
     Returns:
-        np 2darr -- columns wavelength, tau_scat, tau_abs
+        (np 2darr, tuple) -- standard output with one row per wavelength and 7 columns, (rad_umu, rad_phi, radiance) with radiance of shape (wvl, umu, phi) or None, if no radiances are in the output
     """
-    found=0
-    result={}
-    table=[]
-    for line in stream_verbose_stderr:
-        #*** wavelength: iv = 0, 599.831543 nm
-        if '*** wavelength: iv =' in line:
-            match=re.search('([0-9]*\.[0-9]*) nm', line)
-            wavelength=match.group(1)
-        if not found and '*** optical_properties' in line:
-            found=1
-        if found and '---------------------------------------------' in line:
-            found+=1
-            continue
-        if found==3:
-            arr=line.replace('|', ' ')
-            arr=arr.split()
-            try:
-                table.append([float(val) for val in arr])
-            except ValueError:
-                if 'The phase function' in line:
-                    result[float(wavelength)]=np.array(table)
-                    table=[]
-                    found=0
-                else:
-                    raise Exception('Error: Did not find end of optprop table like expected.')
-    return result
+    lengths=[]
+    for line in io.StringIO(text):
+        lengths.append(len(line.split()))
+        if len(lengths)>3 and lengths[-1]==lengths[1]:#phi line of the second wavelength
+            break
+    if not lengths:
+        raise ResultNotFoundException('No lines found in disort output!')
+    if lengths[0]!=7:
+        raise Exception('Error: Number of fields in first line of disort output not 7!')
+    values=np.fromstring(text, dtype=float, sep=' ')
+    if np.all(np.array(lengths[:3])==7):#no radiance
+        return values.reshape(-1, 7), None
+    n_phi=lengths[1]
+    if n_phi==7:
+        print("Error: output not unique if 7 phi angles are specified!")
+    assert(n_phi!=7)
+    n_umu=len(lengths)-4 if len(lengths)>3 and lengths[-1]==n_phi else len(lengths)-2
+    blocksize=7+n_phi+n_umu*(n_phi+2)
+    if len(values)%blocksize!=0:
+        raise Exception(f'Error: disort output does not consist of blocks with {n_phi} phi and {n_umu} umu angles!')
+    blocks=values.reshape(-1, blocksize)
+    umu=blocks[:, 7+n_phi:].reshape(len(blocks), n_umu, n_phi+2)
+    return blocks[:, :7], (umu[0,:,0], blocks[0,7:7+n_phi], umu[:,:,2:])
 
+def first_change(rows, columns):
+    """Index of the first row, where any of the given columns differs from the first row, or the number of rows if there is no such row."""
+    changed=np.any(rows[:,columns]!=rows[0,columns], axis=1)
+    return int(np.argmax(changed)) if changed.any() else len(rows)
 
+def read_mystic_spc(filename):
+    """Read a MYSTIC radiance file (.rad.spc or .rad.std.spc) with the columns wavelength, ix, iy, iz and radiance.
+    The rows are ordered by wavelength, ix, iy, iz and polarization, with the last one changing fastest. The grid is inferred from the positions where the leading columns change for the first time, instead of searching all unique values. If the first two rows have equal coordinates, the file contains the four Stokes components I, Q, U, V.
+
+    Arguments:
+        filename {str} -- the radiance file
+
+    Returns:
+        (list, np ndarr) -- coordinates [rad_wvl, rad_ix, rad_iy, rad_iz, rad_pol] and radiance with the corresponding shape
+    """
+    data=np.loadtxt(filename, dtype=float, ndmin=2)
+    n_pol=4 if len(data)>1 and np.all(data[0,:4]==data[1,:4]) else 1
+    rows=data[::n_pol]
+    n_iz=first_change(rows, [0,1,2])
+    n_iyz=first_change(rows, [0,1])
+    n_ixyz=first_change(rows, [0])
+    if n_iyz%n_iz or n_ixyz%n_iyz or len(rows)%n_ixyz or len(data)%n_pol:
+        raise Exception(f'Error: The rows in {filename} do not form a regular grid!')
+    rad_wvl=rows[::n_ixyz,0]
+    rad_ix=rows[:n_ixyz:n_iyz,1]
+    rad_iy=rows[:n_iyz:n_iz,2]
+    rad_iz=rows[:n_iz,3]
+    rad_pol=['I', 'Q', 'U', 'V'] if n_pol==4 else ['I']
+    radiance=data[:,4].reshape(len(rad_wvl), len(rad_ix), len(rad_iy), len(rad_iz), n_pol)#a view on the radiance column
+    return [rad_wvl, rad_ix, rad_iy, rad_iz, rad_pol], radiance
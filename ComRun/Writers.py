@@ -0,0 +1,544 @@
+import os
+import itertools as it
+import math
+import shutil
+import numpy as np
+
+FILLED='comrun_filled'
+
+def path_size(path):
+    """Size of a file or of all files in a directory, e.g. a zarr store, in bytes."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+class SnapshotWriter(object):
+    """Base class for objects which store the content of an Output object in a file.
+    'bytes_written' sums up the size of all written files and data blocks."""
+    bytes_written=0
+
+    def write(self, output, savefile):
+        raise NotImplementedError
+
+class NetcdfWriter(SnapshotWriter):
+    def write(self, output, savefile):
+        """Write the complete output dataset to a netcdf file, replacing any existing file."""
+        output.data.to_netcdf(savefile)
+        output.dirty.clear()
+        self.bytes_written+=path_size(savefile)
+
+def is_string(dtype):
+    return np.dtype(dtype).kind in 'USO'
+
+def contiguous_regions(indices):
+    """Group state positions into hyperslabs which can be written with one call.
+    Positions sharing all but the last index are combined into slices along the last dimension.
+
+    Arguments:
+        indices {iterable} -- tuples of integer positions
+
+    Yields:
+        tuple -- position with a slice as last element
+    """
+    indices=sorted(indices)
+    for prefix, group in it.groupby(indices, key=lambda idx: idx[:-1]):
+        last=[idx[-1] for idx in group]
+        start=last[0]
+        for prev, cur in zip(last, last[1:]+[None]):
+            if cur!=prev+1:
+                yield prefix+(slice(start, prev+1),)
+                start=cur
+
+class NetcdfRegionWriter(SnapshotWriter):
+    def __init__(self):
+        """Write snapshots incrementally. The netcdf file is created once, with the state dimensions preallocated and the dimensions of the extracted quantities unlimited. Every following snapshot only writes the hyperslabs of states which changed since the last snapshot.
+        The file is closed after every snapshot. The variable 'comrun_filled' is updated after the data and marks the states which were written completely, so that a file from an interrupted run can be used safely.
+        """
+        self.savefile=None
+
+    def write(self, output, savefile):
+        import netCDF4
+        if self.savefile!=savefile or not os.path.exists(savefile) or not self.fits(output, savefile):
+            self.create(output, savefile)
+        else:
+            with netCDF4.Dataset(savefile, 'a') as nc:
+                self.write_states(nc, output, output.dirty)
+        output.dirty.clear()
+
+    def fits(self, output, savefile):
+        """Check whether the state dimensions of the file can hold the output and whether the coordinates in the file are still at the same positions in the output. Sorting new coordinates of the extracted quantities moves existing ones, which requires a new file."""
+        import netCDF4
+        with netCDF4.Dataset(savefile, 'r') as nc:
+            if not np.all([d in nc.dimensions and len(nc.dimensions[d])==len(output.axes[d]) for d in output.state_dims]):
+                return False
+            for d, axis in output.axes.items():
+                if d in output.state_dims or d not in nc.variables:
+                    continue
+                written=list(np.asarray(nc[d][:]))
+                if written!=list(axis.values[:len(written)]):
+                    return False
+            return True
+
+    def create(self, output, savefile):
+        """Create a new file containing all states of the output. The file is written to a temporary location first, so that an existing file is only replaced by a complete one."""
+        import netCDF4
+        tempfile=savefile+'.tmp'
+        with netCDF4.Dataset(tempfile, 'w') as nc:
+            nc.setncatts(output.attrs)
+            for d in output.state_dims:
+                nc.createDimension(d, len(output.axes[d]))
+            filled=nc.createVariable(FILLED, 'u1', tuple(output.state_dims))
+            filled.flag_values=np.array([0,1], dtype='u1')
+            filled.flag_meanings='missing written'
+            for d in output.state_dims:
+                self.write_axis(nc, output.axes[d], 0)
+            self.write_states(nc, output, [])
+            for name, var in output.store.items():
+                values=var.view()
+                nc[name][tuple(slice(0, n) for n in values.shape)]=self.encode(values)
+            if output.state_dims:
+                mask=np.zeros([len(output.axes[d]) for d in output.state_dims], dtype='u1')
+                for index in output.filled:
+                    mask[index]=1
+                filled[...]=mask
+        os.replace(tempfile, savefile)
+        self.savefile=savefile
+        self.bytes_written+=path_size(savefile)
+
+    def write_axis(self, nc, axis, start):
+        """Write the coordinate values of an axis, beginning at position 'start'."""
+        values=axis.coordinate()
+        if axis.name not in nc.variables:
+            if axis.name not in nc.dimensions:
+                nc.createDimension(axis.name, None)
+            var=nc.createVariable(axis.name, str if is_string(values.dtype) else values.dtype, (axis.name,))
+            var.setncatts(axis.attrs)
+        for auxname in axis.aux:
+            if auxname not in nc.variables:
+                auxvalues=np.array(axis.aux[auxname])
+                nc.createVariable(auxname, str if is_string(auxvalues.dtype) else auxvalues.dtype, (axis.name,))
+        if len(values)>start:
+            nc[axis.name][start:]=values[start:].astype(object) if is_string(values.dtype) else values[start:]
+            for auxname, auxvalues in axis.aux.items():
+                auxvalues=np.array(auxvalues)
+                nc[auxname][start:]=auxvalues[start:].astype(object) if is_string(auxvalues.dtype) else auxvalues[start:]
+
+    @staticmethod
+    def encode(block):
+        """String variables are stored as variable length strings, where missing values become empty strings."""
+        if is_string(block.dtype):
+            block=np.array([v if isinstance(v, str) else v[()] if isinstance(v, np.ndarray) and v.ndim==0 and isinstance(v[()], str) else '' for v in block.flat], dtype=object).reshape(block.shape)
+        return block
+
+    def write_states(self, nc, output, indices):
+        """Write the given states of all output variables into an open file and mark them as filled. Variables and coordinates which are not yet part of the file are added."""
+        indices=list(indices)
+        nstate=len(output.state_dims)
+        for name, var in output.store.items():
+            for axis in var.axes[nstate:]:
+                written=len(nc[axis.name]) if axis.name in nc.variables else 0
+                self.write_axis(nc, axis, written)
+            if name not in nc.variables:
+                if np.dtype(var.values.dtype).kind=='c':
+                    raise TypeError(f'Complex variable {name} can not be written incrementally. Use snapshot=full instead.')
+                if is_string(var.values.dtype):
+                    ncvar=nc.createVariable(name, str, var.dims)
+                else:
+                    ncvar=nc.createVariable(name, var.values.dtype, var.dims, fill_value=np.nan)
+                ncvar.setncatts(var.attrs)
+            if not indices:
+                continue
+            values=var.view()
+            extent=tuple(slice(0, len(axis)) for axis in var.axes[nstate:])
+            for region in (contiguous_regions(indices) if nstate else [()]):
+                block=values[region+extent]
+                nc[name][region+extent]=self.encode(block)
+                self.bytes_written+=block.nbytes
+        if nstate:
+            for region in contiguous_regions(indices):
+                nc[FILLED][region]=1
+
+class NetcdfRowWriter(NetcdfRegionWriter):
+    def __init__(self):
+        """Write the pending rows of a LazyOutput into a netcdf file. The file is the only complete copy of the output: It is created once with the state dimensions preallocated and afterwards, only the rows of new states are written."""
+        self.savefile=None
+
+    def write(self, output, savefile):
+        import netCDF4
+        if not os.path.exists(savefile) or (self.savefile!=savefile and output.source!=savefile):
+            self.create(output, savefile)
+        with netCDF4.Dataset(savefile, 'a') as nc:
+            self.write_rows(nc, output)
+        output.pending.clear()
+        output.dirty.clear()
+
+    def create(self, output, savefile):
+        import netCDF4
+        tempfile=savefile+'.tmp'
+        with netCDF4.Dataset(tempfile, 'w') as nc:
+            nc.setncatts(output.attrs)
+            for d in output.state_dims:
+                nc.createDimension(d, len(output.axes[d]))
+                self.write_axis(nc, output.axes[d], 0)
+            filled=nc.createVariable(FILLED, 'u1', tuple(output.state_dims))
+            filled.flag_values=np.array([0,1], dtype='u1')
+            filled.flag_meanings='missing written'
+            if output.state_dims:
+                filled[...]=np.zeros([len(output.axes[d]) for d in output.state_dims], dtype='u1')
+        os.replace(tempfile, savefile)
+        self.savefile=savefile
+        self.bytes_written+=path_size(savefile)
+
+    def write_rows(self, nc, output):
+        """Add new coordinates and variables to an open file and write all pending rows."""
+        for d, axis in output.axes.items():
+            if d not in output.state_dims:
+                self.write_axis(nc, axis, len(nc[d]) if d in nc.variables else 0)
+        for name, (dims, dtype, attrs) in output.layout.items():
+            if name not in nc.variables:
+                if np.dtype(dtype).kind=='c':
+                    raise TypeError(f'Complex variable {name} can not be written by a lazy output.')
+                ncvar=nc.createVariable(name, str, dims) if is_string(dtype) else nc.createVariable(name, dtype, dims, fill_value=np.nan)
+                ncvar.setncatts(attrs)
+        for name, rows in output.pending.items():
+            for index, positions, values in rows:
+                nc[name][index+positions]=self.encode(values)
+                self.bytes_written+=values.nbytes
+        if output.state_dims:
+            for region in contiguous_regions(output.dirty):
+                nc[FILLED][region]=1
+        self.savefile=nc.filepath()
+
+def state_chunks(sizes, chunksize):
+    """Derive a chunk shape over the state dimensions, which is aligned with the chunks of 'chunksize' consecutive states: Every ComRun chunk covers complete zarr chunks, so no zarr chunk is written by two ComRun chunks.
+    Trailing dimensions are kept complete as long as their number of states divides the chunksize. The next dimension gets the largest chunk length which divides both its length and the remaining factor of the chunksize.
+
+    Arguments:
+        sizes {list} -- length of every state dimension
+        chunksize {int} -- number of states in one chunk
+
+    Returns:
+        tuple -- chunk length along every state dimension
+    """
+    chunks=[1]*len(sizes)
+    remaining=max(int(chunksize), 1)
+    if remaining>=np.prod(sizes):#only one ComRun chunk
+        return tuple(max(size, 1) for size in sizes)
+    for i in reversed(range(len(sizes))):
+        size=max(sizes[i], 1)
+        if remaining%size==0:
+            chunks[i]=size
+            remaining//=size
+        else:
+            chunks[i]=math.gcd(size, remaining)
+            break
+    return tuple(chunks)
+
+class ZarrRegionWriter(SnapshotWriter):
+    def __init__(self, chunksize=1):
+        """Write snapshots into a zarr store. The store is created once and every following snapshot only writes the regions of states which changed, using to_zarr(region=...).
+        The zarr chunks along the state dimensions are aligned with the chunks of the scheduler (see state_chunks), so that ComRun processes working on different chunks write to different zarr chunks. A store with other chunks is rejected. The store is created in a temporary directory and moved into place, so if several processes create it at the same time, one wins and the others write into its store.
+        Existing data is never overwritten by a new layout: New coordinates of the extracted quantities are appended to the store and new variables are added. If several processes share one store, it should already contain all coordinates of the extracted quantities, because concurrent appends can not be coordinated. Appended coordinates are only sorted if they arrive in increasing order, otherwise sort when reading, e.g. xr.open_zarr(store).sortby('rad_wvl').
+
+        Arguments:
+            chunksize {int} -- number of states in one ComRun chunk
+        """
+        self.chunksize=chunksize
+        self.savefile=None
+
+    def write(self, output, savefile):
+        import xarray as xr
+        if not os.path.exists(savefile) and self.create(output, savefile):
+            output.dirty.clear()
+            return
+        store=xr.open_zarr(savefile)
+        self.check_chunks(output, savefile, store)
+        if not self.fits(output, store):
+            store=self.extend(output, savefile, store)
+        self.write_states(output, savefile, store, output.dirty)
+        output.dirty.clear()
+
+    def chunks(self, output):
+        return dict(zip(output.state_dims, state_chunks([len(output.axes[d]) for d in output.state_dims], self.chunksize)))
+
+    def check_chunks(self, output, savefile, store):
+        """Reject stores whose zarr chunks are not aligned with the ComRun chunks."""
+        for d in output.state_dims:
+            if store.sizes.get(d)!=len(output.axes[d]):
+                raise Exception(f'The state dimension {d} of the store {savefile} does not match the output!')
+        expected=self.chunks(output)
+        found=dict(zip(store[FILLED].dims, store[FILLED].encoding.get('chunks', ()))) if FILLED in store else {}
+        if found and found!=expected:
+            raise Exception(f'The zarr chunks {found} of {savefile} are not aligned with chunksize={self.chunksize}, which needs {expected}!')
+
+    def extend(self, output, savefile, store):
+        """Append new coordinates of the extracted quantities and add new variables to the store, without touching existing data.
+
+        Returns:
+            xr.Dataset -- the extended store
+        """
+        import xarray as xr
+        data=self.dataset(output)
+        for d, axis in output.axes.items():
+            if d in output.state_dims or d not in store.dims:
+                continue
+            new=[v for v in axis.values if v not in store.indexes[d]]
+            if not new:
+                continue
+            names=[name for name in output.store if name in store and d in data[name].dims]
+            part=data[names].sel({d:new})
+            part=part.reindex({e:store.indexes[e] for e in part.dims if e not in output.state_dims and e!=d and e in store.dims})
+            part=part.drop_vars([c for c in part.coords if d not in part[c].dims])
+            part.to_zarr(savefile, append_dim=d)
+            store=xr.open_zarr(savefile)
+        names=[name for name in output.store if name not in store]
+        if names:
+            part=data[names]
+            part=part.reindex({d:store.indexes[d] for d in part.dims if d not in output.state_dims and d in store.dims})
+            part=part.drop_vars([c for c in part.coords if c in store.coords])
+            chunks=self.chunks(output)
+            part.to_zarr(savefile, mode='a', encoding={name:{'chunks':tuple(chunks.get(d, part.sizes[d]) for d in part[name].dims)} for name in names})
+            store=xr.open_zarr(savefile)
+        return store
+
+    def fits(self, output, store):
+        """Check whether all coordinates of the output are present in the store."""
+        for d, axis in output.axes.items():
+            if d not in store.dims:
+                return False
+            if d in output.state_dims and store.sizes[d]!=len(axis):
+                return False
+            if not set(axis.index).issubset(store.indexes[d]):
+                return False
+        return np.all([name in store for name in output.store])
+
+    def dataset(self, output):
+        data=output.data.copy()
+        for name in output.store:
+            data[name]=(data[name].dims, NetcdfRegionWriter.encode(data[name].values), data[name].attrs)
+        mask=np.zeros([len(output.axes[d]) for d in output.state_dims], dtype='u1')
+        for index in output.filled:
+            mask[index]=1
+        data[FILLED]=(tuple(output.state_dims), mask)
+        return data
+
+    def create(self, output, savefile):
+        """Create the store, unless another process was faster.
+
+        Returns:
+            bool -- True if this process created the store
+        """
+        data=self.dataset(output)
+        chunks=self.chunks(output)
+        encoding={name:{'chunks':tuple(chunks.get(d, data.sizes[d]) for d in data[name].dims)} for name in data.data_vars}
+        tempstore=f'{savefile}.{os.getpid()}.tmp'
+        data.to_zarr(tempstore, mode='w-', encoding=encoding)
+        size=path_size(tempstore)
+        try:
+            os.rename(tempstore, savefile)#atomic, fails if the store exists and is not empty
+        except OSError:
+            shutil.rmtree(tempstore)
+            if not os.path.exists(savefile):
+                raise
+            return False
+        self.savefile=savefile
+        self.bytes_written+=size
+        return True
+
+    def write_states(self, output, savefile, store, indices):
+        """Write the given states into an existing store. Extracted quantities are aligned to the coordinates of the store."""
+        if not self.fits(output, store):
+            raise Exception(f'The coordinates of the output do not fit into the existing store {savefile}!')
+        data=self.dataset(output)
+        nstate=len(output.state_dims)
+        extdims=[d for d in data.dims if d not in output.state_dims]
+        data=data.reindex({d:store.indexes[d] for d in extdims})
+        data=data.drop_vars([c for c in data.coords])
+        for region in (contiguous_regions(indices) if nstate else []):
+            region=dict(zip(output.state_dims, [r if isinstance(r, slice) else slice(r, r+1) for r in region]))
+            block=data.isel(region)
+            block.to_zarr(savefile, region=region)
+            self.bytes_written+=block.nbytes
+
+def open_lazy(filename):
+    """Open a netcdf file or zarr store without loading the data."""
+    import xarray as xr
+    if os.path.splitext(filename)[1]=='.zarr':
+        return xr.open_zarr(filename)
+    return xr.open_dataset(filename)
+
+def as_index(positions):
+    """Use a slice instead of an array of positions, if they are consecutive."""
+    if np.ndim(positions)==0:
+        return int(positions)
+    positions=np.asarray(positions)
+    if len(positions)>0 and np.all(np.diff(positions)==1):
+        return slice(int(positions[0]), int(positions[-1])+1)
+    return positions
+
+def filled_mask(dataset, state_dims):
+    """Mask of all states which contain data, from 'comrun_filled' or from the non-missing values."""
+    if FILLED in dataset:
+        return dataset[FILLED].transpose(*state_dims).values>0
+    filled=np.zeros([dataset.sizes[d] for d in state_dims], dtype=bool)
+    for da in dataset.data_vars.values():
+        da=da.expand_dims([d for d in state_dims if d not in da.dims])
+        filled|=da.notnull().any([d for d in da.dims if d not in state_dims]).transpose(*state_dims).values
+    return filled
+
+def rows_writable(filename, state_dims):
+    """Check whether NetcdfRowWriter can continue a netcdf file: It needs 'comrun_filled', unlimited dimensions for the extracted quantities and the state dimensions first in every variable."""
+    import netCDF4
+    with netCDF4.Dataset(filename, 'r') as nc:
+        if FILLED not in nc.variables:
+            return False
+        if [d for name, dim in nc.dimensions.items() if name not in state_dims and not dim.isunlimited()]:
+            return False
+        return np.all([var.dimensions[:len(state_dims)]==tuple(state_dims) for name, var in nc.variables.items() if name not in nc.dimensions and name!=FILLED and len(var.dimensions)>1])
+
+def convert_for_rows(filename, state_dims):
+    """Rewrite a netcdf file, e.g. from snapshot=full or a merge, so that NetcdfRowWriter can continue it. The dimensions of the extracted quantities become unlimited and 'comrun_filled' is derived from the non-missing values, if it does not exist. The data is copied with dask, so it does not need to fit into memory."""
+    import xarray as xr
+    tempfile=filename+'.convert.tmp'
+    with xr.open_dataset(filename, chunks={}) as ds:
+        if FILLED not in ds:
+            ds[FILLED]=(tuple(state_dims), filled_mask(ds, state_dims).astype('u1'), {'flag_values':np.array([0,1], dtype='u1'), 'flag_meanings':'missing written'})
+        for name in ds.data_vars:
+            dims=ds[name].dims
+            if set(state_dims).issubset(dims):
+                ds[name]=ds[name].transpose(*state_dims, ...)
+        ds.to_netcdf(tempfile, unlimited_dims=[d for d in ds.dims if d not in state_dims])
+    os.replace(tempfile, filename)
+
+def merge_files(files, savefile, state_dims, state_coords=None, chunksize=1):
+    """Merge the outputs of several ComRun processes into one netcdf file or zarr store. Only one variable of one file is in memory at a time.
+    The coordinates of the merged file are the union of all coordinates. Every file contributes the states which it marks as filled, later files overwrite earlier ones.
+    A zarr store (savefile ending with '.zarr') is first merged into a temporary netcdf file, which is then copied with dask into a store with the chunks of ZarrRegionWriter.
+
+    Arguments:
+        files {list} -- netcdf files or zarr stores written by ComRun
+        savefile {str} -- the merged netcdf file or zarr store
+        state_dims {list} -- names of the state dimensions
+
+    Keyword Arguments:
+        state_coords {dict} -- state dimension:all values in the order of the merged file. Needed if the files only cover parts of the state dimensions, like the shards. (default: {None})
+        chunksize {int} -- number of states in one ComRun chunk, which determines the chunks of a zarr store (default: {1})
+    """
+    if os.path.splitext(savefile)[1]=='.zarr':
+        tempfile=savefile+'.merge.nc'
+        merge_files(files, tempfile, state_dims, state_coords)
+        to_zarr_store(tempfile, savefile, state_dims, chunksize)
+        os.remove(tempfile)
+        return
+    import netCDF4
+    import pandas as pd
+    coords={}#dim:values in order of appearance
+    aux={}#name:(dim, {dim value:aux value})
+    variables={}#name:(dims, dtype, attrs)
+    attrs=None
+    for filename in files:
+        with open_lazy(filename) as ds:
+            attrs=dict(ds.attrs) if attrs is None else attrs
+            for d in ds.dims:
+                values=ds[d].values if d in ds.coords else np.arange(ds.sizes[d])
+                known=coords.setdefault(d, {})
+                for v in values:
+                    known.setdefault(v, len(known))
+            for name, coord in ds.coords.items():
+                if name not in ds.dims and len(coord.dims)==1:
+                    aux.setdefault(name, (coord.dims[0], {}))[1].update(zip(ds[coord.dims[0]].values, coord.values))
+            for name, da in ds.data_vars.items():
+                if name==FILLED:
+                    continue
+                dims=tuple(state_dims)+tuple(d for d in da.dims if d not in state_dims)
+                dtype=da.dtype if name not in variables else np.promote_types(variables[name][1], da.dtype)
+                variables[name]=(dims, dtype, dict(da.attrs))
+    indexes={d:pd.Index(list(values)) for d, values in coords.items()}
+    for d, values in (state_coords or {}).items():
+        indexes[d]=pd.Index(list(values))
+    for d, index in indexes.items():
+        if d not in state_dims:#coordinates of the extracted quantities are sorted, like the union formed by xr.merge
+            try:
+                indexes[d]=index.sort_values()
+            except TypeError:
+                pass
+    tempfile=savefile+'.tmp'
+    with netCDF4.Dataset(tempfile, 'w') as nc:
+        nc.setncatts(attrs or {})
+        for d, index in indexes.items():
+            nc.createDimension(d, len(index))
+            values=np.array(index)
+            nc.createVariable(d, str if is_string(values.dtype) else values.dtype, (d,))
+            nc[d][:]=values.astype(object) if is_string(values.dtype) else values
+        for name, (d, mapping) in aux.items():
+            missing='' if is_string(np.array(list(mapping.values())).dtype) else np.nan
+            values=np.array([mapping.get(v, missing) for v in indexes[d]])
+            nc.createVariable(name, str if is_string(values.dtype) else values.dtype, (d,))
+            nc[name][:]=values.astype(object) if is_string(values.dtype) else values
+        for name, (dims, dtype, varattrs) in variables.items():
+            if np.dtype(dtype).kind=='c':
+                raise TypeError(f'Complex variable {name} can not be merged.')
+            if is_string(dtype):
+                ncvar=nc.createVariable(name, str, dims)
+            else:
+                ncvar=nc.createVariable(name, np.float64 if np.dtype(dtype).kind in 'iub' else dtype, dims, fill_value=np.nan)
+            ncvar.setncatts(varattrs)
+        merged=nc.createVariable(FILLED, 'u1', tuple(state_dims))
+        merged.flag_values=np.array([0,1], dtype='u1')
+        merged.flag_meanings='missing written'
+        merged[...]=np.zeros([len(indexes[d]) for d in state_dims], dtype='u1')
+        for filename in files:
+            with open_lazy(filename) as ds:
+                filled=filled_mask(ds, state_dims)
+                regions=list(contiguous_regions(zip(*np.nonzero(filled)))) if state_dims else [()]
+                positions={d:indexes[d].get_indexer(ds[d].values if d in ds.coords else np.arange(ds.sizes[d])) for d in ds.dims}
+                targets=[tuple(as_index(positions[d][r]) for d, r in zip(state_dims, region)) for region in regions]
+                for name, da in ds.data_vars.items():
+                    if name==FILLED:
+                        continue
+                    dims=variables[name][0]
+                    values=da.expand_dims([d for d in state_dims if d not in da.dims]).transpose(*dims).values
+                    extent=[]
+                    for axis, d in enumerate(dims[len(state_dims):], len(state_dims)):
+                        order=np.argsort(positions[d], kind='stable')#netcdf expects increasing positions
+                        values=np.take(values, order, axis=axis)
+                        extent.append(as_index(positions[d][order]))
+                    for region, target in zip(regions, targets):
+                        nc[name][target+tuple(extent)]=NetcdfRegionWriter.encode(values[region])
+                for target in targets:
+                    merged[target]=1
+    os.replace(tempfile, savefile)
+
+def to_zarr_store(filename, savefile, state_dims, chunksize=1):
+    """Copy a netcdf file written by ComRun into a zarr store, which ZarrRegionWriter can continue. An existing store is replaced."""
+    import xarray as xr
+    with xr.open_dataset(filename, chunks={}) as ds:
+        chunks=dict(zip(state_dims, state_chunks([ds.sizes[d] for d in state_dims], chunksize)))
+        encoding={name:{'chunks':tuple(chunks.get(d, ds.sizes[d]) for d in ds[name].dims)} for name in ds.data_vars}
+        ds=ds.chunk({d:chunks.get(d, -1) for d in ds.dims})
+        for name in ds.data_vars:
+            ds[name].encoding={}
+        tempstore=f'{savefile}.{os.getpid()}.tmp'
+        ds.to_zarr(tempstore, mode='w', encoding=encoding)
+    if os.path.exists(savefile):
+        shutil.rmtree(savefile)
+    os.rename(tempstore, savefile)
+
+def writer_for(savefile, snapshot='full', chunksize=1):
+    """Select a snapshot writer. Files ending with '.zarr' are always written as zarr store with region writes.
+
+    Arguments:
+        savefile {str} -- output filename
+        snapshot {str} -- 'full' rewrites the file for every snapshot, 'incremental' only writes the states which changed
+        chunksize {int} -- number of states in one ComRun chunk
+
+    Returns:
+        SnapshotWriter -- the writer
+    """
+    if os.path.splitext(savefile)[1]=='.zarr':
+        return ZarrRegionWriter(chunksize)
+    if snapshot=='full':
+        return NetcdfWriter()
+    elif snapshot=='incremental':
+        return NetcdfRegionWriter()
+    raise KeyError(f'{snapshot} not a valid keyword for "snapshot"!')
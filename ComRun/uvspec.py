@@ -1,7 +1,7 @@
 import re as reg
 import numpy as np
 import xarray as xr
-import subprocess
+from ComRun.Helperfunctions import timed_pipe
 
 class UvspecError(Exception):
     """Exception raised for errors in uvspec.
@@ -16,10 +16,10 @@ class UvspecError(Exception):
 
 
 class uvspec(object):
-    def __init__(self, input):
+    def __init__(self, input, command='uvspec', info='info'):
         self.input=input
-        self._uvspec_command=uvspec
-        self._verbose='info'
+        self._uvspec_command=command
+        self._info=info
 
     def get_basename(self):
         """Get the parameter value of "mc_basename" in a uvspec input file
@@ -92,21 +92,14 @@ class uvspec(object):
         Returns:
             (str, str) -- (stdout, stderr) as tuple of strings
         """
-        uvspec=self._uvspec_command
-        # process=subprocess.run(args=["time","-f", "\"Runtimes in total: %e %U %S\"", "ls"],stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        process=subprocess.Popen(args=["time","-f", "\"###Runtime %e %U %S ###\"", uvspec],stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-        process.stdin.write(self.input)
-        out,err=process.communicate()#also sends end signal to stdin?
-        process.stdin.close()
+        self.returncode, out, err=timed_pipe(self._uvspec_command, self.input)#the runtime is appended to stderr
+        self.stdout=out
+        self.stderr=err
         if self._info=="verbose":
             print(err)
             print(out)
-        if process.returncode!=0:
-            raise UvspecError("Error in uvspec: returncode was "+str(process.returncode))
-            
-        # print(process.stderr.decode('utf-8'))
-        self.stdout=out
-        self.stderr=err
+        if self.returncode!=0:
+            raise UvspecError("Error in uvspec: returncode was "+str(self.returncode))
 
 
     def process_output(self, key):
@@ -0,0 +1,48 @@
+from ComRun.Cache import ResultCache
+import xarray as xr
+import numpy as np
+import unittest as ut
+import tempfile
+import os
+import time
+
+class ResultCacheTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def array(self, value):
+        da=xr.DataArray(np.full(100, value), coords=[('wvl', np.arange(100))])
+        da.name='radiance'
+        return da
+
+    def test_key(self):
+        self.assertEqual(ResultCache.key(['a', 'b']), ResultCache.key(['a', 'b']))
+        self.assertNotEqual(ResultCache.key(['ab', '']), ResultCache.key(['a', 'b']))
+
+    def test_get_put(self):
+        cache=ResultCache(self.tempdir.name)
+        key=cache.key(['input'])
+        self.assertIsNone(cache.get(key))
+        cache.put(key, [self.array(1.0)])
+        xr.testing.assert_identical(ResultCache(self.tempdir.name).get(key)[0], self.array(1.0))
+
+    def test_evict(self):
+        cache=ResultCache(self.tempdir.name)
+        cache.put('first', [self.array(1.0)])
+        entrysize=cache.size
+        cache.maxsize=int(2.5*entrysize)
+        cache.put('second', [self.array(2.0)])
+        os.utime(cache.path('first'), (time.time()-10, time.time()-10))
+        os.utime(cache.path('second'), (time.time()-5, time.time()-5))
+        cache.get('first')#first is now the most recently used entry
+        cache.put('third', [self.array(3.0)])
+        self.assertIsNone(cache.get('second'))
+        self.assertIsNotNone(cache.get('first'))
+        self.assertIsNotNone(cache.get('third'))
+        self.assertLessEqual(cache.size, cache.maxsize)
+
+if __name__=="__main__":
+    ut.main()
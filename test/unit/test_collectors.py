@@ -1,8 +1,13 @@
-from ComRun.Collectors import Output, UvspecCollector, CoordinateError
+from ComRun.Collectors import Output, LazyOutput, RaggedOutput, UvspecCollector, CoordinateError
 import xarray as xr
 import numpy.testing as npt
 import numpy as np
 import unittest as ut
+from unittest import mock
+import tempfile
+import shutil
+import os
+from ComRun.Writers import NetcdfRegionWriter
 
 class OutputTest(ut.TestCase):
     def test_Output(self):
@@ -133,6 +138,185 @@ class OutputTest(ut.TestCase):
         npt.assert_array_equal(out.data['time'].sel(state1=1, state2=3, type=['wall', 'user']).values, [0.3, 0.4])
 
 
+    def test_add_growth(self):
+        variables={'state1':[1,2,3]}
+        out=Output(variables)
+        for i, state1 in enumerate([1,2,3]):
+            for wvl in range(10):
+                new=xr.DataArray([i*100+wvl], coords=[('wvl', [wvl])])
+                new.name='radiance'
+                out.add_data(new, {'state1':state1})
+        self.assertEqual(out.data['radiance'].shape, (3,10))
+        self.assertGreaterEqual(out.store['radiance'].values.shape[1], 10)
+        npt.assert_array_equal(out.data['radiance'].sel(state1=3).values, np.arange(200,210))
+        self.assertEqual(out.state_index({'state1':2}), (1,))
+        with self.assertRaises(CoordinateError):
+            out.state_index({'state2':2})
+
+    def test_add_unsorted(self):
+        variables={'state1':[1,2,3]}
+        out=Output(variables)
+        out.writer=NetcdfRegionWriter()
+        with tempfile.TemporaryDirectory() as tempdir:
+            savefile=os.path.join(tempdir, 'output.nc')
+            for state1, wvl in ((1, [2100, 2110]), (2, [620, 630])):
+                out.add_data(xr.DataArray(np.array(wvl, dtype=float), coords=[('rad_wvl', wvl)], name='radiance'), {'state1':state1})
+            npt.assert_array_equal(out.data['rad_wvl'].values, [620, 630, 2100, 2110])
+            npt.assert_array_equal(out.data['radiance'].sel(rad_wvl=slice(600, 700), state1=2).values, [620, 630])
+            out.save_snapshot(savefile)
+            out.add_data(xr.DataArray([640., 2105.], coords=[('rad_wvl', [640, 2105])], name='radiance'), {'state1':3})
+            out.save_snapshot(savefile)
+            data=xr.load_dataset(savefile)
+            npt.assert_array_equal(data['rad_wvl'].values, [620, 630, 640, 2100, 2105, 2110])
+            xr.testing.assert_equal(data['radiance'], out.data['radiance'])
+            npt.assert_array_equal(data['radiance'].sel(state1=3, rad_wvl=[640, 2105]).values, [640, 2105])
+            lazy=LazyOutput(variables)
+            lazy.add_data(xr.DataArray([1., 2.], coords=[('rad_wvl', [2100, 620])], name='radiance'), {'state1':1})
+            lazy.save_snapshot(savefile)
+            lazy.add_data(xr.DataArray([3.], coords=[('rad_wvl', [630])], name='radiance'), {'state1':2})
+            lazy.save_snapshot(savefile)
+            with lazy.data as data:
+                npt.assert_array_equal(data['rad_wvl'].values, [620, 630, 2100])
+                npt.assert_array_equal(data['radiance'].sel(state1=[1, 2]).values, [[2, np.nan, 1], [np.nan, 3, np.nan]])
+
+    def test_load_existing(self):
+        variables={'state1':[1,2], 'state2':[3,4]}
+        out=Output(variables, tied=[['state1', 'state2']])
+        new=xr.DataArray([1,2], coords=[('wvl', [400,500])])
+        new.name='radiance'
+        new.attrs['units']='W'
+        out.add_data(new, {'state1':2})
+        out2=Output({'state1':[1,2,5], 'state2':[3,4,6]}, tied=[['state1', 'state2']])
+        out2.data=out.data
+        npt.assert_array_equal(out2.data['state1'].values, [1,2,5])
+        npt.assert_array_equal(out2.data['state2'].values, [3,4,6])
+        npt.assert_array_equal(out2.data['radiance'].sel(state1=2).values, [1,2])
+        self.assertEqual(out2.data['radiance'].attrs['units'], 'W')
+        new2=xr.DataArray([3,4], coords=[('wvl', [400,500])])
+        new2.name='radiance'
+        out2.add_data(new2, {'state1':5})
+        npt.assert_array_equal(out2.data['radiance'].sel(state1=5).values, [3,4])
+        npt.assert_array_equal(out2.data['radiance'].sel(state1=1).values, [np.nan, np.nan])
+
+class LazyOutputTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir=tempfile.TemporaryDirectory()
+        self.savefile=os.path.join(self.tempdir.name, 'output.nc')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def fill(self, out, rows):
+        for state, wvl, value in rows:
+            new=xr.DataArray(np.full(len(wvl), value), coords=[('wvl', wvl)])
+            new.name='radiance'
+            out.add_data(new, state)
+
+    def test_snapshots(self):
+        variables={'state1':[1,2,3], 'state2':['a','b']}
+        rows=[({'state1':1, 'state2':'a'}, [400,500], 1), ({'state1':2, 'state2':'b'}, [600,400], 2), ({'state1':3, 'state2':'a'}, [500], 3)]
+        dense=Output(variables)
+        self.fill(dense, rows)
+        lazy=LazyOutput(variables)
+        self.fill(lazy, rows[:2])
+        lazy.save_snapshot(self.savefile)
+        self.assertEqual(lazy.pending, {})
+        self.fill(lazy, rows[2:])
+        with lazy.data as data:
+            self.assertIsNotNone(data['radiance'].chunks)
+            xr.testing.assert_equal(data['radiance'].load(), dense.data['radiance'])
+            npt.assert_array_equal(data['comrun_filled'].values, [[1,0],[0,1],[1,0]])
+        self.assertIn('3 of 6 states filled', lazy.summary())
+
+    def test_load_existing(self):
+        variables={'state1':[1,2,3]}
+        first=LazyOutput(variables)
+        self.fill(first, [({'state1':1}, [400,500], 1)])
+        first.save_snapshot(self.savefile)
+        second=LazyOutput(variables)
+        second.load_existing(self.savefile)
+        self.assertEqual(second.filled, {(0,)})
+        self.fill(second, [({'state1':3}, [500,600], 3)])
+        second.save_snapshot(self.savefile)
+        data=xr.load_dataset(self.savefile)
+        npt.assert_array_equal(data['radiance'].values, [[1,1,np.nan], [np.nan]*3, [np.nan,3,3]])
+
+    def test_load_full_snapshot(self):
+        variables={'state1':[1,2,3]}
+        dense=Output(variables)
+        self.fill(dense, [({'state1':1}, [400,500], 1)])
+        dense.save_snapshot(self.savefile)#fixed size dimensions and no comrun_filled
+        lazy=LazyOutput(variables)
+        lazy.load_existing(self.savefile)
+        self.assertEqual(lazy.filled, {(0,)})
+        self.fill(lazy, [({'state1':2}, [500,600], 2)])
+        lazy.save_snapshot(self.savefile)
+        data=xr.load_dataset(self.savefile)
+        npt.assert_array_equal(data['radiance'].values, [[1,1,np.nan], [np.nan,2,2], [np.nan]*3])
+        npt.assert_array_equal(data['comrun_filled'].values, [1,1,0])
+
+class RaggedOutputTest(ut.TestCase):
+    def test_roundtrip(self):
+        variables={'band':['vis', 'nir'], 'lwc':['0.1', '0.2']}
+        out=RaggedOutput(variables)
+        for band, wvl in (('vis', [400, 410]), ('nir', [2100, 2110, 2120])):
+            for lwc in variables['lwc']:
+                new=xr.DataArray(np.arange(len(wvl))+float(lwc), coords=[('rad_wvl', wvl)], name='radiance')
+                out.add_data(new, {'band':band, 'lwc':lwc})
+        self.assertEqual(out.data.sizes['radiance_obs'], 10)
+        npt.assert_array_equal(out.data['radiance_row_size'].values, [2, 2, 3, 3])
+        with tempfile.TemporaryDirectory() as tempdir:
+            savefile=os.path.join(tempdir, 'output.nc')
+            out.save_snapshot(savefile)
+            data=xr.load_dataset(savefile)
+            state=data.comrun.sel(band='nir', lwc='0.2')
+            npt.assert_array_equal(state['rad_wvl'].values, [2100, 2110, 2120])
+            npt.assert_array_equal(state['radiance'].values, [0.2, 1.2, 2.2])
+            loaded=RaggedOutput(variables)
+            loaded.load_existing(savefile)
+            self.assertEqual(loaded.filled, out.filled)
+            xr.testing.assert_equal(loaded.data['radiance'], out.data['radiance'])
+
+class UvspecCollectorTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir=tempfile.TemporaryDirectory()
+        self.base=os.path.join(self.tempdir.name, 'Run')
+        for taskid in range(3):
+            shutil.copy('test/integration/fixtures/Wctau/wctau_dis.dat', f'{self.base}_stderr_0_{taskid}.dat')
+            shutil.copy('test/integration/fixtures/Wctau/wctau_dis.inp', f'{self.base}_0_{taskid}.inp')
+            with open(f'{self.base}_stdout_0_{taskid}.dat', 'w') as f:
+                f.write('')
+        self.variables={'lwc':['0.1', '0.2', '0.3']}
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def collector(self):
+        return UvspecCollector(self.base+'_stdout.dat', self.base+'_stderr.dat', self.base+'.inp', [], ['time_all', 'wctau_dis'], self.variables)
+
+    def test_read_once(self):
+        collector=UvspecCollector(self.base+'_stdout.dat', self.base+'_stderr.dat', self.base+'.inp', [], ['time_all', 'wctau_dis', 'optprop_dis'], self.variables)
+        with mock.patch('builtins.open', wraps=open) as opened:
+            arrays=collector.extract(0, 1)
+        self.assertEqual([a.name for a in arrays], ['time_all', 'wctau_dis', 'optprop_dis'])
+        self.assertEqual([c.args[0] for c in opened.call_args_list], [self.base+'_stderr_0_1.dat'])
+        self.assertEqual(collector.memory, {})
+
+    def test_collect_many_parallel(self):
+        tasks=[({'lwc':lwc}, 0, taskid) for taskid, lwc in enumerate(self.variables['lwc'])]
+        serial=self.collector()
+        serial.collect_many(tasks)
+        parallel=self.collector()
+        parallel.workers=2
+        parallel.collect_many(tasks)
+        parallel.close()
+        xr.testing.assert_identical(serial.output.data, parallel.output.data)
+        serial_stats, parallel_stats=serial.take_stats(), parallel.take_stats()
+        self.assertEqual(serial_stats['bytes_parsed'], parallel_stats['bytes_parsed'])
+        self.assertEqual(set(parallel_stats), set(serial_stats))
+        self.assertEqual(serial.take_stats(), {})
+        self.assertEqual(parallel.output.data['wctau_dis'].sizes['lwc'], 3)
+
 
 if __name__=="__main__":
     test=OutputTest()
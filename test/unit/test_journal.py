@@ -0,0 +1,27 @@
+from ComRun.Journal import Journal, state_key
+import unittest as ut
+import tempfile
+import os
+
+class JournalTest(ut.TestCase):
+    def test_record_resume(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename=Journal.filename_for(os.path.join(tempdir, 'output.nc'))
+            self.assertEqual(filename, os.path.join(tempdir, 'output.journal'))
+            journal=Journal(filename)
+            journal.record('submitted', [(0, 0, {'x':'a'}), (0, 1, {'x':'b'})])
+            journal.record('finished', [(0, 1, {'x':'b'})])
+            journal.record('collected', [(0, 0, {'x':'a'})])
+            with open(filename, 'a') as f:
+                f.write('{"event": "collec')#interrupted while writing
+            resumed=Journal(filename, resume=True)
+            self.assertEqual(resumed.collected, {state_key({'x':'a'})})
+            self.assertEqual(resumed.submitted[state_key({'x':'b'})], (0, 1))
+            self.assertEqual(resumed.finished, {state_key({'x':'b'}):(0, 1)})
+            self.assertEqual(resumed.last_chunkid, 0)
+            fresh=Journal(filename)
+            self.assertFalse(os.path.exists(filename))
+            self.assertEqual(fresh.last_chunkid, -1)
+
+if __name__=="__main__":
+    ut.main()
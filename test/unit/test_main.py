@@ -1,9 +1,19 @@
 import unittest as ut
 import xarray as xr
 import numpy as np
-from ComRun.Main import Scheduler, TemplateHandler
+from ComRun.Main import Scheduler, AdaptiveScheduler, sample_design, sample_variables, stored_seed, SEED_ATTR, TemplateHandler, ChunkDriver, PipelinedDriver, WindowDriver, BulkRenderDriver, generate_chunks, shard_chunks, RunController, LocalPoolRunner, PipeRunner, SlurmRunner, Chunk
 import numpy.testing as npt
 import itertools as it
+import tempfile
+import pickle
+from ComRun.Cache import ResultCache
+from ComRun.Journal import Journal
+from ComRun.Collectors import UvspecCollector, Output
+import os
+import json
+import collections
+from ComRun.Metrics import Metrics
+from ComRun.Writers import NetcdfRegionWriter
 
 
 class SchedulerTest(ut.TestCase):
@@ -31,6 +41,376 @@ class SchedulerTest(ut.TestCase):
         next(iter1)
         self.assertEqual(next(iter1)[0],  {'x': 'b', 'y': 'e'})
         self.assertEqual(next(iter2)[0],  {'x': 'a', 'y': 'e'})
+    def test_random_access(self):
+        variables={'x':['a', 'b', 'c'], 'y':['e', 'f'], 'z':['g','h'], 'w':['1', '2', '3', '4']}
+        sched=Scheduler(variables, [['y', 'z']])
+        states=list(sched.generate_state())
+        self.assertEqual(len(sched), len(states))
+        self.assertEqual([sched.state(i) for i in range(len(sched))], states)
+        self.assertEqual([sched.index(s) for s, _ in states], list(range(len(states))))
+        self.assertEqual([sched.index(m) for _, m in states], list(range(len(states))))
+        self.assertEqual(list(sched[5:13:3]), states[5:13:3])
+        self.assertEqual(sched[-1], states[-1])
+        with self.assertRaises(IndexError):
+            sched.state(len(states))
+
+    def test_range_variables(self):
+        variables={'x':['a', 'b', 'c'], 'y':['e', 'f'], 'z':['g','h'], 'w':['1', '2', '3', '4']}
+        sched=Scheduler(variables, [['y', 'z']])
+        self.assertEqual(sched.range_variables(8, 13), {'x':['b'], 'y':['e', 'f'], 'z':['g','h'], 'w':['1', '2', '3']})
+        self.assertEqual(sched.range_variables(2, 4), {'x':['a'], 'y':['e', 'f'], 'z':['g','h'], 'w':['2']})
+        self.assertEqual(sched.range_variables(6, 10), {'x':['a', 'b'], 'y':['e', 'f'], 'z':['g','h'], 'w':['1', '2', '3', '4']})
+        self.assertEqual(sched.range_variables(0), variables)
+        for start, stop in ((8, 13), (2, 4), (5, 6)):
+            box=sched.range_variables(start, stop)
+            for state, _ in sched[start:stop]:
+                self.assertTrue(np.all([state[key] in values for key, values in box.items()]))
+
+class SamplingTest(ut.TestCase):
+    def test_lhs(self):
+        design=sample_design({'sza':(0., 80.), 'lwc':(0.1, 1.)}, 'lhs', 8, seed=1)
+        npt.assert_array_equal(np.sort(np.floor(design['sza']/10)), np.arange(8))#one sample in every stratum
+        npt.assert_array_equal(np.sort(np.floor((design['lwc']-0.1)/0.9*8)), np.arange(8))
+        npt.assert_array_equal(sample_design({'sza':(0., 80.)}, 'lhs', 8, seed=1)['sza'], sample_design({'sza':(0., 80.)}, 'lhs', 8, seed=1)['sza'])
+
+    def test_sample_variables(self):
+        variables, tied=sample_variables({'sza':['0:80'], 'lwc':['0.1:1'], 'wvl':['500', '600']}, [], 'halton', 4, seed=0)
+        self.assertEqual(tied, [['sample', 'sza', 'lwc']])
+        sched=Scheduler(variables, tied)
+        self.assertEqual(len(sched), 8)
+        state, majorstate=sched[1]
+        self.assertEqual(majorstate, {'wvl':'500', 'sample':'1'})
+        self.assertTrue(0<=float(state['sza'])<=80)
+        output=Output(variables, tied)
+        self.assertEqual(list(output.data.sza.dims), ['sample'])
+
+    def test_stored_seed(self):
+        #shards, merge and resumed runs must draw the same design as the first run
+        config={'sza':['0:80'], 'wvl':['500', '600']}
+        first, _=sample_variables(config, [], 'lhs', 5, seed=1234)
+        second, _=sample_variables(config, [], 'lhs', 5, seed=1234)
+        self.assertEqual(first, second)
+        with tempfile.TemporaryDirectory() as tempdir:
+            outputfile=os.path.join(tempdir, 'out.nc')
+            self.assertIsNone(stored_seed(outputfile))
+            Journal(Journal.filename_for(outputfile)).record_attrs({SEED_ATTR:'1234'})
+            self.assertEqual(stored_seed(outputfile), '1234')#interrupted before the first snapshot
+            output=Output(first, [['sample', 'sza']])
+            output.attrs[SEED_ATTR]='1234'
+            output.save_snapshot(outputfile)
+            os.remove(Journal.filename_for(outputfile))
+            self.assertEqual(stored_seed(outputfile), '1234')
+
+class RecordingRunner(RunController):
+    def __init__(self, events):
+        self.events=events
+    def run(self, runfile):
+        self.events.append(('run', os.path.basename(runfile)))
+    def wait(self):
+        pass
+
+class DelayedRunner(RecordingRunner):
+    """Chunk 0 needs three polls to finish, all others one."""
+    mininterval=0.001
+    def run_chunk(self, chunk):
+        self.polls=3 if chunk.chunkid==0 else 1
+        self.events.append(('run', chunk.chunkid))
+    def finished(self):
+        self.polls-=1
+        return self.polls<=0
+
+class RecordingOutput(object):
+    def __init__(self, events):
+        self.events=events
+        self.filled=set()
+    def state_index(self, state):
+        return (state['x'],)
+    def add_data(self, new, state):
+        self.events.append(('cached', state['x'], new))
+
+class RecordingCollector(object):
+    def __init__(self, events):
+        self.events=events
+        self.output=RecordingOutput(events)
+    def extract(self, chunkid, taskid):
+        if (chunkid, taskid)!=(2, 0):#only the output of this task still exists
+            raise FileNotFoundError
+        return ['recovered']
+    collection_keys=['x']
+    def collect_many(self, tasks, streams=None):
+        results=[]
+        for state, chunkid, taskid in tasks:
+            self.events.append(('collect', chunkid, taskid, state['x']))
+            results.append([state['x']])
+        return results
+    def save_snapshot(self, savefile):
+        self.events.append(('snapshot',))
+
+class StepCollector(RecordingCollector):
+    """Collects a step function of x into a real Output."""
+    def __init__(self, events, variables):
+        super().__init__(events)
+        self.output=Output(variables)
+    def collect_many(self, tasks, streams=None):
+        for state, chunkid, taskid in tasks:
+            self.events.append(('collect', chunkid, taskid, state['x']))
+            self.output.add_data(xr.DataArray([float(int(state['x'])>=10)], coords=[('wvl', [500])], name='radiance'), state)
+        return [[] for _ in tasks]
+    def save_snapshot(self, savefile):
+        self.output.save_snapshot(savefile)
+    def take_stats(self):
+        return collections.Counter({'extract_radiance':0.5, 'bytes_parsed':100})
+
+class DriverTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir=tempfile.TemporaryDirectory()
+        intemplate=os.path.join(self.tempdir.name, 'in.template')
+        with open(intemplate, 'w') as f:
+            f.write('x {{var.x}}')
+        runtemplate=os.path.join(self.tempdir.name, 'run.template')
+        with open(runtemplate, 'w') as f:
+            f.write('jobs {{var.jobs}}')
+        self.template_handler=TemplateHandler(intemplate, os.path.join(self.tempdir.name, 'in.inp'))
+        self.runtemplate_handler=TemplateHandler(runtemplate, os.path.join(self.tempdir.name, 'run.sh'))
+        self.scheduler=Scheduler({'x':['a', 'b', 'c', 'd', 'e']})
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def drive(self, driverclass, chunkstart=0, **kwargs):
+        events=[]
+        driver=driverclass(self.template_handler, self.runtemplate_handler, {}, RecordingRunner(events), RecordingCollector(events), 'out.nc', info=0, **kwargs)
+        driver.run(generate_chunks(driver.skip_cached(driver.skip_done(self.scheduler.generate_state())), 2, chunkstart))
+        driver.finalize()
+        return events
+
+    def test_resume(self):
+        filename=os.path.join(self.tempdir.name, 'out.journal')
+        journal=Journal(filename)
+        journal.record('submitted', [(0, 0, {'x':'a'}), (0, 1, {'x':'b'}), (1, 0, {'x':'c'}), (2, 0, {'x':'e'})])
+        journal.record('finished', [(0, 0, {'x':'a'}), (0, 1, {'x':'b'}), (2, 0, {'x':'e'})])
+        journal.record('collected', [(0, 0, {'x':'a'}), (0, 1, {'x':'b'})])
+        journal=Journal(filename, resume=True)
+        events=self.drive(ChunkDriver, chunkstart=journal.last_chunkid+1, journal=journal)
+        self.assertEqual([e for e in events if e[0]=='collect'], [('collect', 3, 0, 'c'), ('collect', 3, 1, 'd')])
+        self.assertEqual([e for e in events if e[0]=='cached'], [('cached', 'e', 'recovered')])
+        resumed=Journal(filename, resume=True)
+        self.assertEqual(len(resumed.collected), 5)
+
+    def test_resume_uvspec(self):
+        base=os.path.join(self.tempdir.name, 'Run')
+        for taskid in range(3):
+            with open(f'{base}_stderr_0_{taskid}.dat', 'w') as f:
+                f.write(f'###Runtime {taskid+1}.00 0.10 0.20 ###\n')
+        variables={'x':['a', 'b', 'c']}
+        collector=UvspecCollector(base+'_stdout.dat', base+'_stderr.dat', base+'.inp', [], ['time_all'], variables)
+        collector.extract(0, 2)#the last task read by the collector before recovery
+        journal=Journal(os.path.join(self.tempdir.name, 'out.journal'))
+        journal.record('submitted', [(0, taskid, {'x':x}) for taskid, x in enumerate('abc')])
+        journal.record('finished', [(0, 0, {'x':'a'}), (0, 1, {'x':'b'})])#task 2 was killed after writing its runtime
+        driver=ChunkDriver(self.template_handler, self.runtemplate_handler, {}, RecordingRunner([]), collector, os.path.join(self.tempdir.name, 'out.nc'), info=0, journal=journal)
+        states=list(driver.skip_done(Scheduler(variables).generate_state()))
+        self.assertEqual([s['x'] for s, _ in states], ['c'])
+        driver.add_cached()
+        npt.assert_array_equal(collector.output.data.time_all.sel(rt_type='wall').values, [1., 2., np.nan])
+
+    def test_fill_gaps(self):
+        collector=RecordingCollector([])
+        collector.output=Output({'x':['a', 'b', 'c', 'd', 'e']})
+        collector.variable_names=lambda: ['radiance', 'time_all']
+        for x, radiance in (('a', 1.0), ('b', np.nan), ('c', 3.0), ('e', 5.0)):
+            collector.output.add_data(xr.DataArray([radiance, 1.0], coords=[('wvl', [400, 500])], name='radiance'), {'x':x})
+            if x!='c':
+                collector.output.add_data(xr.DataArray(1.0, name='time_all'), {'x':x})
+        driver=ChunkDriver(self.template_handler, self.runtemplate_handler, {}, RecordingRunner([]), collector, os.path.join(self.tempdir.name, 'out.nc'), info=0)
+        states=list(driver.skip_complete(self.scheduler.generate_state()))
+        self.assertEqual([s['x'] for s, _ in states], ['c', 'd'])#'c' misses time_all, 'd' was never run
+
+    def test_refine(self):
+        variables={'x':[str(i) for i in range(17)], 'y':['a', 'b']}
+        events=[]
+        collector=StepCollector(events, variables)
+        scheduler=AdaptiveScheduler(variables, refine=['x'], coarse=3, tolerance=0.5)
+        driver=ChunkDriver(self.template_handler, self.runtemplate_handler, {}, RecordingRunner(events), collector, os.path.join(self.tempdir.name, 'out.nc'), info=0)
+        driver.run(driver.refine_chunks(scheduler.rounds(lambda majorstate: collector.output.state_values('radiance', majorstate)), 4))
+        collected=[e[3] for e in events if e[0]=='collect']
+        self.assertEqual(collected, ['0', '0', '8', '8', '16', '16', '12', '12', '10', '10', '9', '9'])#bisection towards the step
+        self.assertEqual(len(collector.output.filled), 12)
+        results={}
+        scheduler=AdaptiveScheduler(variables, refine=['x'], budget=7)
+        rounds=[]
+        for states in scheduler.rounds(lambda majorstate: results.get(scheduler.index(majorstate))):
+            rounds.append(len(states))
+            results.update((scheduler.index(m), np.array([float(m['x'])])) for _, m in states)
+        self.assertEqual(rounds, [6, 1])
+
+    def test_metrics(self):
+        variables={'x':['8', '9', '10']}
+        collector=StepCollector([], variables)
+        collector.output.writer=NetcdfRegionWriter()
+        self.scheduler=Scheduler(variables)
+        metrics=Metrics(os.path.join(self.tempdir.name, 'out.metrics.jsonl'))
+        driver=ChunkDriver(self.template_handler, self.runtemplate_handler, {}, RecordingRunner([]), collector, os.path.join(self.tempdir.name, 'out.nc'), info=0, metrics=metrics)
+        driver.run(generate_chunks(self.scheduler.generate_state(), 2))
+        with open(metrics.filename) as f:
+            lines=[json.loads(line) for line in f]
+        self.assertEqual([(line['chunk'], line['tasks'], line['bytes_parsed']) for line in lines], [(0, 2, 100), (1, 1, 100)])
+        self.assertEqual(set(lines[0]['phases']), {'render', 'submit', 'wait', 'collect', 'extract_radiance', 'snapshot'})
+        self.assertGreater(lines[0]['bytes_written'], 0)
+        self.assertLess(lines[1]['bytes_written'], lines[0]['bytes_written'])#only the new state is written
+        self.assertEqual(metrics.counters['tasks'], 3)
+
+    def test_cache(self):
+        cache=ResultCache(os.path.join(self.tempdir.name, 'cache'))
+        first=self.drive(ChunkDriver, cache=cache)
+        self.assertEqual(len([e for e in first if e[0]=='collect']), 5)
+        self.scheduler=Scheduler({'x':['a', 'f', 'e']})
+        second=self.drive(ChunkDriver, cache=cache)
+        self.assertEqual([e for e in second if e[0]=='collect'], [('collect', 0, 0, 'f')])
+        self.assertCountEqual([e for e in second if e[0]=='cached'], [('cached', 'a', 'a'), ('cached', 'e', 'e')])
+
+    def test_bulk_render(self):
+        self.scheduler=Scheduler({'x':['a', 'b', 'c', 'd', 'e'], 'y':['CHUNKID_TASKID']})
+        events=self.drive(BulkRenderDriver, workers=2)
+        self.assertEqual(events, [])
+        with open(os.path.join(self.tempdir.name, 'in_2_0.inp')) as f:
+            self.assertEqual(f.read(), 'x e')
+        with open(os.path.join(self.tempdir.name, 'run_1.sh')) as f:
+            self.assertEqual(f.read(), 'jobs 1')
+
+    def test_shard_chunks(self):
+        ranges=[shard_chunks(11, 2, 4, shard) for shard in range(4)]
+        self.assertEqual(ranges, [(0,1), (1,3), (3,4), (4,6)])
+
+    def test_generate_chunks(self):
+        chunks=list(generate_chunks(self.scheduler.generate_state(), 2, chunkstart=3))
+        self.assertEqual([c.chunkid for c in chunks], [3,4,5])
+        self.assertEqual([len(c) for c in chunks], [2,2,1])
+
+    def test_sequential(self):
+        events=self.drive(ChunkDriver)
+        self.assertEqual(events[:4], [('run', 'run_0.sh'), ('collect', 0, 0, 'a'), ('collect', 0, 1, 'b'), ('snapshot',)])
+        with open(os.path.join(self.tempdir.name, 'in_2_0.inp')) as f:
+            self.assertEqual(f.read(), 'x e')
+        with open(os.path.join(self.tempdir.name, 'run_2.sh')) as f:
+            self.assertEqual(f.read(), 'jobs 0')
+
+    def test_pipelined(self):
+        sequential=self.drive(ChunkDriver)
+        pipelined=self.drive(PipelinedDriver, depth=2)
+        self.assertEqual([e for e in pipelined if e[0]=='run'], [e for e in sequential if e[0]=='run'])
+        self.assertEqual([e for e in pipelined if e[0]!='run'], [e for e in sequential if e[0]!='run'])
+
+    def test_window(self):
+        events=[]
+        driver=WindowDriver(self.template_handler, self.runtemplate_handler, {}, DelayedRunner(events), RecordingCollector(events), 'out.nc', info=0, window=2)
+        driver.run(generate_chunks(self.scheduler.generate_state(), 2))
+        order=[(e[0], e[1]) for e in events if e[0]=='run' or (e[0]=='collect' and e[2]==0)]
+        self.assertEqual(order, [('run', 0), ('run', 1), ('collect', 1), ('run', 2), ('collect', 2), ('collect', 0)])
+
+class TemplateTest(ut.TestCase):
+    def test_render(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            templatefile=os.path.join(tempdir, 'in.template')
+            with open(templatefile, 'w') as f:
+                f.write('{{var.x}} {{var.y}}')
+            handler=TemplateHandler(templatefile, os.path.join(tempdir, 'in.inp'))
+            state={'x':'a', 'y':'f_CHUNKID_TASKID'}
+            self.assertEqual(handler.render(state), ['a f_CHUNKID_TASKID'])
+            self.assertEqual(handler.render(state, chunkid=2, taskid=3), ['a f_2_3'])
+            self.assertEqual(state['y'], 'f_CHUNKID_TASKID')
+            handler=pickle.loads(pickle.dumps(handler))
+            self.assertEqual(handler.create(state, chunkid=2, taskid=3), [os.path.join(tempdir, 'in_2_3.inp')])
+
+class LocalPoolRunnerTest(ut.TestCase):
+    def test_run_chunk(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            names=[os.path.join(tempdir, n) for n in ('Run.inp', 'Run_stdout.dat', 'Run_stderr.dat')]
+            for taskid in range(4):
+                with open(os.path.join(tempdir, f'Run_1_{taskid}.inp'), 'w') as f:
+                    f.write(f'task {taskid}')
+            runner=LocalPoolRunner('cat', *names, processes=2)
+            runner.run_chunk(Chunk(1, [({}, {})]*4))
+            runner.wait()
+            self.assertEqual(runner.result, [0,0,0,0])
+            with open(os.path.join(tempdir, 'Run_stdout_1_3.dat')) as f:
+                self.assertEqual(f.read(), 'task 3')
+            with open(os.path.join(tempdir, 'Run_stderr_1_3.dat')) as f:
+                self.assertRegex(f.read(), r'^###Runtime [0-9.]+ [0-9.]+ [0-9.]+ ###')
+
+class PipeRunnerTest(ut.TestCase):
+    def test_run_in_memory(self):
+        fixture=os.path.abspath('test/integration/fixtures/Wctau/wctau_dis.dat')
+        with tempfile.TemporaryDirectory() as tempdir:
+            intemplate=os.path.join(tempdir, 'in.template')
+            with open(intemplate, 'w') as f:
+                f.write('lwc {{var.lwc}}')
+            handler=TemplateHandler(intemplate, os.path.join(tempdir, 'Run.inp'), ['input'])
+            handler.memory_only.add('input')
+            runner=PipeRunner(handler.templates['input'], f'grep -q "lwc 0.3" && exit 1; cat {fixture} >&2', processes=2)
+            names=[os.path.join(tempdir, n) for n in ('Run_stdout.dat', 'Run_stderr.dat', 'Run.inp')]
+            variables={'lwc':['0.1', '0.2', '0.3']}
+            collector=UvspecCollector(*names, [], ['time_all', 'wctau_dis'], variables)
+            driver=ChunkDriver(handler, TemplateHandler([], []), {}, runner, collector, os.path.join(tempdir, 'out.nc'), info=0)
+            driver.run(generate_chunks(Scheduler(variables).generate_state(), 3))
+            self.assertEqual(runner.result[:2], [0,0])
+            self.assertEqual(sorted(os.listdir(tempdir)), ['in.template', 'out.nc'])
+            wctau=collector.output.data['wctau_dis']
+            self.assertEqual(wctau.sizes['lwc'], 3)
+            self.assertFalse(np.isnan(wctau.sel(lwc='0.2')).any())
+            self.assertTrue(np.isnan(wctau.sel(lwc='0.3')).all())
+
+class SlurmRunnerTest(ut.TestCase):
+    """Run SlurmRunner against fake sbatch, squeue and sacct commands."""
+    def setUp(self):
+        self.tempdir=tempfile.TemporaryDirectory()
+        shims={'sbatch':'echo "$@" > {d}/sbatch_args; echo "4711;cluster"',
+            'squeue':'n=$(cat {d}/polls 2>/dev/null || echo 0); echo $((n+1)) > {d}/polls; [ $n -lt 2 ] && echo "4711_[0-2] PENDING"; exit 0',
+            'sacct':'printf "4711_0|COMPLETED|0:0\\n4711_1|FAILED|1:0\\n4711_2|OUT_OF_MEMORY|0:125\\n"'}
+        for name, script in shims.items():
+            self.shim(name, script)
+        self.path=os.environ['PATH']
+        os.environ['PATH']=self.tempdir.name+os.pathsep+self.path
+
+    def tearDown(self):
+        os.environ['PATH']=self.path
+        self.tempdir.cleanup()
+
+    def shim(self, name, script):
+        path=os.path.join(self.tempdir.name, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n'+script.format(d=self.tempdir.name)+'\n')
+        os.chmod(path, 0o755)
+
+    def test_run(self):
+        runner=SlurmRunner(mininterval=0.01, maxinterval=0.02)
+        runner.run('Run_0.sh')
+        self.assertEqual(runner.jobid, '4711')
+        with open(os.path.join(self.tempdir.name, 'sbatch_args')) as f:
+            self.assertEqual(f.read().strip(), '--parsable Run_0.sh')
+        runner.wait()
+        with open(os.path.join(self.tempdir.name, 'polls')) as f:
+            self.assertEqual(int(f.read()), 3)
+        self.assertEqual(runner.states[1], ('FAILED', '1:0'))
+        self.assertEqual(runner.failed_tasks(None), set())#the tasks of an element are unknown
+        self.assertGreater(runner.queue_time, 0)
+        chunk=Chunk(0, [({}, {})]*5)
+        chunk.elements=[[0, 4], [1], [2, 3]]
+        self.assertEqual(runner.failed_tasks(chunk), {1, 2, 3})#all tasks of the failed elements
+        runner.array_tasks=True
+        self.assertEqual(runner.failed_tasks(None), {1, 2})
+
+    def test_wait_for_sacct(self):
+        #squeue fails and the accounting still reports a running element in the first polls
+        self.shim('squeue', 'exit 1')
+        self.shim('sacct', 'n=$(cat {d}/polls 2>/dev/null || echo 0); echo $((n+1)) > {d}/polls; [ $n -lt 2 ] && state=RUNNING || state=COMPLETED; printf "4711_0|COMPLETED|0:0\\n4711_1|$state|0:0\\n"')
+        runner=SlurmRunner(mininterval=0.01, maxinterval=0.02)
+        runner.run('Run_0.sh')
+        self.assertFalse(runner.finished())
+        runner.wait()
+        with open(os.path.join(self.tempdir.name, 'polls')) as f:
+            self.assertEqual(int(f.read()), 3)
+        self.assertEqual(runner.states[1], ('COMPLETED', '0:0'))
 
 # class TemplateHandlerTest(ut.TestCase):
 #     def test_create(self):
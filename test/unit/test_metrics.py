@@ -0,0 +1,30 @@
+from ComRun.Metrics import Metrics
+import unittest as ut
+import tempfile
+import json
+import os
+
+class MetricsTest(ut.TestCase):
+    def test_finish(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            metrics=Metrics(Metrics.filename_for(os.path.join(tempdir, 'Output.nc')), os.path.join(tempdir, 'comrun.prom'))
+            self.assertEqual(metrics.filename, os.path.join(tempdir, 'Output.metrics.jsonl'))
+            with metrics.phase(0, 'render'):
+                pass
+            metrics.add_phase(0, 'wait', 2.)
+            metrics.add_phase(0, 'wait', 1.)
+            metrics.add(0, bytes_parsed=10)
+            metrics.add(1, bytes_parsed=5)
+            metrics.finish(0, 4)
+            with open(metrics.filename) as f:
+                entry=json.loads(f.read())
+            self.assertEqual(entry['chunk'], 0)
+            self.assertEqual(entry['tasks'], 4)
+            self.assertEqual(entry['phases']['wait'], 3.)
+            self.assertEqual(entry['bytes_parsed'], 10)
+            self.assertIn(1, metrics.chunks)#still running
+            with open(metrics.promfile) as f:
+                prom=f.read().splitlines()
+            self.assertIn('comrun_phase_seconds_total{phase="wait"} 3.0', prom)
+            self.assertIn('comrun_tasks_total 4', prom)
+            self.assertIn('comrun_chunks_total 1', prom)
@@ -0,0 +1,37 @@
+from ComRun.Packing import CostModel, TaskPacker, pack_lpt
+from ComRun.Main import Chunk
+import xarray as xr
+import numpy as np
+import unittest as ut
+import tempfile
+import os
+
+class CostModelTest(ut.TestCase):
+    def dataset(self):
+        wall=np.outer([1., 10., 100.], [1., 2.])#runtime grows with wvl and with photons
+        wall[2, 1]=np.nan#never run
+        times=np.stack([wall, wall/2, wall/10], axis=-1)
+        return xr.Dataset({'time_all':(('wvl', 'photons', 'rt_type'), times)}, coords={'wvl':['a', 'b', 'c'], 'photons':['1e4', '1e5'], 'rt_type':['wall', 'user', 'kernel']})
+
+    def test_fit(self):
+        model=CostModel.fit(self.dataset(), ['wvl', 'photons'])
+        self.assertEqual(model.predict({'wvl':'b', 'photons':'1e5'}), 20.)
+        self.assertAlmostEqual(model.predict({'wvl':'c', 'photons':'1e5'}), 200., places=3)
+        self.assertEqual(CostModel.fit(xr.Dataset(), ['wvl', 'photons']).predict({'wvl':'c', 'photons':'1e5'}), 1.)
+
+    def test_pack_lpt(self):
+        packing=pack_lpt([1, 8, 2, 4, 1, 3, 1], 3)
+        self.assertCountEqual([t for tasks in packing for t in tasks], range(7))
+        self.assertEqual(packing[0], [1])
+        self.assertEqual(sorted(sum([1, 8, 2, 4, 1, 3, 1][t] for t in tasks) for tasks in packing), [6, 6, 8])
+        self.assertEqual(len(pack_lpt([1, 2], 5)), 2)
+
+    def test_manifest(self):
+        model=CostModel(['x'], exact={('a',):5., ('b',):1., ('c',):1., ('d',):3.})
+        chunk=Chunk(3, [({'x':x}, {'x':x}) for x in 'abcd'])
+        with tempfile.TemporaryDirectory() as tempdir:
+            runstate=TaskPacker(model, 2, os.path.join(tempdir, 'Run.manifest')).pack(chunk)
+            self.assertEqual(runstate, {'manifest':os.path.join(tempdir, 'Run_3.manifest'), 'elements':'1'})
+            with open(runstate['manifest']) as f:
+                self.assertEqual(f.read(), '0\n3 1 2\n')
+        self.assertEqual(chunk.elements, [[0], [3, 1, 2]])
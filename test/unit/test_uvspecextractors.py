@@ -2,6 +2,9 @@ import ComRun.UvspecExtractors as uvex
 import numpy.testing as npt
 import numpy as np
 import unittest as ut
+import tempfile
+import os
+import io
 
 class UvexTest(ut.TestCase):
     def test_wctau_dis(self):
@@ -10,6 +13,17 @@ class UvexTest(ut.TestCase):
         checkresult=np.array([[599.831543, 77.240723, 0.0], [600.453247, 77.242174, 1.4e-05], [600.80188, 77.24301, 3.2e-05], [601.435242, 77.244528, 5.5e-05], [602.335449, 77.246685, 8.7e-05], [602.585754, 77.247283, 9.2e-05], [603.195312, 77.248744, 0.00012], [603.859863, 77.250338, 0.000143], [604.22345, 77.251209, 0.000157], [604.929993, 77.252903, 0.00018], [605.525879, 77.254329, 0.000203], [606.12915, 77.255774, 0.00023], [606.623413, 77.256958, 0.000244], [607.052368, 77.257989, 0.000258], [607.692566, 77.259523, 0.000281], [608.317993, 77.261021, 0.000309], [608.830994, 77.262251, 0.000322], [609.294067, 77.263362, 0.000341], [609.871948, 77.264747, 0.000359]])
         npt.assert_almost_equal(checkresult, result)
     
+    def test_wctau_without_phase_function(self):
+        #other solvers than disort do not print the phase function line after the table
+        with open('test/integration/fixtures/Wctau/wctau_dis.dat') as f:
+            checkresult=uvex.get_wctau_dis_fromstream(f)
+        with open('test/integration/fixtures/Wctau/wctau_dis_nophase.dat') as f:
+            npt.assert_almost_equal(uvex.get_wctau_dis_fromstream(f), checkresult)
+        with open('test/integration/fixtures/Wctau/wctau_dis_nophase.dat') as f:
+            result=uvex.get_optprop_table_fromstream(f)
+        self.assertEqual(len(result), 19)
+        npt.assert_almost_equal([table[-2,6] for table in result.values()], checkresult[:,1])
+
     def test_optprop_table_fromstream(self):
         with open('test/integration/fixtures/Wctau/wctau_dis.dat') as f:
             result=uvex.get_optprop_table_fromstream(f)
@@ -17,3 +31,51 @@ class UvexTest(ut.TestCase):
         npt.assert_almost_equal(checkwvl, list(result.keys()))
         checkresult=np.array([[599.831543, 77.240723, 0.0], [600.453247, 77.242174, 1.4e-05], [600.80188, 77.24301, 3.2e-05], [601.435242, 77.244528, 5.5e-05], [602.335449, 77.246685, 8.7e-05], [602.585754, 77.247283, 9.2e-05], [603.195312, 77.248744, 0.00012], [603.859863, 77.250338, 0.000143], [604.22345, 77.251209, 0.000157], [604.929993, 77.252903, 0.00018], [605.525879, 77.254329, 0.000203], [606.12915, 77.255774, 0.00023], [606.623413, 77.256958, 0.000244], [607.052368, 77.257989, 0.000258], [607.692566, 77.259523, 0.000281], [608.317993, 77.261021, 0.000309], [608.830994, 77.262251, 0.000322], [609.294067, 77.263362, 0.000341], [609.871948, 77.264747, 0.000359]])
         npt.assert_almost_equal([result[wvl][-2,6] for wvl in checkwvl], checkresult[:,1])#6. column is water cloud opt thickness. In this example, we have one level, so it should be the same as the total opt depth.
+
+    def test_read_disort_stdout(self):
+        with open('test/integration/fixtures/Radiance/radiance_dis.dat') as f:
+            standard, (umu, phi, radiance)=uvex.read_disort_stdout(f.read())
+        npt.assert_almost_equal(standard[:,0], [500, 550, 600])
+        npt.assert_almost_equal(standard[1,1:], [2.2, 4.4, 6.6, 8.8, 11, 13.2])
+        npt.assert_almost_equal(umu, [-1, 0.5])
+        npt.assert_almost_equal(phi, [0, 90, 180])
+        self.assertEqual(radiance.shape, (3, 2, 3))
+        npt.assert_almost_equal(radiance[2,1], [0.13, 0.131, 0.132])
+
+    def test_read_disort_stdout_standard(self):
+        with open('test/integration/fixtures/Radiance/standard_dis.dat') as f:
+            standard, radiance=uvex.read_disort_stdout(f.read())
+        self.assertIsNone(radiance)
+        self.assertEqual(standard.shape, (3, 7))
+
+    def test_read_disort_stdout_seven_phi(self):
+        text='500 1 2 3 4 5 6\n0 30 60 90 120 150 180\n1 0 0 0 0 0 0 0 0\n'
+        with self.assertRaises(AssertionError):
+            uvex.read_disort_stdout(text)
+
+    def test_read_mystic_spc(self):
+        grid=np.stack(np.meshgrid([500., 600.], [0., 1., 2.], [0.], [0., 1.], np.arange(4), indexing='ij'), -1).reshape(-1, 5)
+        grid[:,4]=np.arange(len(grid))
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename=os.path.join(tempdir, 'mc.rad.spc')
+            np.savetxt(filename, grid, fmt='%g')
+            coords, radiance=uvex.read_mystic_spc(filename)
+        npt.assert_equal(coords[0], [500, 600])
+        npt.assert_equal(coords[1], [0, 1, 2])
+        npt.assert_equal(coords[2], [0])
+        npt.assert_equal(coords[3], [0, 1])
+        self.assertEqual(coords[4], ['I', 'Q', 'U', 'V'])
+        self.assertEqual(radiance.shape, (2, 3, 1, 2, 4))
+        self.assertEqual(radiance[1,2,0,1,3], len(grid)-1)
+
+    def test_scan_stderr(self):
+        with open('test/integration/fixtures/Wctau/wctau_dis.dat') as f:
+            text=f.read()
+        lines=(line for line in io.StringIO(text+'###Runtime 1.50 1.20 0.10 ###\n'))
+        results=list(uvex.scan_stderr(lines, ['wctau', 'runtime']))#not seekable, read until the end
+        self.assertEqual([q for q, _ in results], ['wctau']*19+['runtime'])
+        self.assertEqual(results[-1][1], [1.5, 1.2, 0.1])
+        stream=io.StringIO(text+'trailing output\n'*1000+'###Runtime 1.50 1.20 0.10 ###\n')
+        results=dict(uvex.scan_stderr(stream, ['optprop', 'runtime']))#the runtime is read from the tail
+        self.assertEqual(results['runtime'], [1.5, 1.2, 0.1])
+        npt.assert_almost_equal(results['optprop'][0], 609.871948)
@@ -0,0 +1,175 @@
+from ComRun.Collectors import Output
+from ComRun.Writers import NetcdfRegionWriter, ZarrRegionWriter, contiguous_regions, state_chunks, writer_for, merge_files
+import xarray as xr
+import numpy.testing as npt
+import numpy as np
+import unittest as ut
+import tempfile
+import os
+
+class WriterTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir=tempfile.TemporaryDirectory()
+        self.savefile=os.path.join(self.tempdir.name, 'output.nc')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def add(self, out, state, wvl, value):
+        new=xr.DataArray(np.full(len(wvl), value), coords=[('wvl', wvl)])
+        new.name='radiance'
+        out.add_data(new, state)
+
+    def test_contiguous_regions(self):
+        regions=list(contiguous_regions([(0,1), (0,2), (1,0), (0,4)]))
+        self.assertEqual(regions, [(0, slice(1,3)), (0, slice(4,5)), (1, slice(0,1))])
+
+    def test_region_writer(self):
+        out=Output({'state1':[1,2,3], 'state2':['a','b']})
+        out.writer=writer_for(self.savefile, 'incremental')
+        self.assertIsInstance(out.writer, NetcdfRegionWriter)
+        self.add(out, {'state1':1, 'state2':'a'}, [400,500], 1)
+        out.save_snapshot(self.savefile)
+        self.assertEqual(len(out.dirty), 0)
+        self.add(out, {'state1':2, 'state2':'b'}, [500,600], 2)
+        out.save_snapshot(self.savefile)
+        data=xr.load_dataset(self.savefile)
+        npt.assert_array_equal(data['radiance'].sel(state1=1, state2='a').values, [1,1,np.nan])
+        npt.assert_array_equal(data['radiance'].sel(state1=2, state2='b').values, [np.nan,2,2])
+        npt.assert_array_equal(data['comrun_filled'].values, [[1,0],[0,1],[0,0]])
+
+        loaded=Output({'state1':[1,2,3], 'state2':['a','b']})
+        loaded.load_existing(self.savefile)
+        self.assertNotIn('comrun_filled', loaded.data)
+        self.assertCountEqual(loaded.filled, [(0,0), (1,1)])
+        npt.assert_array_equal(loaded.data['radiance'].sel(state1=2, state2='b').values, [np.nan,2,2])
+
+    def test_region_writer_scalar_string(self):
+        out=Output({'state1':[1,2]})
+        out.writer=writer_for(self.savefile, 'incremental')
+        out.add_data(xr.DataArray('disort', name='solver'), {'state1':1})
+        out.save_snapshot(self.savefile)
+        out.add_data(xr.DataArray('mystic', name='solver'), {'state1':2})
+        out.save_snapshot(self.savefile)
+        data=xr.load_dataset(self.savefile)
+        self.assertEqual(list(data['solver'].values), ['disort', 'mystic'])
+
+    def test_merge_files(self):
+        variables={'state1':[1,2,3], 'state2':['a','b']}
+        shards=[os.path.join(self.tempdir.name, f'output_shard{i}.nc') for i in range(2)]
+        first=Output(variables)
+        self.add(first, {'state1':1, 'state2':'a'}, [400,500], 1)
+        self.add(first, {'state1':1, 'state2':'b'}, [400,500], 2)
+        first.save_snapshot(shards[0])#without comrun_filled
+        second=Output(variables)
+        second.writer=writer_for(shards[1], 'incremental')
+        self.add(second, {'state1':3, 'state2':'b'}, [600,500], 3)
+        second.save_snapshot(shards[1])
+        merge_files(shards, self.savefile, first.state_dims)
+        data=xr.load_dataset(self.savefile)
+        npt.assert_array_equal(data['wvl'].values, [400,500,600])
+        npt.assert_array_equal(data['radiance'].sel(state1=1, state2='b').values, [2,2,np.nan])
+        npt.assert_array_equal(data['radiance'].sel(state1=3, state2='b').values, [np.nan,3,3])
+        npt.assert_array_equal(data['comrun_filled'].values, [[1,1],[0,0],[0,1]])
+        merged=Output(variables)
+        merged.load_existing(self.savefile)
+        self.assertEqual(merged.filled, {(0,0), (0,1), (2,1)})
+
+    def test_merge_zarr(self):
+        variables={'state1':[1,2], 'state2':['a','b']}
+        shards=[os.path.join(self.tempdir.name, f'output_shard{i}.nc') for i in range(2)]
+        for shard, state1 in zip(shards, [1, 2]):
+            out=Output(variables)
+            self.add(out, {'state1':state1, 'state2':'a'}, [400,500], state1)
+            out.save_snapshot(shard)
+        savefile=os.path.join(self.tempdir.name, 'output.zarr')
+        merge_files(shards, savefile, ['state1', 'state2'], chunksize=2)
+        merged=Output(variables)
+        merged.writer=writer_for(savefile, chunksize=2)#the merged store can be continued
+        self.add(merged, {'state1':2, 'state2':'b'}, [400], 3)
+        merged.save_snapshot(savefile)
+        data=xr.open_zarr(savefile).load()
+        npt.assert_array_equal(data['radiance'].sel(wvl=400).values, [[1,np.nan],[2,3]])
+        npt.assert_array_equal(data['comrun_filled'].values, [[1,0],[1,1]])
+
+    def test_merge_partial_files(self):
+        #like the shards, every file only covers the box of its own states
+        variables={'state1':[1,2,3], 'state2':['a','b','c']}
+        shards=[os.path.join(self.tempdir.name, f'output_shard{i}.nc') for i in range(2)]
+        first=Output({'state1':[1], 'state2':['b']})
+        self.add(first, {'state1':1, 'state2':'b'}, [400], 1)
+        first.save_snapshot(shards[0])
+        second=Output({'state1':[1,2], 'state2':['a','b','c']})
+        self.add(second, {'state1':1, 'state2':'c'}, [400], 2)
+        self.add(second, {'state1':2, 'state2':'a'}, [400], 3)
+        second.save_snapshot(shards[1])
+        merge_files(shards, self.savefile, ['state1', 'state2'], variables)
+        data=xr.load_dataset(self.savefile)
+        npt.assert_array_equal(data['state2'].values, ['a','b','c'])
+        npt.assert_array_equal(data['radiance'].sel(wvl=400).values, [[np.nan,1,2],[3,np.nan,np.nan],[np.nan]*3])
+        npt.assert_array_equal(data['comrun_filled'].values, [[0,1,1],[1,0,0],[0,0,0]])
+
+    def test_state_chunks(self):
+        self.assertEqual(state_chunks([3,4,5], 1), (1,1,1))
+        self.assertEqual(state_chunks([3,4,5], 12), (1,1,1))#a chunk of 12 states does not cover complete rows of 5
+        self.assertEqual(state_chunks([3,4,5], 10), (1,2,5))
+        self.assertEqual(state_chunks([3,4,5], 40), (1,4,5))
+        self.assertEqual(state_chunks([3,4,5], 15), (1,1,5))
+        self.assertEqual(state_chunks([3,4,5], 100), (3,4,5))
+
+    def test_zarr_writer(self):
+        savefile=os.path.join(self.tempdir.name, 'output.zarr')
+        variables={'state1':[1,2,3], 'state2':['a','b']}
+        out=Output(variables)
+        out.writer=writer_for(savefile, chunksize=2)
+        self.assertIsInstance(out.writer, ZarrRegionWriter)
+        self.add(out, {'state1':1, 'state2':'a'}, [400,500], 1)
+        out.save_snapshot(savefile)
+        self.add(out, {'state1':1, 'state2':'b'}, [400,500], 2)
+        out.save_snapshot(savefile)
+        #a second process fills another region of the same store
+        other=Output(variables)
+        other.writer=writer_for(savefile, chunksize=2)
+        self.add(other, {'state1':3, 'state2':'b'}, [500], 3)
+        other.save_snapshot(savefile)
+        data=xr.open_zarr(savefile).load()
+        self.assertEqual(data['radiance'].encoding['chunks'], (1,2,2))
+        npt.assert_array_equal(data['radiance'].sel(state1=1).values, [[1,1],[2,2]])
+        npt.assert_array_equal(data['radiance'].sel(state1=3, state2='b').values, [np.nan,3])
+        npt.assert_array_equal(data['comrun_filled'].values, [[1,1],[0,0],[0,1]])
+
+    def test_zarr_two_writers(self):
+        savefile=os.path.join(self.tempdir.name, 'output.zarr')
+        variables={'state1':[1,2], 'state2':['a','b']}
+        first=Output(variables); first.writer=writer_for(savefile, chunksize=2)
+        second=Output(variables); second.writer=writer_for(savefile, chunksize=2)
+        self.add(first, {'state1':1, 'state2':'a'}, [400,500], 1)
+        self.add(second, {'state1':2, 'state2':'a'}, [400,500], 3)
+        first.save_snapshot(savefile)
+        second.save_snapshot(savefile)#the store exists already
+        self.add(first, {'state1':1, 'state2':'b'}, [400,500], 2)
+        first.save_snapshot(savefile)
+        self.add(second, {'state1':2, 'state2':'b'}, [500,600], 4)#a new wavelength is appended
+        new=xr.DataArray([5.]); new.name='irradiance'
+        second.add_data(new.squeeze(), {'state1':2, 'state2':'b'})
+        second.save_snapshot(savefile)
+        data=xr.open_zarr(savefile).load()
+        npt.assert_array_equal(data.wvl, [400,500,600])
+        npt.assert_array_equal(data['radiance'].sel(state1=1).values, [[1,1,np.nan],[2,2,np.nan]])
+        npt.assert_array_equal(data['radiance'].sel(state1=2).values, [[3,3,np.nan],[np.nan,4,4]])
+        npt.assert_array_equal(data['irradiance'].values, [[np.nan,np.nan],[np.nan,5]])
+        npt.assert_array_equal(data['comrun_filled'].values, [[1,1],[1,1]])
+
+    def test_zarr_misaligned_store(self):
+        savefile=os.path.join(self.tempdir.name, 'output.zarr')
+        variables={'state1':[1,2,3], 'state2':['a','b']}
+        out=Output(variables); out.writer=writer_for(savefile, chunksize=2)
+        self.add(out, {'state1':1, 'state2':'a'}, [400], 1)
+        out.save_snapshot(savefile)
+        other=Output(variables); other.writer=writer_for(savefile, chunksize=1)
+        self.add(other, {'state1':2, 'state2':'a'}, [400], 2)
+        with self.assertRaises(Exception):
+            other.save_snapshot(savefile)
+
+if __name__=="__main__":
+    ut.main()